@@ -1,90 +1,260 @@
-from fastapi import APIRouter, UploadFile, File, BackgroundTasks, HTTPException, Depends, Request, Form
+from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Request, Form, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import UploadFile as StarletteUploadFile
 from typing import Optional, Any
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.models import schemas
-from app.services import ai_services, google_drive
+from app.services import ai_services, google_drive, kie_results
 from app import crud
-from app.database import SessionLocal, get_db
+from app.database import get_async_db
 from app.models.models import TaskStatus
-import os
+from app.core.config import settings
+from app.services.sse import SSE_HEADERS, format_sse, stream_analysis_events
+from app.services.task_events import task_events, task_event
+from app.services.job_queue import job_queue
+from app.services.admission import PRIORITY_BULK
+from app.services.jobs import TASK_GENERATION, submission_admission, admission_stats
+from app.services.media_cache import media_response
+from app.services.callback_inbox import InboxBusyError, callback_processor
+from app.services.script_formats import ScriptTooLargeError
+from app.services.script_ingest import ingest_scripts
+import asyncio
 router = APIRouter()
 
-def process_video_generation(task_id: str, prompt: str):
-    db = SessionLocal()
-    try:
-        crud.update_task(db, task_id=task_id, status=TaskStatus.PROCESSING)
-        print(f"Task {task_id}: Started processing.")
-        
-        video_url = ai_services.generate_video_from_prompt(prompt)
-        
-        crud.update_task(db, task_id=task_id, status=TaskStatus.COMPLETED, result_url=video_url)
-        print(f"Task {task_id}: Completed successfully.")
-
-    except Exception as e:
-        crud.update_task(db, task_id=task_id, status=TaskStatus.FAILED, result_url=str(e))
-        print(f"Task {task_id}: Failed. Error: {e}")
-    finally:
-        db.close()
-
 @router.post("/generate-video", response_model=schemas.VideoGenerationResponse)
 async def generate_video(
     request: schemas.VideoGenerationRequest,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    task = crud.create_task(db=db, prompt=request.prompt, owner_id=request.user_id)
+    await submission_admission.admit(request.user_id)
+    task = await crud.create_task_async(db=db, prompt=request.prompt, owner_id=request.user_id)
     
-    background_tasks.add_task(process_video_generation, task.id, task.prompt)
+    await job_queue.enqueue(TASK_GENERATION, {"task_id": task.id, "prompt": task.prompt, "service_type": "video", "quality": request.quality})
     
     return {"task_id": task.id, "message": "Video generation task has been submitted."}
 
+@router.get("/admission")
+async def get_admission_stats():
+    """Admission, rate limiter, job queue and upstream circuit breaker metrics for generation requests."""
+    return await admission_stats()
+
+@router.get("/tasks", response_model=schemas.TaskPage)
+async def list_tasks(
+    user_id: str,
+    status: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = 50,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Lists a user's tasks, newest first. Pass the returned next_cursor as
+    `after` to fetch the next page. `status` filters by one TaskStatus value,
+    or by "active" for pending and processing tasks.
+    """
+    if status is None:
+        statuses = None
+    elif status == "active":
+        statuses = crud.ACTIVE_STATUSES
+    else:
+        try:
+            statuses = [TaskStatus(status)]
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Unknown task status: {status}")
+
+    limit = max(1, min(limit, settings.TASK_LIST_MAX_LIMIT))
+    try:
+        items, next_cursor = await crud.list_tasks_for_user_async(db, owner_id=user_id, statuses=statuses, after=after, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": items, "next_cursor": next_cursor}
+
 @router.get("/tasks/{task_id}", response_model=schemas.Task)
-async def get_task_status(task_id: str, user_id: str, db: Session = Depends(get_db)): 
-    db_task = crud.get_task_for_user(db, task_id=task_id, owner_id=user_id) 
+async def get_task_status(task_id: str, user_id: str, db: AsyncSession = Depends(get_async_db)): 
+    db_task = await crud.get_task_for_user_async(db, task_id=task_id, owner_id=user_id) 
     if db_task is None:
         raise HTTPException(status_code=404, detail="Task not found or you do not have permission to view it")
     return db_task
 
 
+@router.get("/tasks/{task_id}/wait", response_model=schemas.Task)
+async def wait_for_task_status(
+    task_id: str,
+    user_id: str,
+    timeout: float = 30.0,
+    known_status: Optional[TaskStatus] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Long-polls a task. Returns as soon as the task's status differs from
+    known_status (or, without known_status, once the task reaches a final
+    state), otherwise after at most `timeout` seconds with its current state.
+    """
+    with task_events.subscribe(task_id=task_id) as subscription:
+        db_task = await crud.get_task_for_user_async(db, task_id=task_id, owner_id=user_id)
+        if db_task is None:
+            raise HTTPException(status_code=404, detail="Task not found or you do not have permission to view it")
+        current = task_event(db_task)
+        # Give the pooled connection back before waiting; waiters would
+        # otherwise hold one each for up to TASK_LONG_POLL_MAX_TIMEOUT
+        await db.close()
+
+        deadline = asyncio.get_running_loop().time() + min(max(timeout, 0.0), settings.TASK_LONG_POLL_MAX_TIMEOUT)
+        while not _status_changed(current, known_status):
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            event = await subscription.get(timeout=remaining)
+            if event is None:
+                break
+            current = event
+    return current
+
+def _status_changed(event: dict, known_status: Optional[TaskStatus]) -> bool:
+    if known_status is not None:
+        return event["status"] != known_status.value
+    return event["status"] in (TaskStatus.COMPLETED.value, TaskStatus.FAILED.value)
+
+@router.get("/task-events/stream")
+async def stream_task_events(request: Request, user_id: str):
+    """
+    Server-Sent Events stream of every status change of the user's tasks.
+    """
+    subscription = task_events.subscribe(user_id=user_id)
+
+    async def events():
+        try:
+            yield ": connected\n\n"
+            while not await request.is_disconnected():
+                event = await subscription.get(timeout=settings.TASK_EVENTS_HEARTBEAT_INTERVAL)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(jsonable_encoder(event), event="task")
+        finally:
+            subscription.close()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@router.websocket("/task-events/ws")
+async def task_events_websocket(websocket: WebSocket, user_id: str):
+    """
+    WebSocket channel pushing every status change of the user's tasks.
+    """
+    await websocket.accept()
+    subscription = task_events.subscribe(user_id=user_id)
+    try:
+        while True:
+            event = await subscription.get(timeout=settings.TASK_EVENTS_HEARTBEAT_INTERVAL)
+            if event is None:
+                await websocket.send_json({"type": "heartbeat"})
+                continue
+            await websocket.send_json({"type": "task", "task": jsonable_encoder(event)})
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        subscription.close()
+
+
 @router.post("/generate-image", response_model=schemas.VideoGenerationResponse) 
 async def generate_image(
     request: schemas.ImageGenerationRequest, 
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Starts an asynchronous image generation task and returns a task ID for tracking.
     """
-    task = crud.create_task(db=db, prompt=request.prompt, owner_id=request.user_id)
+    await submission_admission.admit(request.user_id)
+    task = await crud.create_task_async(db=db, prompt=request.prompt, owner_id=request.user_id)
     
-    background_tasks.add_task(process_image_generation, task.id, task.prompt)
+    await job_queue.enqueue(TASK_GENERATION, {"task_id": task.id, "prompt": task.prompt, "service_type": "image", "quality": request.quality})
     
     return {"task_id": task.id, "message": "Image generation task has been submitted."}
 
-@router.post("/analyze-script", response_model=schemas.ScriptAnalysisResponse)
-async def analyze_script(
-    script_text: Optional[str] = Form(None),
-    file: Any = File(None) 
+async def _create_batch_tasks(db: AsyncSession, request: schemas.BatchGenerationRequest):
+    if not request.items:
+        raise HTTPException(status_code=400, detail="The batch must contain at least one item.")
+    if len(request.items) > settings.KIE_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {settings.KIE_BATCH_MAX_ITEMS} items.")
+
+    provided_ids = [item.internal_task_id for item in request.items if item.internal_task_id]
+    if len(provided_ids) != len(set(provided_ids)):
+        raise HTTPException(status_code=422, detail="Each internal_task_id in a batch must be unique.")
+    existing_ids = await crud.get_existing_task_ids_async(db, provided_ids)
+    if existing_ids:
+        raise HTTPException(status_code=409, detail=f"Tasks already exist with internal_task_id: {', '.join(sorted(existing_ids))}")
+
+    await submission_admission.admit(request.user_id, cost=len(request.items), priority=PRIORITY_BULK)
+    items = [(item.internal_task_id, item.prompt) for item in request.items]
+    try:
+        task_ids = await crud.create_tasks_async(db, items=items, owner_id=request.user_id)
+    except IntegrityError:
+        # Another request took one of the IDs since the check above; nothing
+        # was queued, so the admission is given back
+        await db.rollback()
+        submission_admission.refund(request.user_id, cost=len(request.items), priority=PRIORITY_BULK)
+        raise HTTPException(status_code=409, detail="A task with one of these internal_task_ids already exists.")
+    return list(zip(task_ids, (prompt for _, prompt in items)))
+
+async def _enqueue_generations(tasks: list, service_type: str, quality: Optional[str] = None):
+    await job_queue.enqueue_many(TASK_GENERATION, [
+        {"task_id": task_id, "prompt": prompt, "service_type": service_type, "quality": quality} for task_id, prompt in tasks
+    ], priority=PRIORITY_BULK)
+
+@router.post("/generate-video/batch", response_model=schemas.BatchGenerationResponse)
+async def generate_video_batch(
+    request: schemas.BatchGenerationRequest,
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
-    Analyzes a screenplay from either an uploaded file or raw text.
+    Creates one task per prompt in a single transaction and queues one
+    submission job per task; the worker pool bounds how many run at once.
+    """
+    tasks = await _create_batch_tasks(db, request)
+    
+    await _enqueue_generations(tasks, "video", request.quality)
+    
+    return {"task_ids": [task_id for task_id, _ in tasks], "message": f"{len(tasks)} video generation tasks have been submitted."}
+
+@router.post("/generate-image/batch", response_model=schemas.BatchGenerationResponse)
+async def generate_image_batch(
+    request: schemas.BatchGenerationRequest,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Creates one task per prompt in a single transaction and queues one
+    submission job per task; the worker pool bounds how many run at once.
+    """
+    tasks = await _create_batch_tasks(db, request)
+    
+    await _enqueue_generations(tasks, "image", request.quality)
+    
+    return {"task_ids": [task_id for task_id, _ in tasks], "message": f"{len(tasks)} image generation tasks have been submitted."}
+
+async def _read_script_input(script_text: Optional[str], file: Any) -> str:
+    """
+    Returns the screenplay text from either an uploaded file (PDF, Final
+    Draft, Fountain or UTF-8 text) or raw text.
     - If a file is provided, it will be prioritized and analyzed.
     - If no file is provided, the script_text will be analyzed.
     - If neither is provided, an error is returned.
     """
-    
     final_script_text = ""
 
-    if isinstance(file, UploadFile):
+    # `file` is typed Any, so FastAPI passes Starlette's UploadFile, of which
+    # fastapi.UploadFile is only a subclass
+    if isinstance(file, StarletteUploadFile):
         print("Processing script from uploaded file.")
-        contents = await file.read()
-        if not contents:
-            raise HTTPException(status_code=400, detail="The uploaded file is empty.")
-        
         try:
-            final_script_text = contents.decode("utf-8")
-        except UnicodeDecodeError:
-            raise HTTPException(status_code=400, detail="Could not decode the file. Please ensure it is a valid text file.")
+            document = (await ingest_scripts([file]))[0]
+        except ScriptTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        if not document.size:
+            raise HTTPException(status_code=400, detail="The uploaded file is empty.")
+        if document.error:
+            raise HTTPException(status_code=400, detail=f"{document.error}. Please upload a PDF, Final Draft (.fdx), Fountain or UTF-8 text file.")
+        final_script_text = document.text
 
     elif script_text:
         print("Processing script from raw text input.")
@@ -96,108 +266,132 @@ async def analyze_script(
     if not final_script_text.strip():
         raise HTTPException(status_code=400, detail="The provided script content is empty or contains only whitespace.")
 
+    return final_script_text
+
+@router.post("/analyze-script", response_model=schemas.ScriptAnalysisResponse)
+async def analyze_script(
+    script_text: Optional[str] = Form(None),
+    file: Any = File(None),
+    project_id: Optional[str] = Form(None)
+):
+    """
+    Analyzes a screenplay from either an uploaded file or raw text.
+    - If a file is provided, it will be prioritized and analyzed.
+    - If no file is provided, the script_text will be analyzed.
+    - If neither is provided, an error is returned.
+    - If a project_id is provided, only scenes changed since the project's last draft are re-analyzed.
+    """
+    final_script_text = await _read_script_input(script_text, file)
+
     print("Sending script to AI for analysis...")
-    analysis = ai_services.analyze_script(final_script_text)
+    analysis = await ai_services.analyze_script(final_script_text, project_id=project_id)
     
     return {"analysis": analysis}
 
+@router.post("/analyze-script/stream")
+async def analyze_script_stream(
+    script_text: Optional[str] = Form(None),
+    file: Any = File(None),
+    project_id: Optional[str] = Form(None)
+):
+    """
+    Same input rules as /analyze-script, but the analysis is streamed back as
+    Server-Sent Events while Gemini generates it.
+    """
+    final_script_text = await _read_script_input(script_text, file)
+
+    print("Streaming script analysis from AI...")
+    return StreamingResponse(
+        stream_analysis_events(ai_services.stream_analyze_script(final_script_text, project_id=project_id)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+async def _iter_upload_file(file: UploadFile):
+    while True:
+        chunk = await file.read(settings.DRIVE_UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
 @router.post("/upload-to-drive")
-async def upload_to_drive(file: UploadFile = File(...)):
+async def upload_to_drive(file: UploadFile = File(...), upload_id: Optional[str] = None):
     """
-    Upload a file to Google Drive.
+    Upload a file to Google Drive. The file is streamed into a resumable
+    upload session in fixed-size chunks instead of being read into memory.
+    Pass an upload_id to follow progress under /upload-to-drive/progress.
     """
-    temp_file_path = f"temp_{file.filename}"
-    with open(temp_file_path, "wb") as buffer:
-        buffer.write(await file.read())
-    
-    file_id = google_drive.upload_file_to_drive(temp_file_path, file.filename)
-    os.remove(temp_file_path)
+    try:
+        file_id = await google_drive.upload_stream_to_drive(
+            _iter_upload_file(file),
+            file.filename,
+            mime_type=file.content_type or "application/octet-stream",
+            total_size=file.size,
+            upload_id=upload_id,
+        )
+    except google_drive.DriveUploadError as e:
+        raise HTTPException(status_code=502, detail=str(e))
     
     return {"file_id": file_id, "file_name": file.filename}
 
-
-@router.post("/kie-callback")
-async def kie_callback(
-    request: Request,
-    db: Session = Depends(get_db)
-):
+@router.put("/upload-to-drive/stream")
+async def upload_to_drive_stream(request: Request, file_name: str, upload_id: Optional[str] = None, folder_id: Optional[str] = None):
     """
-    This endpoint receives the final result from the Kie.ai webhook
-    and updates the correct task in the database using the external_id.
+    Upload the raw request body to Google Drive. The body is piped straight
+    into a resumable upload session as it arrives, so nothing is spooled to
+    disk and memory use stays bounded by the upload chunk size.
     """
-    callback_body = await request.json()
-    print(f"\n--- RAW CALLBACK BODY RECEIVED FROM KIE.AI ---\n{callback_body}\n---------------------------------------------\n")
-
+    content_length = request.headers.get("content-length")
     try:
-        if callback_body.get("code") != 200:
-            return {"status": "callback received with error"}
-
-        data_dict = callback_body.get("data")
-        if not data_dict:
-            raise ValueError("Callback data does not contain a 'data' field.")
-
-        external_task_id = data_dict.get("taskId")
-        if not external_task_id:
-            raise ValueError("Callback 'data' object does not contain a 'taskId'.")
-            
-        db_task = crud.get_task_by_external_id(db, external_id=external_task_id)
-        if not db_task:
-            raise ValueError(f"No task found in our database with external_id: {external_task_id}")
-
-        info_dict = data_dict.get("info")
-        if not info_dict:
-            raise ValueError("Callback 'data' object does not contain an 'info' field.")
-            
-        result_urls = info_dict.get("resultUrls") or info_dict.get("result_urls")
-        if not result_urls or not isinstance(result_urls, list) or len(result_urls) == 0:
-            raise ValueError("Callback 'info' object does not contain a valid list of result URLs.")
-            
-        final_video_url = result_urls[0]
-        
-        print(f"CALLBACK SUCCESS: Found internal task '{db_task.id}'. Updating with Video URL '{final_video_url}'")
-        
-        crud.update_task(
-            db,
-            task_id=db_task.id, 
-            status=TaskStatus.COMPLETED,
-            result_url=final_video_url
+        file_id = await google_drive.upload_stream_to_drive(
+            request.stream(),
+            file_name,
+            mime_type=request.headers.get("content-type", "application/octet-stream"),
+            total_size=int(content_length) if content_length else None,
+            folder_id=folder_id,
+            upload_id=upload_id,
         )
-        
-        return {"status": "callback received and processed successfully"}
-
-    except (ValueError, KeyError) as e:
-        print(f"CALLBACK PARSING ERROR: {e}")
-        return {"status": "callback received but data was in an unexpected format"}
+    except google_drive.DriveUploadError as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
+    return {"file_id": file_id, "file_name": file_name}
 
-def process_video_generation(task_id: str, prompt: str):
-    db = SessionLocal()
-    try:
-        crud.update_task(db, task_id=task_id, status=TaskStatus.PROCESSING)
-        
-        kie_task_id = ai_services.generate_video_from_prompt(prompt)
-        
-        crud.link_task_ids(db, internal_task_id=task_id, external_task_id=kie_task_id)
+@router.get("/upload-to-drive/progress")
+async def list_upload_progress():
+    return google_drive.upload_progress.all()
 
-        print(f"Task {task_id}: Job successfully submitted to Kie.ai and linked with their Task ID: {kie_task_id}.")
+@router.get("/upload-to-drive/progress/{upload_id}")
+async def get_upload_progress(upload_id: str):
+    progress = google_drive.upload_progress.get(upload_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return progress
 
-    except Exception as e:
-        crud.update_task(db, task_id=task_id, status=TaskStatus.FAILED, result_url=str(e))
-        print(f"Task {task_id}: Failed during submission. Error: {e}")
-    finally:
-        db.close()
+@router.api_route("/media/{media_hash}", methods=["GET", "HEAD"])
+async def get_media(media_hash: str, request: Request):
+    """Serves a cached generation result; supports Range requests and ETag revalidation."""
+    return await media_response(request, media_hash)
 
 
-def process_image_generation(task_id: str, prompt: str):
-    db = SessionLocal()
+@router.post("/kie-callback")
+async def kie_callback(request: Request):
+    """
+    This endpoint receives the final result from the Kie.ai webhook. The
+    callback is validated, recorded in the inbox (Kie.ai's retries of a
+    callback we already have are dropped) and acknowledged straight away;
+    the callback processor updates the task by its external_id in batches.
+    """
     try:
-        crud.update_task(db, task_id=task_id, status=TaskStatus.PROCESSING)
-        kie_task_id = ai_services.generate_image_from_prompt_async(prompt)
-        crud.link_task_ids(db, internal_task_id=task_id, external_task_id=kie_task_id)
-        print(f"Task {task_id}: Image job successfully submitted to Kie.ai and linked with their Task ID: {kie_task_id}.")
-
-    except Exception as e:
-        crud.update_task(db, task_id=task_id, status=TaskStatus.FAILED, result_url=str(e))
-        print(f"Task {task_id}: Failed during image submission. Error: {e}")
-    finally:
-        db.close()
\ No newline at end of file
+        accepted = await kie_results.accept_callback(await request.body())
+    except ValueError as e:
+        print(f"CALLBACK PARSING ERROR: {e}")
+        return {"status": "callback received but data was in an unexpected format"}
+    except InboxBusyError as e:
+        # Not stored: a non-2xx answer makes Kie.ai deliver it again
+        print(f"CALLBACK: Inbox busy, asking Kie.ai to retry: {e}")
+        raise HTTPException(status_code=503, detail="Callback inbox is busy; please retry.", headers={"Retry-After": "1"})
+
+    if not accepted:
+        return {"status": "duplicate callback ignored"}
+    callback_processor.notify()
+    return {"status": "callback received"}
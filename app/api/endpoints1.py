@@ -1,9 +1,16 @@
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, Form, UploadFile, File
-from typing import Optional, List
+from fastapi import APIRouter, HTTPException, Request, Form, UploadFile, File
+from fastapi.responses import StreamingResponse
+from typing import Optional, List, Literal
 from app.services import service
 from pydantic import BaseModel
 from app.core.config import settings
-import httpx 
+from app.services.job_queue import job_queue
+from app.services.admission import PRIORITY_BULK
+from app.services.jobs import KIE_SUBMIT, submission_admission, admission_stats
+from app.services.sse import SSE_HEADERS, stream_analysis_events
+from app.services.media_cache import media_response
+from app.services.callback_inbox import InboxBusyError, callback_processor
+from app.services.script_formats import ScriptTooLargeError
 
 router = APIRouter()
 
@@ -11,6 +18,13 @@ router = APIRouter()
 class GenerationRequest(BaseModel):
     internal_task_id: str
     prompt: str
+    user_id: Optional[str] = None
+    # Model quality tier; the model router picks the fastest healthy model of it
+    quality: Optional[Literal["standard", "high"]] = None
+
+class BatchGenerationRequest(BaseModel):
+    items: List[GenerationRequest]
+    user_id: Optional[str] = None
 
 class ScriptRequest(BaseModel):
     prompt: str = Form(...),
@@ -18,55 +32,125 @@ class ScriptRequest(BaseModel):
 
 # --- ENDPOINTS ---
 @router.post("/generate-video")
-async def generate_video(request: GenerationRequest, background_tasks: BackgroundTasks):
-    background_tasks.add_task(service.submit_kie_job, request.prompt, request.internal_task_id, "video")
+async def generate_video(request: GenerationRequest, http_request: Request):
+    await submission_admission.admit(_rate_limit_key(request.user_id, http_request))
+    await job_queue.enqueue(KIE_SUBMIT, _submit_job(request, "video"))
     return {"status": "video generation job accepted"}
 
 @router.post("/generate-image")
-async def generate_image(request: GenerationRequest, background_tasks: BackgroundTasks):
-    background_tasks.add_task(service.submit_kie_job, request.prompt, request.internal_task_id, "image")
+async def generate_image(request: GenerationRequest, http_request: Request):
+    await submission_admission.admit(_rate_limit_key(request.user_id, http_request))
+    await job_queue.enqueue(KIE_SUBMIT, _submit_job(request, "image"))
     return {"status": "image generation job accepted"}
 
+@router.post("/generate-video/batch")
+async def generate_video_batch(request: BatchGenerationRequest, http_request: Request):
+    _validate_batch(request)
+    await submission_admission.admit(_rate_limit_key(request.user_id, http_request), cost=len(request.items), priority=PRIORITY_BULK)
+    await job_queue.enqueue_many(KIE_SUBMIT, [_submit_job(item, "video") for item in request.items], priority=PRIORITY_BULK)
+    return {"status": "video generation batch accepted", "task_ids": [item.internal_task_id for item in request.items]}
+
+@router.post("/generate-image/batch")
+async def generate_image_batch(request: BatchGenerationRequest, http_request: Request):
+    _validate_batch(request)
+    await submission_admission.admit(_rate_limit_key(request.user_id, http_request), cost=len(request.items), priority=PRIORITY_BULK)
+    await job_queue.enqueue_many(KIE_SUBMIT, [_submit_job(item, "image") for item in request.items], priority=PRIORITY_BULK)
+    return {"status": "image generation batch accepted", "task_ids": [item.internal_task_id for item in request.items]}
+
+@router.get("/admission")
+async def get_admission_stats():
+    """Admission, rate limiter, job queue and upstream circuit breaker metrics for generation requests."""
+    return await admission_stats()
+
+def _rate_limit_key(user_id: Optional[str], http_request: Request) -> str:
+    # Requests without a user_id are limited per client address
+    if user_id:
+        return user_id
+    return http_request.client.host if http_request.client else "anonymous"
+
+def _submit_job(request: GenerationRequest, service_type: str) -> dict:
+    return {"prompt": request.prompt, "internal_task_id": request.internal_task_id, "service_type": service_type, "quality": request.quality}
+
+def _validate_batch(request: BatchGenerationRequest):
+    if not request.items:
+        raise HTTPException(status_code=400, detail="The batch must contain at least one item.")
+    if len(request.items) > settings.KIE_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {settings.KIE_BATCH_MAX_ITEMS} items.")
+    # Callbacks and results are matched by internal_task_id, so a repeat would mix up two jobs
+    task_ids = [item.internal_task_id for item in request.items]
+    if len(task_ids) != len(set(task_ids)):
+        raise HTTPException(status_code=422, detail="Each internal_task_id in a batch must be unique.")
+
+async def _read_script_files(files: Optional[List[UploadFile]]) -> str:
+    # Read before any response starts, so an oversized upload is a 413 even
+    # on the streaming endpoint
+    try:
+        return await service.read_script_files(files)
+    except ScriptTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
 @router.post("/analyze-script")
 async def analyze_script(
     prompt: Optional[str] = Form(None), 
-    files: Optional[List[UploadFile]] = File(None)
+    files: Optional[List[UploadFile]] = File(None),
+    project_id: Optional[str] = Form(None)
 ):
     """
     Analyzes a screenplay from an optional uploaded file and/or optional text prompt.
+    Pass a project_id to re-analyze only the scenes changed since the project's last draft.
     """
     # We must have at least a prompt or a file
     if not prompt and not files:
         raise HTTPException(status_code=400, detail="You must provide either a script file or a text prompt.")
 
+    script_content = await _read_script_files(files)
+
     # Pass the received data to the service layer for processing
-    return await service.analyze_script(prompt=prompt, files=files)
+    return await service.analyze_script(prompt=prompt, script_content=script_content, project_id=project_id)
+
+@router.post("/analyze-script/stream")
+async def analyze_script_stream(
+    prompt: Optional[str] = Form(None), 
+    files: Optional[List[UploadFile]] = File(None),
+    project_id: Optional[str] = Form(None)
+):
+    """
+    Streams the screenplay analysis back as Server-Sent Events while Gemini generates it.
+    """
+    if not prompt and not files:
+        raise HTTPException(status_code=400, detail="You must provide either a script file or a text prompt.")
+
+    script_content = await _read_script_files(files)
+
+    return StreamingResponse(
+        stream_analysis_events(service.stream_analyze_script(prompt=prompt, script_content=script_content, project_id=project_id)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
 
 @router.post("/kie-callback")
 async def kie_callback(request: Request, internal_task_id: str):
-    callback_body = await request.json()
-    print(f"Callback received for internal task: {internal_task_id}")
-
-    final_status = "failed"
-    result_url = "Error: " + callback_body.get("msg", "Unknown error from callback")
-    
-    if callback_body.get("code") == 200:
-        data = callback_body.get("data", {})
-        info = data.get("info", {})
-        urls = info.get("resultUrls") or info.get("result_urls")
-        if urls:
-            final_status = "completed"
-            result_url = urls[0]
-
-    # --- Handoff to Main Backend ---
-    result_payload = {
-        "task_id": internal_task_id,
-        "status": final_status,
-        "result_url": result_url
-    }
-    
-    async with httpx.AsyncClient() as client:
-        print(f"Sending final result to main backend: {result_payload}")
-        await client.post(settings.MAIN_BACKEND_SAVE_URL, json=result_payload)
-
-    return {"status": "callback processed and result forwarded"}
\ No newline at end of file
+    """
+    Receives Kie.ai's webhook. It is recorded in the callback inbox (retries
+    of a callback we already have are dropped) and acknowledged straight
+    away; the callback processor forwards results to the main backend.
+    """
+    try:
+        accepted = await service.accept_callback(await request.body(), internal_task_id)
+    except ValueError as e:
+        print(f"CALLBACK PARSING ERROR for internal task {internal_task_id}: {e}")
+        return {"status": "callback received but data was in an unexpected format"}
+    except InboxBusyError as e:
+        # Not stored: a non-2xx answer makes Kie.ai deliver it again
+        print(f"CALLBACK: Inbox busy for internal task {internal_task_id}, asking Kie.ai to retry: {e}")
+        raise HTTPException(status_code=503, detail="Callback inbox is busy; please retry.", headers={"Retry-After": "1"})
+
+    if not accepted:
+        return {"status": "duplicate callback ignored"}
+    callback_processor.notify()
+    return {"status": "callback received and result queued for forwarding"}
+
+@router.api_route("/media/{media_hash}", methods=["GET", "HEAD"])
+async def get_media(media_hash: str, request: Request):
+    """Serves a cached generation result; supports Range requests and ETag revalidation."""
+    return await media_response(request, media_hash)
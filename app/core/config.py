@@ -1,4 +1,5 @@
 from pydantic_settings import BaseSettings
+from typing import Dict, List, Optional
 
 class Settings(BaseSettings):
     GOOGLE_API_KEY: str
@@ -9,6 +10,176 @@ class Settings(BaseSettings):
     KIE_API_KEY: str
     PUBLIC_SERVER_URL: str
     MAIN_BACKEND_SAVE_URL: str
+    MAIN_BACKEND_BATCH_SAVE_URL: Optional[str] = None
+
+    # Router served under /api/v1: "endpoints1" forwards results to the main
+    # backend, "endpoints" keeps tasks in this service's own database
+    API_ROUTER: str = "endpoints1"
+
+    # Database connection pool
+    DATABASE_POOL_SIZE: int = 10
+    DATABASE_MAX_OVERFLOW: int = 20
+    DATABASE_POOL_TIMEOUT: float = 30.0
+    DATABASE_POOL_RECYCLE: int = 1800
+    DATABASE_POOL_PRE_PING: bool = True
+    DATABASE_CONNECT_TIMEOUT: float = 10.0
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_CACHE_SIZE_KB: int = 64000
+
+    # Shared Kie.ai HTTP client
+    KIE_API_ROOT: str = "https://api.kie.ai/api/v1"
+    KIE_HTTP_TIMEOUT: float = 30.0
+    KIE_HTTP_CONNECT_TIMEOUT: float = 10.0
+    KIE_HTTP_MAX_CONNECTIONS: int = 200
+    KIE_HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 50
+    KIE_HTTP_KEEPALIVE_EXPIRY: float = 60.0
+
+    # Batch generation
+    KIE_BATCH_MAX_ITEMS: int = 200
+
+    # Deduplication of identical generation requests
+    GENERATION_DEDUP_RESULT_TTL: float = 3600.0
+    GENERATION_DEDUP_MAX_RESULTS: int = 1000
+    GENERATION_DEDUP_INFLIGHT_TIMEOUT: float = 1800.0
+
+    # Script analysis cache
+    ANALYSIS_CACHE_PATH: str = "analysis_cache.sqlite3"
+    ANALYSIS_CACHE_MEMORY_ENTRIES: int = 128
+    ANALYSIS_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+
+    # Long-script (scene map-reduce) analysis
+    SCRIPT_LONG_MODE_THRESHOLD_CHARS: int = 60000
+    SCRIPT_CHUNK_MAX_CHARS: int = 20000
+    SCRIPT_ANALYSIS_PARALLELISM: int = 8
+
+    # Ingestion of uploaded scripts (PDF, Final Draft, Fountain, plain text)
+    SCRIPT_INGEST_WORKERS: int = 2
+    SCRIPT_INGEST_SPOOL_DIR: Optional[str] = None
+    SCRIPT_INGEST_CHUNK_SIZE: int = 1024 * 1024
+    SCRIPT_INGEST_INLINE_MAX_BYTES: int = 256 * 1024
+    SCRIPT_INGEST_MAX_FILES: int = 20
+    SCRIPT_INGEST_MAX_FILE_BYTES: int = 25 * 1024 * 1024
+    SCRIPT_INGEST_MAX_TOTAL_BYTES: int = 100 * 1024 * 1024
+    SCRIPT_INGEST_MAX_FILE_TOKENS: int = 250000
+    SCRIPT_INGEST_MAX_TOTAL_TOKENS: int = 1000000
+
+    # Google Drive resumable uploads
+    DRIVE_UPLOAD_URL: str = "https://www.googleapis.com/upload/drive/v3/files"
+    DRIVE_UPLOAD_CHUNK_SIZE: int = 8 * 1024 * 1024
+    DRIVE_UPLOAD_MAX_RETRIES: int = 5
+    DRIVE_UPLOAD_RETRY_BACKOFF: float = 1.0
+    DRIVE_UPLOAD_TIMEOUT: float = 120.0
+
+    # Google Drive client
+    DRIVE_TOKEN_REFRESH_MARGIN: float = 300.0
+    DRIVE_DISCOVERY_CACHE_PATH: str = "drive_v3_discovery.json"
+
+    # Local content-addressed cache of generated media, served from /media/{hash}
+    MEDIA_CACHE_ENABLED: bool = False
+    MEDIA_CACHE_DIR: str = "media_cache"
+    MEDIA_CACHE_MAX_BYTES: int = 20 * 1024 * 1024 * 1024
+    MEDIA_CACHE_MAX_FILE_BYTES: int = 2 * 1024 * 1024 * 1024
+    MEDIA_INGEST_CHUNK_SIZE: int = 1024 * 1024
+    MEDIA_INGEST_TIMEOUT: float = 300.0
+    MEDIA_PUBLIC_BASE_URL: Optional[str] = None
+
+    # Outbox for results forwarded to the main backend
+    OUTBOX_PATH: str = "outbox.sqlite3"
+    OUTBOX_BATCH_SIZE: int = 50
+    OUTBOX_POLL_INTERVAL: float = 2.0
+    OUTBOX_MAX_ATTEMPTS: int = 12
+    OUTBOX_RETRY_BASE_DELAY: float = 1.0
+    OUTBOX_RETRY_MAX_DELAY: float = 300.0
+    # How long a forwarder owns the rows it claimed; must exceed OUTBOX_HTTP_TIMEOUT
+    OUTBOX_LEASE: float = 60.0
+    OUTBOX_HTTP_TIMEOUT: float = 15.0
+    OUTBOX_MAX_CONNECTIONS: int = 20
+
+    # Inbox for Kie.ai webhooks, deduplicated by (taskId, state) and processed in batches
+    CALLBACK_INBOX_PATH: str = "callback_inbox.sqlite3"
+    CALLBACK_BATCH_SIZE: int = 100
+    CALLBACK_POLL_INTERVAL: float = 1.0
+    CALLBACK_LEASE: float = 60.0
+    CALLBACK_MAX_ATTEMPTS: int = 10
+    CALLBACK_RETRY_BASE_DELAY: float = 1.0
+    CALLBACK_RETRY_MAX_DELAY: float = 120.0
+    CALLBACK_DEDUP_TTL: float = 7 * 24 * 3600.0
+    CALLBACK_PRUNE_INTERVAL: float = 600.0
+    # Longest a webhook waits for another process's write lock on the inbox file
+    CALLBACK_INBOX_BUSY_TIMEOUT: float = 0.5
+
+    # Push-based task status
+    TASK_LONG_POLL_MAX_TIMEOUT: float = 60.0
+    TASK_EVENTS_HEARTBEAT_INTERVAL: float = 15.0
+    TASK_LIST_MAX_LIMIT: int = 200
+
+    # Provider clients, created lazily; listed names are warmed up at startup,
+    # in a worker thread, so the first request does not import their SDK
+    PROVIDER_WARMUP: List[str] = ["gemini"]
+    PROVIDER_WARMUP_BLOCKING: bool = False
+
+    # Persistent job queue and worker pool
+    JOB_WORKER_EMBEDDED: bool = True
+    JOB_WORKER_CONCURRENCY: int = 32
+    JOB_TYPE_CONCURRENCY: Dict[str, int] = {"kie_submit": 16, "task_generation": 16, "media_ingest": 4}
+    JOB_POLL_INTERVAL: float = 1.0
+    JOB_VISIBILITY_TIMEOUT: float = 120.0
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_RETRY_BASE_DELAY: float = 2.0
+    JOB_RETRY_MAX_DELAY: float = 300.0
+    # Retries of the database write that records a submitted job, in place
+    JOB_PERSIST_MAX_ATTEMPTS: int = 4
+    JOB_SHUTDOWN_GRACE: float = 10.0
+
+    # Admission control for Kie.ai submissions
+    ADMISSION_USER_RATE: float = 1.0
+    ADMISSION_USER_BURST: float = 20.0
+    ADMISSION_GLOBAL_RATE: float = 10.0
+    ADMISSION_GLOBAL_BURST: float = 20.0
+    ADMISSION_MAX_QUEUED: int = 10000
+    ADMISSION_MAX_QUEUED_BULK: int = 2000
+    ADMISSION_MAX_TRACKED_USERS: int = 10000
+
+    # Routing of generation jobs across Kie.ai models; empty MODEL_ROUTER_MODELS enables all
+    MODEL_ROUTER_MODELS: List[str] = []
+    # Requests without a quality get the premium models; cheaper routing is opt-in
+    MODEL_ROUTER_DEFAULT_QUALITY: str = "high"
+    MODEL_ROUTER_MAX_FALLBACKS: int = 2
+    MODEL_ROUTER_HEALTH_WINDOW: int = 50
+    MODEL_ROUTER_MIN_SAMPLES: int = 5
+    MODEL_ROUTER_MIN_SUCCESS_RATE: float = 0.8
+    MODEL_ROUTER_LATENCY_ALPHA: float = 0.2
+    MODEL_ROUTER_IN_FLIGHT_HORIZON: float = 3600.0
+    MODEL_ROUTER_REFRESH_INTERVAL: float = 5.0
+    MODEL_ROUTER_LEDGER_TTL: float = 7 * 24 * 3600.0
+    MODEL_ROUTER_LEDGER_PRUNE_INTERVAL: float = 600.0
+    MODEL_ROUTER_MAX_TRACKED_JOBS: int = 100000
+
+    # Retries, hedged requests and circuit breakers for Kie.ai and Gemini calls
+    RESILIENCE_MAX_RETRIES: int = 2
+    RESILIENCE_RETRY_BASE_DELAY: float = 0.5
+    RESILIENCE_RETRY_MAX_DELAY: float = 8.0
+    RESILIENCE_HEDGE_ENABLED: bool = True
+    RESILIENCE_HEDGE_MIN_SAMPLES: int = 20
+    RESILIENCE_HEDGE_MIN_DELAY: float = 0.5
+    RESILIENCE_LATENCY_HISTORY: int = 500
+    RESILIENCE_BREAKER_FAILURES: int = 5
+    RESILIENCE_BREAKER_RESET_TIMEOUT: float = 30.0
+
+    # Reconciliation of tasks whose Kie.ai callback never arrived
+    RECONCILE_ENABLED: bool = True
+    RECONCILE_INTERVAL: float = 60.0
+    RECONCILE_STALE_AFTER: float = 300.0
+    RECONCILE_DEADLINE: float = 7200.0
+    RECONCILE_BATCH_SIZE: int = 100
+    RECONCILE_CONCURRENCY: int = 8
+
+    # Metrics and tracing
+    METRICS_ENABLED: bool = True
+    SPAN_SERVICE_NAME: str = "filmmaker-ai-platform"
+    SPAN_EXPORT_PATH: Optional[str] = None
+    SPAN_EXPORT_URL: Optional[str] = None
+    SPAN_EXPORT_INTERVAL: float = 2.0
 
     class Config:
         env_file = ".env"
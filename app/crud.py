@@ -1,10 +1,134 @@
+import base64
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, insert, delete, bindparam, or_, and_, case, literal, true
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from .models import models, schemas
 from .models.models import TaskStatus
+from .services.task_events import task_events, task_event
+from .services.metrics import timed_db
 
+# Status writes go through Core UPDATE statements on the table and return
+# plain rows (attribute access works like a Task), so a status change is a
+# single round-trip on databases that support UPDATE ... RETURNING.
+tasks_table = models.Task.__table__
+
+def _task_update(where, **values):
+    return update(tasks_table).where(where).values(**values)
+
+def _select_tasks(where):
+    return select(*tasks_table.c).where(where)
+
+def _bulk_update_statements(statuses: list, only_status: TaskStatus = None):
+    """
+    Splits bulk status outcomes into executemany UPDATEs keyed by internal
+    task ID and by Kie.ai external ID, plus the filter that selects the
+    matching rows. With only_status, rows in any other status are left
+    alone by the UPDATEs.
+    """
+    values = dict(
+        status=bindparam("new_status", type_=tasks_table.c.status.type),
+        result_url=bindparam("new_result_url", type_=tasks_table.c.result_url.type),
+    )
+    by_id, by_external = [], []
+    for outcome in statuses:
+        params = {"new_status": outcome["status"], "new_result_url": outcome.get("result_url")}
+        if outcome.get("task_id"):
+            by_id.append({**params, "match_id": outcome["task_id"]})
+        elif outcome.get("external_id"):
+            by_external.append({**params, "match_external_id": outcome["external_id"]})
+
+    guard = tasks_table.c.status == only_status if only_status is not None else true()
+    statements = []
+    if by_id:
+        statements.append((_task_update(and_(tasks_table.c.id == bindparam("match_id"), guard), **values), by_id))
+    if by_external:
+        statements.append((_task_update(and_(tasks_table.c.external_id == bindparam("match_external_id"), guard), **values), by_external))
+    affected = or_(
+        tasks_table.c.id.in_([params["match_id"] for params in by_id]),
+        tasks_table.c.external_id.in_([params["match_external_id"] for params in by_external]),
+    )
+    return statements, affected
+
+def _qualifying_task_ids(affected, only_status: TaskStatus):
+    return select(tasks_table.c.id).where(and_(affected, tasks_table.c.status == only_status)).with_for_update()
+
+def _join_tasks_statement(leader_task_id: str, task_ids: list):
+    """
+    Points task_ids at the leader's Kie.ai job, so an update by external_id
+    (from whichever process gets the callback) completes them as well. A
+    leader that already finished hands over its outcome instead.
+    """
+    leader = tasks_table.alias("leader")
+    def leader_value(column):
+        return select(leader.c[column]).where(leader.c.id == leader_task_id).scalar_subquery()
+    finished = leader_value("status").in_([TaskStatus.COMPLETED, TaskStatus.FAILED])
+    return _task_update(
+        tasks_table.c.id.in_(task_ids),
+        external_id=leader_value("external_id"),
+        service_type=leader_value("service_type"),
+        model=leader_value("model"),
+        status=case((finished, leader_value("status")), else_=literal(TaskStatus.PROCESSING, tasks_table.c.status.type)),
+        result_url=case((finished, leader_value("result_url")), else_=None),
+    )
+
+ACTIVE_STATUSES = [TaskStatus.PENDING, TaskStatus.PROCESSING]
+
+def encode_task_cursor(task) -> str:
+    raw = f"{task.created_at.isoformat()}|{task.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_task_cursor(cursor: str):
+    """Returns (created_at, id) from a listing cursor; raises ValueError if malformed."""
+    try:
+        created_at, task_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), task_id
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+def _list_tasks_query(owner_id: str, statuses: list = None, after: str = None, limit: int = 50):
+    """
+    Newest-first keyset page of a user's tasks, ordered on
+    (owner_id, created_at, id) so it is served by the composite indexes.
+    Fetches one extra row to tell whether another page follows.
+    """
+    query = select(models.Task).where(models.Task.owner_id == owner_id)
+    if statuses:
+        query = query.where(models.Task.status.in_(statuses))
+    if after:
+        created_at, task_id = decode_task_cursor(after)
+        query = query.where(or_(
+            models.Task.created_at < created_at,
+            and_(models.Task.created_at == created_at, models.Task.id < task_id),
+        ))
+    return query.order_by(models.Task.created_at.desc(), models.Task.id.desc()).limit(limit + 1)
+
+def _task_page(rows: list, limit: int):
+    items = rows[:limit]
+    next_cursor = encode_task_cursor(items[-1]) if len(rows) > limit else None
+    return items, next_cursor
+
+@timed_db
+def list_tasks_for_user(db: Session, owner_id: str, statuses: list = None, after: str = None, limit: int = 50):
+    rows = db.execute(_list_tasks_query(owner_id, statuses, after, limit)).scalars().all()
+    return _task_page(rows, limit)
+
+def _write_task(db: Session, where, **values):
+    statement = _task_update(where, **values)
+    if db.get_bind().dialect.update_returning:
+        row = db.execute(statement.returning(*tasks_table.c)).first()
+    else:
+        db.execute(statement)
+        row = db.execute(_select_tasks(where)).first()
+    db.commit()
+    return row
+
+@timed_db
 def get_task(db: Session, task_id: str):
     return db.query(models.Task).filter(models.Task.id == task_id).first()
 
+@timed_db
 def create_task(db: Session, prompt: str, owner_id: str):
     db_task = models.Task(prompt=prompt, owner_id=owner_id)
     db.add(db_task)
@@ -12,28 +136,316 @@ def create_task(db: Session, prompt: str, owner_id: str):
     db.refresh(db_task)
     return db_task
 
+@timed_db
+def create_tasks(db: Session, items: list, owner_id: str):
+    """
+    Creates one task per (task_id, prompt) pair in a single transaction and
+    returns the task IDs in input order. A task_id of None gets a fresh UUID.
+    """
+    task_ids = [task_id or str(uuid.uuid4()) for task_id, _ in items]
+    db.add_all([
+        models.Task(id=task_id, prompt=prompt, owner_id=owner_id)
+        for task_id, (_, prompt) in zip(task_ids, items)
+    ])
+    db.commit()
+    return task_ids
+
+@timed_db
+def get_existing_task_ids(db: Session, task_ids: list) -> set:
+    """The subset of task_ids that already have a task."""
+    if not task_ids:
+        return set()
+    return set(db.execute(select(tasks_table.c.id).where(tasks_table.c.id.in_(task_ids))).scalars())
+
+@timed_db
 def update_task(db: Session, task_id: str, status: TaskStatus, result_url: str = None):
-    db_task = get_task(db, task_id)
+    db_task = _write_task(db, tasks_table.c.id == task_id, status=status, result_url=result_url)
     if db_task:
-        db_task.status = status
-        db_task.result_url = result_url
-        db.commit()
-        db.refresh(db_task)
+        task_events.publish(task_event(db_task))
     return db_task
 
-def link_task_ids(db: Session, internal_task_id: str, external_task_id: str):
-    db_task = get_task(db, internal_task_id)
+@timed_db
+def update_task_by_external_id(db: Session, external_id: str, status: TaskStatus, result_url: str = None):
+    """
+    Applies a Kie.ai outcome straight to the task with this external_id,
+    without looking the task up first.
+    """
+    db_task = _write_task(db, tasks_table.c.external_id == external_id, status=status, result_url=result_url)
     if db_task:
-        db_task.external_id = external_task_id
-        db.commit()
-        db.refresh(db_task)
+        task_events.publish(task_event(db_task))
     return db_task
 
+@timed_db
+def update_tasks(db: Session, statuses: list, only_status: TaskStatus = None):
+    """
+    Applies many status outcomes in one transaction. Each item is a dict
+    with 'status', an optional 'result_url', and either 'task_id' or
+    'external_id'. With only_status, tasks that have since moved to another
+    status are not touched. Returns the updated rows.
+    """
+    statements, affected = _bulk_update_statements(statuses, only_status)
+    if not statements:
+        return []
+    if only_status is not None:
+        # Lock the rows that qualify now; afterwards they are in their new status
+        affected = tasks_table.c.id.in_(db.execute(_qualifying_task_ids(affected, only_status)).scalars().all())
+    for statement, params in statements:
+        db.execute(statement, params)
+    db_tasks = db.execute(_select_tasks(affected)).all()
+    db.commit()
+    for db_task in db_tasks:
+        task_events.publish(task_event(db_task))
+    return db_tasks
+
+@timed_db
+def link_task_ids(db: Session, internal_task_id: str, external_task_id: str, service_type: str = None, model: str = None):
+    values = {"external_id": external_task_id, "submitted_at": datetime.utcnow()}
+    if service_type:
+        values["service_type"] = service_type
+    if model:
+        values["model"] = model
+    return _write_task(db, tasks_table.c.id == internal_task_id, **values)
+
+def _stale_filter(updated_before: datetime):
+    return and_(tasks_table.c.status == TaskStatus.PROCESSING, tasks_table.c.updated_at < updated_before)
+
+def _stale_tasks_query(updated_before: datetime, limit: int):
+    # Served by ix_tasks_status_updated
+    return (
+        select(tasks_table.c.id).where(_stale_filter(updated_before))
+        .order_by(tasks_table.c.updated_at)
+        .limit(limit)
+    )
+
+def _claim_tasks_update(task_ids: list, updated_before: datetime, claimed_at: datetime):
+    # Only rows still stale are claimed: another process that got there
+    # first has already bumped updated_at
+    return _task_update(and_(tasks_table.c.id.in_(task_ids), _stale_filter(updated_before)), updated_at=claimed_at)
+
+@timed_db
+def claim_stale_tasks(db: Session, updated_before: datetime, limit: int = 100):
+    """
+    PROCESSING tasks not updated since updated_before, least recently
+    updated first. Claimed tasks get a fresh updated_at, so they are not
+    stale again, for any process, until the same time has passed.
+    """
+    task_ids = db.execute(_stale_tasks_query(updated_before, limit)).scalars().all()
+    if not task_ids:
+        return []
+    claimed_at = datetime.utcnow()
+    statement = _claim_tasks_update(task_ids, updated_before, claimed_at)
+    if db.get_bind().dialect.update_returning:
+        rows = db.execute(statement.returning(*tasks_table.c)).all()
+    else:
+        db.execute(statement)
+        rows = db.execute(_select_tasks(and_(tasks_table.c.id.in_(task_ids), tasks_table.c.updated_at == claimed_at))).all()
+    db.commit()
+    return rows
+
+@timed_db
 def get_task_by_external_id(db: Session, external_id: str):
     return db.query(models.Task).filter(models.Task.external_id == external_id).first()
 
+@timed_db
 def get_task_for_user(db: Session, task_id: str, owner_id: str):
     return db.query(models.Task).filter(
         models.Task.id == task_id,
         models.Task.owner_id == owner_id
-    ).first()
\ No newline at end of file
+    ).first()
+
+
+# --- Async counterparts (for use with AsyncSession) ---
+@timed_db
+async def get_task_async(db: AsyncSession, task_id: str):
+    return await db.get(models.Task, task_id)
+
+@timed_db
+async def create_task_async(db: AsyncSession, prompt: str, owner_id: str):
+    db_task = models.Task(prompt=prompt, owner_id=owner_id)
+    db.add(db_task)
+    await db.commit()
+    await db.refresh(db_task)
+    return db_task
+
+@timed_db
+async def create_tasks_async(db: AsyncSession, items: list, owner_id: str):
+    task_ids = [task_id or str(uuid.uuid4()) for task_id, _ in items]
+    db.add_all([
+        models.Task(id=task_id, prompt=prompt, owner_id=owner_id)
+        for task_id, (_, prompt) in zip(task_ids, items)
+    ])
+    await db.commit()
+    return task_ids
+
+@timed_db
+async def get_existing_task_ids_async(db: AsyncSession, task_ids: list) -> set:
+    if not task_ids:
+        return set()
+    return set((await db.execute(select(tasks_table.c.id).where(tasks_table.c.id.in_(task_ids)))).scalars())
+
+async def _write_task_async(db: AsyncSession, where, **values):
+    statement = _task_update(where, **values)
+    if db.get_bind().dialect.update_returning:
+        row = (await db.execute(statement.returning(*tasks_table.c))).first()
+    else:
+        await db.execute(statement)
+        row = (await db.execute(_select_tasks(where))).first()
+    await db.commit()
+    return row
+
+@timed_db
+async def update_task_async(db: AsyncSession, task_id: str, status: TaskStatus, result_url: str = None):
+    db_task = await _write_task_async(db, tasks_table.c.id == task_id, status=status, result_url=result_url)
+    if db_task:
+        task_events.publish(task_event(db_task))
+    return db_task
+
+@timed_db
+async def update_task_by_external_id_async(db: AsyncSession, external_id: str, status: TaskStatus, result_url: str = None):
+    db_task = await _write_task_async(db, tasks_table.c.external_id == external_id, status=status, result_url=result_url)
+    if db_task:
+        task_events.publish(task_event(db_task))
+    return db_task
+
+@timed_db
+async def update_tasks_async(db: AsyncSession, statuses: list, only_status: TaskStatus = None):
+    statements, affected = _bulk_update_statements(statuses, only_status)
+    if not statements:
+        return []
+    if only_status is not None:
+        affected = tasks_table.c.id.in_((await db.execute(_qualifying_task_ids(affected, only_status))).scalars().all())
+    for statement, params in statements:
+        await db.execute(statement, params)
+    db_tasks = (await db.execute(_select_tasks(affected))).all()
+    await db.commit()
+    for db_task in db_tasks:
+        task_events.publish(task_event(db_task))
+    return db_tasks
+
+@timed_db
+async def link_task_ids_async(db: AsyncSession, internal_task_id: str, external_task_id: str, service_type: str = None, model: str = None):
+    values = {"external_id": external_task_id, "submitted_at": datetime.utcnow()}
+    if service_type:
+        values["service_type"] = service_type
+    if model:
+        values["model"] = model
+    return await _write_task_async(db, tasks_table.c.id == internal_task_id, **values)
+
+@timed_db
+async def join_tasks_async(db: AsyncSession, leader_task_id: str, task_ids: list):
+    """Links dedup followers to their leader's job; returns the updated rows."""
+    if not task_ids:
+        return []
+    await db.execute(_join_tasks_statement(leader_task_id, task_ids))
+    db_tasks = (await db.execute(_select_tasks(tasks_table.c.id.in_(task_ids)))).all()
+    await db.commit()
+    for db_task in db_tasks:
+        task_events.publish(task_event(db_task))
+    return db_tasks
+
+@timed_db
+async def claim_stale_tasks_async(db: AsyncSession, updated_before: datetime, limit: int = 100):
+    task_ids = (await db.execute(_stale_tasks_query(updated_before, limit))).scalars().all()
+    if not task_ids:
+        return []
+    claimed_at = datetime.utcnow()
+    statement = _claim_tasks_update(task_ids, updated_before, claimed_at)
+    if db.get_bind().dialect.update_returning:
+        rows = (await db.execute(statement.returning(*tasks_table.c))).all()
+    else:
+        await db.execute(statement)
+        rows = (await db.execute(_select_tasks(and_(tasks_table.c.id.in_(task_ids), tasks_table.c.updated_at == claimed_at)))).all()
+    await db.commit()
+    return rows
+
+@timed_db
+async def get_task_by_external_id_async(db: AsyncSession, external_id: str):
+    result = await db.execute(select(models.Task).where(models.Task.external_id == external_id).limit(1))
+    return result.scalars().first()
+
+@timed_db
+async def get_task_for_user_async(db: AsyncSession, task_id: str, owner_id: str):
+    result = await db.execute(select(models.Task).where(
+        models.Task.id == task_id,
+        models.Task.owner_id == owner_id
+    ).limit(1))
+    return result.scalars().first()
+
+@timed_db
+async def list_tasks_for_user_async(db: AsyncSession, owner_id: str, statuses: list = None, after: str = None, limit: int = 50):
+    rows = (await db.execute(_list_tasks_query(owner_id, statuses, after, limit))).scalars().all()
+    return _task_page(rows, limit)
+
+
+# --- Dedup flights of forwarded jobs (endpoints1 router, no task rows) ---
+flights_table = models.GenerationFlight.__table__
+followers_table = models.GenerationFollower.__table__
+
+@timed_db
+async def start_flight_async(db: AsyncSession, leader_task_id: str):
+    """
+    Records a deduplicated job that identical requests may join. Safe to
+    call again when the leader's submission is retried.
+    """
+    exists = await db.scalar(select(flights_table.c.leader_task_id).where(flights_table.c.leader_task_id == leader_task_id))
+    if exists is None:
+        await db.execute(insert(flights_table).values(leader_task_id=leader_task_id, created_at=datetime.utcnow()))
+    await db.commit()
+
+@timed_db
+async def join_flight_async(db: AsyncSession, leader_task_id: str, task_id: str) -> bool:
+    """
+    Records task_id as waiting on the leader's job. Returns False when the
+    job already finished, or is not known, so there is nothing to wait for.
+    """
+    # Updating the flight row locks it: a concurrent finish_flights_async
+    # either waits and then sees this follower, or finishes first and the
+    # update matches nothing
+    result = await db.execute(
+        update(flights_table)
+        .where(flights_table.c.leader_task_id == leader_task_id, flights_table.c.finished_at.is_(None))
+        .values(followers=flights_table.c.followers + 1)
+    )
+    if not result.rowcount:
+        await db.rollback()
+        return False
+    joined = await db.scalar(select(followers_table.c.task_id).where(
+        followers_table.c.leader_task_id == leader_task_id, followers_table.c.task_id == task_id
+    ))
+    if joined is None:
+        await db.execute(insert(followers_table).values(leader_task_id=leader_task_id, task_id=task_id, joined_at=datetime.utcnow()))
+    await db.commit()
+    return True
+
+@timed_db
+async def finish_flights_async(db: AsyncSession, leader_task_ids: list) -> dict:
+    """
+    Marks the leaders' jobs finished, so no request joins them anymore, and
+    returns the task IDs that joined each one. Safe to call again when a
+    batch is retried.
+    """
+    if not leader_task_ids:
+        return {}
+    await db.execute(
+        update(flights_table)
+        .where(flights_table.c.leader_task_id.in_(leader_task_ids), flights_table.c.finished_at.is_(None))
+        .values(finished_at=datetime.utcnow())
+    )
+    rows = (await db.execute(
+        select(followers_table.c.leader_task_id, followers_table.c.task_id)
+        .where(followers_table.c.leader_task_id.in_(leader_task_ids))
+        .order_by(followers_table.c.joined_at)
+    )).all()
+    await db.commit()
+    followers = {leader_task_id: [] for leader_task_id in leader_task_ids}
+    for leader_task_id, task_id in rows:
+        followers[leader_task_id].append(task_id)
+    return followers
+
+@timed_db
+async def prune_flights_async(db: AsyncSession, older_than: float):
+    """Forgets flights started, and followers joined, more than older_than seconds ago."""
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+    await db.execute(delete(followers_table).where(followers_table.c.joined_at < cutoff))
+    await db.execute(delete(flights_table).where(flights_table.c.created_at < cutoff))
+    await db.commit()
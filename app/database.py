@@ -1,14 +1,117 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url, URL
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from app.core.config import settings
 
-# The 'connect_args' is only needed for SQLite.
-engine = create_engine(
-    settings.DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# Async driver used for each backend when DATABASE_URL names none.
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+}
+SYNC_DRIVERS = {
+    "aiosqlite": None,
+    "asyncpg": "psycopg2",
+    "aiomysql": "pymysql",
+}
+
+
+def _parse_url(database_url: str) -> URL:
+    # Heroku-style "postgres://" URLs are not accepted by SQLAlchemy.
+    if database_url.startswith("postgres://"):
+        database_url = "postgresql://" + database_url[len("postgres://"):]
+    return make_url(database_url)
+
+
+def sync_database_url(database_url: str) -> URL:
+    url = _parse_url(database_url)
+    driver = url.get_driver_name()
+    if driver in SYNC_DRIVERS:
+        sync_driver = SYNC_DRIVERS[driver]
+        backend = url.get_backend_name()
+        url = url.set(drivername=f"{backend}+{sync_driver}" if sync_driver else backend)
+    return url
+
+
+def async_database_url(database_url: str) -> URL:
+    url = _parse_url(database_url)
+    backend = url.get_backend_name()
+    if url.get_driver_name() not in SYNC_DRIVERS and backend in ASYNC_DRIVERS:
+        url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    return url
+
+
+def _is_memory_sqlite(url: URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def engine_options(url: URL, is_async: bool = False) -> dict:
+    """
+    Picks connect args and pool settings for the dialect in use.
+    """
+    backend = url.get_backend_name()
+    options = {"pool_pre_ping": settings.DATABASE_POOL_PRE_PING}
+
+    if backend == "sqlite":
+        options["connect_args"] = {"check_same_thread": False, "timeout": settings.SQLITE_BUSY_TIMEOUT_MS / 1000}
+        if _is_memory_sqlite(url):
+            # Every connection to :memory: is a separate database; share one.
+            options["poolclass"] = StaticPool
+            return options
+    elif backend == "postgresql":
+        if is_async:
+            options["connect_args"] = {"timeout": settings.DATABASE_CONNECT_TIMEOUT}
+        else:
+            options["connect_args"] = {"connect_timeout": int(settings.DATABASE_CONNECT_TIMEOUT)}
+    elif backend == "mysql":
+        options["connect_args"] = {"connect_timeout": int(settings.DATABASE_CONNECT_TIMEOUT)}
+
+    options.update(
+        pool_size=settings.DATABASE_POOL_SIZE,
+        max_overflow=settings.DATABASE_MAX_OVERFLOW,
+        pool_timeout=settings.DATABASE_POOL_TIMEOUT,
+        pool_recycle=settings.DATABASE_POOL_RECYCLE,
+    )
+    return options
+
+
+def _enable_sqlite_pragmas(sync_engine):
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers run alongside the single writer.
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute(f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_SIZE_KB)}")
+        cursor.close()
+
+
+_sync_url = sync_database_url(settings.DATABASE_URL)
+engine = create_engine(_sync_url, **engine_options(_sync_url))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+_async_url = async_database_url(settings.DATABASE_URL)
+async_engine = create_async_engine(_async_url, **engine_options(_async_url, is_async=True))
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+if _sync_url.get_backend_name() == "sqlite":
+    _enable_sqlite_pragmas(engine)
+    _enable_sqlite_pragmas(async_engine.sync_engine)
+
+def _dispose_pools_after_fork():
+    # Pooled connections belong to the parent process; the child opens its own.
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_dispose_pools_after_fork)
+
 Base = declarative_base()
 
 def get_db():
@@ -16,4 +119,8 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,14 +1,67 @@
-from fastapi import FastAPI
-from app.api import endpoints1
-from app.database import engine
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from app.api import endpoints, endpoints1
+from app.core.config import settings
+from app.database import engine, async_engine
+from app.services.providers import providers
+from app.services.outbox import result_forwarder
+from app.services.callback_inbox import callback_processor
+from app.services.job_queue import job_queue, JobWorker
+from app.services.admission import AdmissionRejected
+from app.services.reconciler import task_reconciler
+from app.services.resilience import CircuitOpenError
+from app.services.script_ingest import script_parser
+from app.services.metrics import registry, http_request_duration, collect_queue_metrics
+from app.services.tracing import tracer
 from app.models import models
+from app.migrations import run_migrations
 from fastapi.middleware.cors import CORSMiddleware
 
-models.Base.metadata.create_all(bind=engine)
+
+# Runs queued jobs inside the API process unless JOB_WORKER_EMBEDDED is off
+# and standalone workers (python -m app.worker) take care of them.
+job_worker = JobWorker(job_queue)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema setup runs at startup rather than import, so importing the app
+    # (e.g. in a pre-fork master) never touches the database.
+    await asyncio.to_thread(models.Base.metadata.create_all, bind=engine)
+    await asyncio.to_thread(run_migrations, engine)
+    result_forwarder.start()
+    callback_processor.start()
+    if settings.JOB_WORKER_EMBEDDED:
+        job_worker.start()
+    if settings.RECONCILE_ENABLED:
+        task_reconciler.start()
+    warm_up = None
+    if settings.PROVIDER_WARMUP:
+        if settings.PROVIDER_WARMUP_BLOCKING:
+            await providers.warm_up(settings.PROVIDER_WARMUP)
+        else:
+            warm_up = asyncio.create_task(providers.warm_up(settings.PROVIDER_WARMUP))
+    yield
+    if warm_up is not None and not warm_up.done():
+        warm_up.cancel()
+    await task_reconciler.stop()
+    await callback_processor.stop()
+    await job_worker.stop()
+    await result_forwarder.stop()
+    script_parser.shutdown()
+    await providers.aclose()
+    await async_engine.dispose()
+    tracer.flush()
+
+
 app = FastAPI(
     title="Filmmaker AI Platform API",
     description="APIs for video generation, image creation, and script analysis for filmmakers.",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 origins = [
@@ -28,7 +81,49 @@ app.add_middleware(
     allow_headers=["*"],  
 )
 
-app.include_router(endpoints1.router, prefix="/api/v1")
+# Only one router is served at a time; see API_ROUTER
+api_router = endpoints.router if settings.API_ROUTER == "endpoints" else endpoints1.router
+app.include_router(api_router, prefix="/api/v1")
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Labelled by the matched route template (e.g. /tasks/{task_id}) rather
+    # than the raw path, so the number of series stays bounded.
+    started = time.perf_counter()
+    status = 500
+    with tracer.span(f"HTTP {request.method}", path=request.url.path) as span:
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            route = request.scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            span.set(route=route_path, status=status)
+            http_request_duration.observe(time.perf_counter() - started, method=request.method, route=route_path, status=status)
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "reason": exc.reason},
+        headers={"Retry-After": exc.retry_after_header},
+    )
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "upstream": exc.upstream},
+        headers={"Retry-After": exc.retry_after_header},
+    )
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    if not settings.METRICS_ENABLED:
+        return PlainTextResponse("Metrics are disabled\n", status_code=404)
+    await collect_queue_metrics()
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/")
 def read_root():
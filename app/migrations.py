@@ -0,0 +1,58 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import Table
+from app.models import models
+
+# Indexes created by earlier versions of the models that are no longer
+# wanted: indexing the long prompt text only cost write time, the
+# single-column owner_id index is a prefix of the composite listing indexes,
+# and job claims now order by priority.
+OBSOLETE_INDEXES = {
+    "tasks": ["ix_tasks_prompt", "ix_tasks_owner_id"],
+    "jobs": ["ix_jobs_claim"],
+}
+
+MIGRATED_TABLES = [models.Task.__table__, models.Job.__table__, models.KieJob.__table__]
+
+
+def _add_missing_columns(conn: Connection, table: Table, existing: set):
+    # Only columns with a server default (or nullable ones) can be added to a
+    # table that already has rows.
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        print(f"MIGRATION: Adding column {table.name}.{column.name}")
+        ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"
+        if column.server_default is not None:
+            ddl += f" DEFAULT {column.server_default.arg}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+        conn.execute(text(ddl))
+
+
+def _sync_indexes(conn: Connection, table: Table):
+    existing = {index["name"] for index in inspect(conn).get_indexes(table.name)}
+    for name in OBSOLETE_INDEXES.get(table.name, []):
+        if name in existing:
+            print(f"MIGRATION: Dropping obsolete index {name}")
+            statement = f"DROP INDEX {conn.dialect.identifier_preparer.quote(name)}"
+            if conn.dialect.name == "mysql":
+                statement += f" ON {table.name}"
+            conn.execute(text(statement))
+    for index in table.indexes:
+        if index.name not in existing:
+            print(f"MIGRATION: Creating index {index.name}")
+            index.create(bind=conn)
+
+
+def run_migrations(engine: Engine):
+    """
+    Brings an existing database's columns and indexes in line with the
+    models. create_all only creates missing tables, so columns and indexes
+    added to an existing table are created here. Safe to run on every startup.
+    """
+    with engine.begin() as conn:
+        for table in MIGRATED_TABLES:
+            columns = {column["name"] for column in inspect(conn).get_columns(table.name)}
+            _add_missing_columns(conn, table, columns)
+            _sync_indexes(conn, table)
@@ -1,5 +1,5 @@
 import enum
-from sqlalchemy import Column, String, DateTime, Enum, INTEGER
+from sqlalchemy import Boolean, Column, String, DateTime, Enum, Index, INTEGER, JSON
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
 from datetime import datetime
@@ -15,10 +15,126 @@ class Task(Base):
     __tablename__ = "tasks"
 
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    prompt = Column(String, index=True)
+    prompt = Column(String)
     external_id = Column(String, nullable=True, index=True) 
     status = Column(Enum(TaskStatus), default=TaskStatus.PENDING)
     result_url = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    owner_id = Column(String, index=True)
\ No newline at end of file
+    owner_id = Column(String)
+    # "video" or "image"; tells the reconciler which Kie.ai record endpoint to ask
+    service_type = Column(String, nullable=True)
+    # Kie.ai model the model router sent the job to, e.g. "veo3_fast"; the
+    # reconciler asks that model's record endpoint
+    model = Column(String, nullable=True)
+    # When the job was submitted to Kie.ai, for the submit-to-result time
+    # measured by whichever process gets the result
+    submitted_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Keyset pagination of a user's tasks, newest first
+        Index("ix_tasks_owner_created_id", "owner_id", "created_at", "id"),
+        Index("ix_tasks_owner_status_created_id", "owner_id", "status", "created_at", "id"),
+        # Dashboards mostly poll the tasks that are still running
+        Index(
+            "ix_tasks_owner_active",
+            "owner_id", "created_at", "id",
+            postgresql_where=status.in_([TaskStatus.PENDING, TaskStatus.PROCESSING]),
+            sqlite_where=status.in_([TaskStatus.PENDING, TaskStatus.PROCESSING]),
+        ),
+        # The reconciler scans for tasks that have been processing too long
+        Index("ix_tasks_status_updated", "status", "updated_at"),
+    )
+
+class JobStatus(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DEAD = "dead"
+
+class Job(Base):
+    """
+    A unit of background work in the persistent job queue. Finished jobs are
+    deleted; jobs that ran out of attempts stay behind as DEAD.
+    """
+    __tablename__ = "jobs"
+
+    id = Column(INTEGER, primary_key=True, autoincrement=True)
+    job_type = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    status = Column(Enum(JobStatus), nullable=False, default=JobStatus.QUEUED)
+    # Lower values run first; see app.services.admission
+    priority = Column(INTEGER, nullable=False, default=0, server_default="0")
+    attempts = Column(INTEGER, nullable=False, default=0)
+    max_attempts = Column(INTEGER, nullable=False)
+    run_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = Column(String, nullable=True)
+    locked_until = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        # Workers claim the oldest due job of a type; expired leases are reclaimed
+        Index("ix_jobs_claim_priority", "job_type", "status", "priority", "run_at", "id"),
+        Index("ix_jobs_lease", "job_type", "status", "locked_until"),
+    )
+
+class KieJob(Base):
+    """
+    Ledger of Kie.ai generation jobs, shared by every process and host: the
+    model router learns each model's success rate and turnaround from it.
+    A submission the model refused is recorded finished, without an
+    external_id. Jobs of the endpoints1 router, which has no task rows,
+    carry the internal task ID their result is forwarded for, and the
+    reconciler checks on them here.
+    """
+    __tablename__ = "kie_jobs"
+
+    id = Column(INTEGER, primary_key=True, autoincrement=True)
+    external_id = Column(String, nullable=True)
+    service_type = Column(String, nullable=True)
+    model = Column(String, nullable=False)
+    submitted_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    succeeded = Column(Boolean, nullable=True)
+    forward_task_id = Column(String, nullable=True)
+    # Set at submission and bumped by each reconciler claim, like a task's updated_at
+    checked_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_kie_jobs_external_id", "external_id"),
+        # Running forwarded jobs, least recently checked first
+        Index("ix_kie_jobs_reconcile", "finished_at", "checked_at"),
+        # A model's running jobs and its most recently finished ones
+        Index("ix_kie_jobs_model_finished", "model", "finished_at", "submitted_at"),
+        Index("ix_kie_jobs_submitted_at", "submitted_at"),
+    )
+
+class GenerationFlight(Base):
+    """
+    A deduplicated generation job of the endpoints1 router, which keeps no
+    task rows. Identical requests that join it are stored as
+    GenerationFollowers, so whichever process or host handles the job's
+    callback forwards their results too.
+    """
+    __tablename__ = "generation_flights"
+
+    leader_task_id = Column(String, primary_key=True)
+    followers = Column(INTEGER, nullable=False, default=0, server_default="0")
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_generation_flights_created_at", "created_at"),
+    )
+
+class GenerationFollower(Base):
+    __tablename__ = "generation_followers"
+
+    leader_task_id = Column(String, primary_key=True)
+    task_id = Column(String, primary_key=True)
+    joined_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_generation_followers_joined_at", "joined_at"),
+    )
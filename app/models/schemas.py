@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Optional, List, Literal
 from datetime import datetime
 from .models import TaskStatus 
 
@@ -13,15 +13,21 @@ class Task(TaskBase):
     id: str
     status: TaskStatus
     result_url: Optional[str] = None
+    model: Optional[str] = None
     created_at: datetime
     updated_at: datetime
 
     class Config:
         from_attributes = True 
 
+class TaskPage(BaseModel):
+    items: List[Task]
+    next_cursor: Optional[str] = None
+
 class VideoGenerationRequest(BaseModel):
     prompt: str = Field(..., example="A cinematic shot of a futuristic city at sunset.")
     user_id: str
+    quality: Optional[Literal["standard", "high"]] = None
 class VideoGenerationResponse(BaseModel):
     task_id: str
     message: str
@@ -29,9 +35,22 @@ class VideoGenerationResponse(BaseModel):
 class ImageGenerationRequest(BaseModel):
     prompt: str = Field(..., example="A hyper-realistic portrait of a golden retriever wearing a crown.")
     user_id: str
+    quality: Optional[Literal["standard", "high"]] = None
 class ImageGenerationResponse(BaseModel):
     image_url: str
 
+class BatchGenerationItem(BaseModel):
+    prompt: str
+    internal_task_id: Optional[str] = None
+
+class BatchGenerationRequest(BaseModel):
+    items: List[BatchGenerationItem]
+    user_id: str
+    quality: Optional[Literal["standard", "high"]] = None
+class BatchGenerationResponse(BaseModel):
+    task_ids: List[str]
+    message: str
+
 class ScriptAnalysisRequest(BaseModel):
     script_text: str = Field(..., example="[SCENE START]\nINT. COFFEE SHOP - DAY\n...")
 
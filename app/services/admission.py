@@ -0,0 +1,237 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional
+from app.core.config import settings
+
+# Job priorities; lower values are claimed and dispatched first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+PRIORITY_BACKGROUND = 20
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk", PRIORITY_BACKGROUND: "background"}
+
+# Priority of the job the current task is running, read by the Kie.ai client.
+current_priority: ContextVar[int] = ContextVar("current_priority", default=PRIORITY_INTERACTIVE)
+
+
+def priority_name(priority: int) -> str:
+    return PRIORITY_NAMES.get(priority, str(priority))
+
+
+class WaitStats:
+    """Recent wait times, summarized as count, mean and percentiles."""
+    def __init__(self, history_size: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=history_size)
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def snapshot(self):
+        ordered = sorted(self.recent)
+        def percentile(p):
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 4) if ordered else 0.0
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 4) if self.count else 0.0,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+        }
+
+
+class TokenBucket:
+    """
+    Classic token bucket. A request bigger than the bucket is admitted once
+    the bucket is full and leaves it in debt, so large batches are not
+    rejected forever but still pay for every item.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float) -> float:
+        """Seconds until `amount` tokens can be taken; 0 if they can be now."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> bool:
+        if self.time_until(amount) > 0:
+            return False
+        self.tokens -= amount
+        return True
+
+    def give_back(self, amount: float):
+        """Returns tokens taken for a request that was not carried out."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdmissionRejected(Exception):
+    """A request was refused; the client should retry after retry_after seconds."""
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Request rejected ({reason}); retry after {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class PriorityRateLimiter:
+    """
+    Global token bucket in front of every Kie.ai call in this process. When
+    tokens run out, callers wait and are served lowest priority value first,
+    so interactive submissions overtake queued bulk ones.
+    """
+    def __init__(self, rate: float, burst: float):
+        self.bucket = TokenBucket(rate, burst)
+        self.waits = defaultdict(WaitStats)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        if not self._waiters and self.bucket.take(1):
+            self.waits[priority].record(0.0)
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._schedule(loop)
+        started = loop.time()
+        await future
+        self.waits[priority].record(loop.time() - started)
+
+    def _schedule(self, loop: asyncio.AbstractEventLoop):
+        if self._timer is None:
+            self._timer = loop.call_later(self.bucket.time_until(1), self._release, loop)
+
+    def _release(self, loop: asyncio.AbstractEventLoop):
+        self._timer = None
+        while self._waiters:
+            _, _, future = self._waiters[0]
+            if future.done():
+                # The waiter was cancelled
+                heapq.heappop(self._waiters)
+                continue
+            if not self.bucket.take(1):
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+        if self._waiters:
+            self._schedule(loop)
+
+    def stats(self):
+        waiting = defaultdict(int)
+        for priority, _, future in self._waiters:
+            if not future.done():
+                waiting[priority_name(priority)] += 1
+        return {
+            "rate": self.bucket.rate,
+            "waiting": dict(waiting),
+            "wait_seconds": {priority_name(p): stats.snapshot() for p, stats in self.waits.items()},
+        }
+
+
+class AdmissionController:
+    """
+    Decides whether a generation request may be queued at all. Each user has
+    a token bucket (one token per job), and requests are turned away while
+    the job backlog is over its limit; bulk batches hit a lower limit than
+    interactive single shots. Rejections carry a Retry-After estimate.
+    """
+    def __init__(
+        self,
+        depth_source: Callable[[], Awaitable[int]],
+        user_rate: float,
+        user_burst: float,
+        max_queued: int,
+        max_queued_bulk: int,
+        drain_rate: float,
+        max_users: int = 10000,
+        depth_ttl: float = 0.5,
+    ):
+        self.depth_source = depth_source
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_queued = max_queued
+        self.max_queued_bulk = max_queued_bulk
+        self.drain_rate = drain_rate
+        self.max_users = max_users
+        self.depth_ttl = depth_ttl
+        self.admitted = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self._buckets = OrderedDict()
+        self._depth = 0
+        self._depth_checked_at = float("-inf")
+
+    async def admit(self, user_id: str, cost: int = 1, priority: int = PRIORITY_INTERACTIVE):
+        """Admits `cost` jobs for user_id or raises AdmissionRejected."""
+        limit = self.max_queued if priority <= PRIORITY_INTERACTIVE else self.max_queued_bulk
+        depth = await self._queued_depth()
+        if depth + cost > limit:
+            self.rejected["queue_full"] += 1
+            raise AdmissionRejected("queue_full", (depth + cost - limit) / self.drain_rate)
+
+        bucket = self._bucket(user_id)
+        wait = bucket.time_until(cost)
+        if wait > 0:
+            self.rejected["user_rate"] += 1
+            raise AdmissionRejected("user_rate", wait)
+        bucket.take(cost)
+        self._depth += cost
+        self.admitted[priority_name(priority)] += cost
+
+    def refund(self, user_id: str, cost: int = 1, priority: int = PRIORITY_INTERACTIVE):
+        """Undoes admit() for jobs that were admitted but never queued."""
+        self._bucket(user_id).give_back(cost)
+        self._depth = max(0, self._depth - cost)
+        self.admitted[priority_name(priority)] -= cost
+
+    async def _queued_depth(self) -> int:
+        # The backlog size is read from the database at most every depth_ttl
+        # seconds; admissions in between are added to the cached value.
+        now = time.monotonic()
+        if now - self._depth_checked_at >= self.depth_ttl:
+            self._depth = await self.depth_source()
+            self._depth_checked_at = now
+        return self._depth
+
+    def _bucket(self, user_id: str) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+            self._buckets[user_id] = bucket
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+
+    def stats(self):
+        return {
+            "admitted": dict(self.admitted),
+            "rejected": dict(self.rejected),
+            "queued_jobs": self._depth,
+            "tracked_users": len(self._buckets),
+        }
+
+
+kie_rate_limiter = PriorityRateLimiter(rate=settings.ADMISSION_GLOBAL_RATE, burst=settings.ADMISSION_GLOBAL_BURST)
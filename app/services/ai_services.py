@@ -1,136 +1,93 @@
-import google.generativeai as genai
 from app.core.config import settings
-import time
-import os
-from google.oauth2 import service_account
-import requests  
-import time
+import asyncio
+import httpx
+from typing import Optional
+from app.services.model_router import submit_generation
+from app.services.analysis_cache import analysis_cache, make_analysis_key
+from app.services.script_analysis import is_long_script, analyze_long_script, stream_long_script
+from app.services.gemini import generate_text, stream_text
 
-genai.configure(api_key=settings.GOOGLE_API_KEY)
-import vertexai
-from vertexai.preview.vision_models import ImageGenerationModel
+# Gemini and Vertex AI clients are created on first use by the provider
+# registry (app.services.providers), not at import time.
 
-credentials = service_account.Credentials.from_service_account_file(
-    settings.GOOGLE_DRIVE_CREDENTIALS_FILE
-)
-vertexai.init(
-    project=settings.GOOGLE_CLOUD_PROJECT_ID,
-    location=settings.GOOGLE_CLOUD_LOCATION,
-    credentials=credentials
-)
-
-KIE_API_KEY = settings.KIE_API_KEY
-KIE_API_BASE_URL = "https://api.kie.ai/api/v1/runway/generate" 
-
-def generate_video_from_prompt(prompt: str):
+async def generate_video_from_prompt(prompt: str, quality: Optional[str] = None):
     """
     Generates a video by submitting a job to the Kie.ai API and providing a
-    callback URL for the result.
+    callback URL for the result. The model router picks the Kie.ai model
+    for the quality tier; model_router.model_for(job_id) tells which.
+    """
+    return await _submit("video", prompt, quality)
+
+async def generate_image_from_prompt_async(prompt: str, quality: Optional[str] = None):
+    """
+    Submits an asynchronous image generation job to Kie.ai and returns the
+    Kie.ai task ID. The model is chosen like for videos.
     """
-    print(f"AI SERVICE: Submitting 'veo3' job to Kie.ai for prompt: '{prompt}'")
-    
-    headers = {
-        "Authorization": f"Bearer {KIE_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    submit_url = "https://api.kie.ai/api/v1/veo/generate"
-    
+    return await _submit("image", prompt, quality)
+
+async def _submit(service_type: str, prompt: str, quality: Optional[str]):
+    print(f"AI SERVICE: Submitting {service_type} job to Kie.ai for prompt: '{prompt}'")
+
     callback_url = f"{settings.PUBLIC_SERVER_URL}/api/v1/kie-callback"
     print(f"AI SERVICE: Providing this callback URL to Kie.ai: {callback_url}")
 
-    submit_payload = {
-        "prompt": prompt,
-        "model": "veo3",
-        "aspectRatio": "16:9",
-        "callBackUrl": callback_url 
-    }
-    
     try:
-        print(f"AI SERVICE: SENDING THIS EXACT VEO3 PAYLOAD: {submit_payload}")
-        submit_response = requests.post(submit_url, headers=headers, json=submit_payload)
-        
-        if submit_response.status_code != 200:
-            print(f"AI SERVICE: ERROR - Kie.ai returned status {submit_response.status_code}")
-            print(f"AI SERVICE: Response Body: {submit_response.text}")
-            submit_response.raise_for_status()
-
-        response_data = submit_response.json()
-        print(f"AI SERVICE: RECEIVED RAW RESPONSE FROM KIE.AI: {response_data}")
-        
-        data_dict = response_data.get("data") or {}
-        job_id = data_dict.get("taskId")
-        
-        if not job_id:
-            raise Exception("API reported success but did not return a recognizable job ID.")
-            
-        print(f"AI SERVICE: Job submitted successfully. Task ID: {job_id}")
-        
+        backend, job_id = await submit_generation(service_type, prompt, callback_url, quality)
+        print(f"AI SERVICE: {service_type.capitalize()} job submitted successfully to '{backend.name}'. Task ID: {job_id}")
         return job_id
 
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         print(f"AI SERVICE: HTTP ERROR: {http_err}")
         print(f"AI SERVICE: Response Body: {http_err.response.text}")
         raise http_err
     except Exception as e:
-        print(f"AI SERVICE: CRITICAL FAILURE during video generation with Kie.ai: {e}")
+        print(f"AI SERVICE: CRITICAL FAILURE during {service_type} submission with Kie.ai: {e}")
         raise e
 
-def generate_image_from_prompt_async(prompt: str):
+ANALYSIS_MODEL = 'gemini-2.5-flash'
+ANALYSIS_INSTRUCTION = "Analyze the following screenplay for plot structure, character development, and dialogue quality:"
+
+async def analyze_script(script_text: str, project_id: Optional[str] = None):
     """
-    Submits an asynchronous image generation job to the Kie.ai GPT-4o endpoint
-    and returns the Kie.ai task ID.
+    Analyzes a screenplay using the Gemini model. Analyses of unchanged
+    scripts are served from the analysis cache, and with a project_id only
+    the scenes changed since the previous draft are re-analyzed.
     """
-    print(f"AI SERVICE: Submitting 'gpt4o-image' job to Kie.ai for prompt: '{prompt}'")
-    
-    headers = {
-        "Authorization": f"Bearer {KIE_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    submit_url = "https://api.kie.ai/api/v1/gpt4o-image/generate"
-    
-    callback_url = f"{settings.PUBLIC_SERVER_URL}/api/v1/kie-callback"
-    print(f"AI SERVICE: Providing this callback URL to Kie.ai: {callback_url}")
-    submit_payload = {
-        "prompt": prompt,
-        "filesUrl": [], 
-        "size": "1:1",
-        "callBackUrl": callback_url,
-        "isEnhance": False,
-        "nVariants": 1
-    }
-    
-    try:
-        print(f"AI SERVICE: SENDING THIS EXACT GPT4O-IMAGE PAYLOAD: {submit_payload}")
-        submit_response = requests.post(submit_url, headers=headers, json=submit_payload)
-        
-        if submit_response.status_code != 200:
-            print(f"AI SERVICE: ERROR - Kie.ai returned status {submit_response.status_code}")
-            print(f"AI SERVICE: Response Body: {submit_response.text}")
-            submit_response.raise_for_status()
+    cache_key = make_analysis_key(script_text, ANALYSIS_INSTRUCTION, ANALYSIS_MODEL)
+    cached_analysis = await asyncio.to_thread(analysis_cache.get, cache_key)
+    if cached_analysis is not None:
+        print("AI SERVICE: Serving script analysis from cache.")
+        return cached_analysis
 
-        response_data = submit_response.json()
-        print(f"AI SERVICE: RECEIVED RAW RESPONSE FROM KIE.AI: {response_data}")
-        
-        data_dict = response_data.get("data") or {}
-        job_id = data_dict.get("taskId")
-        
-        if not job_id:
-            raise Exception("API reported success but did not return a recognizable job ID.")
-            
-        print(f"AI SERVICE: Image job submitted successfully. Task ID: {job_id}")
-        return job_id
+    if is_long_script(script_text, project_id):
+        analysis = await analyze_long_script(script_text, ANALYSIS_INSTRUCTION, ANALYSIS_MODEL, project_id)
+    else:
+        prompt = f"{ANALYSIS_INSTRUCTION}\n\n{script_text}"
+        analysis = await generate_text(ANALYSIS_MODEL, prompt, "analyze")
+    await asyncio.to_thread(analysis_cache.set, cache_key, analysis)
+    return analysis
 
-    except Exception as e:
-        print(f"AI SERVICE: CRITICAL FAILURE during image submission with Kie.ai: {e}")
-        raise e
-
-def analyze_script(script_text: str):
+async def stream_analyze_script(script_text: str, project_id: Optional[str] = None):
     """
-    Analyzes a screenplay using the Gemini model.
+    Streams a Gemini screenplay analysis chunk by chunk. The complete text is
+    written to the analysis cache once the stream finishes.
     """
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    prompt = f"Analyze the following screenplay for plot structure, character development, and dialogue quality:\n\n{script_text}"
-    response = model.generate_content(prompt)
-    return response.text
\ No newline at end of file
+    cache_key = make_analysis_key(script_text, ANALYSIS_INSTRUCTION, ANALYSIS_MODEL)
+    cached_analysis = await asyncio.to_thread(analysis_cache.get, cache_key)
+    if cached_analysis is not None:
+        print("AI SERVICE: Serving script analysis from cache.")
+        yield cached_analysis
+        return
+
+    if is_long_script(script_text, project_id):
+        chunks = stream_long_script(script_text, ANALYSIS_INSTRUCTION, ANALYSIS_MODEL, project_id)
+    else:
+        chunks = _stream_generate(f"{ANALYSIS_INSTRUCTION}\n\n{script_text}")
+    parts = []
+    async for text in chunks:
+        parts.append(text)
+        yield text
+    await asyncio.to_thread(analysis_cache.set, cache_key, "".join(parts))
+
+def _stream_generate(prompt: str):
+    return stream_text(ANALYSIS_MODEL, prompt, "analyze_stream")
\ No newline at end of file
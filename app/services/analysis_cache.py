@@ -0,0 +1,239 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from app.core.config import settings
+
+# Least recently used entries are read and deleted this many at a time
+EVICTION_BATCH = 100
+
+
+def normalize_script_text(script_text: str) -> str:
+    """
+    Normalizes line endings and trailing whitespace so re-uploads of an
+    unchanged draft hash to the same key.
+    """
+    lines = script_text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+def make_analysis_key(script_text: str, instruction: str, model_name: str) -> str:
+    digest = hashlib.sha256()
+    for part in (normalize_script_text(script_text), instruction.strip(), model_name):
+        encoded = part.encode("utf-8")
+        # Length-prefix each part so different splits never collide
+        digest.update(len(encoded).to_bytes(8, "big"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """
+    Content-addressed cache for Gemini script analyses.
+
+    A small in-memory LRU sits in front of a SQLite file that survives
+    restarts. The disk tier evicts least recently used entries once it grows
+    past max_disk_bytes; triggers keep the total size in analyses_size, so
+    neither the check nor the eviction reads the whole table.
+
+    get() and set() block on the SQLite file; call them from a worker
+    thread in async code.
+    """
+    def __init__(self, path: str, memory_entries: int, max_disk_bytes: int):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # SQLite connections must not be shared with a forked child.
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Opened on first use so importing this module never touches the disk.
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS analyses ("
+                " key TEXT PRIMARY KEY,"
+                " analysis TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_analyses_accessed_at ON analyses (accessed_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS analyses_size ("
+                " id INTEGER PRIMARY KEY CHECK (id = 0),"
+                " total_bytes INTEGER NOT NULL)"
+            )
+            # Seeds the total of cache files created before it was tracked
+            self._conn.execute(
+                "INSERT OR IGNORE INTO analyses_size (id, total_bytes) SELECT 0, COALESCE(SUM(size), 0) FROM analyses"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS analyses_size_insert AFTER INSERT ON analyses"
+                " BEGIN UPDATE analyses_size SET total_bytes = total_bytes + NEW.size WHERE id = 0; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS analyses_size_update AFTER UPDATE OF size ON analyses"
+                " BEGIN UPDATE analyses_size SET total_bytes = total_bytes + NEW.size - OLD.size WHERE id = 0; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS analyses_size_delete AFTER DELETE ON analyses"
+                " BEGIN UPDATE analyses_size SET total_bytes = total_bytes - OLD.size WHERE id = 0; END"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            analysis = self._memory.get(key)
+            if analysis is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return analysis
+
+            conn = self._connection()
+            row = conn.execute("SELECT analysis FROM analyses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE analyses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            self.disk_hits += 1
+            self._remember(key, row[0])
+            return row[0]
+
+    def set(self, key: str, analysis: str):
+        now = time.time()
+        size = len(analysis.encode("utf-8"))
+        with self._lock:
+            self._remember(key, analysis)
+            conn = self._connection()
+            # An upsert rather than INSERT OR REPLACE: REPLACE's implicit
+            # delete does not fire the size trigger
+            conn.execute(
+                "INSERT INTO analyses (key, analysis, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET analysis = excluded.analysis, size = excluded.size,"
+                " created_at = excluded.created_at, accessed_at = excluded.accessed_at",
+                (key, analysis, size, now, now),
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def stats(self):
+        with self._lock:
+            conn = self._connection()
+            total_bytes = self._total_bytes(conn)
+            entries = conn.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "disk_entries": entries,
+                "disk_bytes": total_bytes,
+            }
+
+    def _remember(self, key: str, analysis: str):
+        self._memory[key] = analysis
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _total_bytes(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT total_bytes FROM analyses_size WHERE id = 0").fetchone()[0]
+
+    def _evict(self, conn: sqlite3.Connection):
+        total_bytes = self._total_bytes(conn)
+        while total_bytes > self.max_disk_bytes:
+            # Oldest entries first, read through the accessed_at index
+            rows = conn.execute(
+                "SELECT key, size FROM analyses ORDER BY accessed_at LIMIT ?", (EVICTION_BATCH,)
+            ).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                if total_bytes <= self.max_disk_bytes:
+                    break
+                evicted.append(key)
+                total_bytes -= size
+            conn.executemany("DELETE FROM analyses WHERE key = ?", [(key,) for key in evicted])
+            for key in evicted:
+                self._memory.pop(key, None)
+            self.evictions += len(evicted)
+
+
+class SceneNotesStore:
+    """
+    Per-scene analysis notes for each script/project, keyed by scene
+    fingerprint. Only the scenes of a project's latest draft are kept, so
+    the table grows with the number of live projects, not with revisions.
+    Shares the SQLite file of the analysis cache.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS scene_notes ("
+                " project_id TEXT NOT NULL,"
+                " fingerprint TEXT NOT NULL,"
+                " notes TEXT NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (project_id, fingerprint))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def load(self, project_id: str) -> dict:
+        """Returns {fingerprint: notes} for the project's latest stored draft."""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT fingerprint, notes FROM scene_notes WHERE project_id = ?", (project_id,)
+            ).fetchall()
+            return dict(rows)
+
+    def replace(self, project_id: str, notes_by_fingerprint: dict):
+        """Stores the notes of a new draft and drops scenes that no longer exist."""
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM scene_notes WHERE project_id = ?", (project_id,))
+            conn.executemany(
+                "INSERT INTO scene_notes (project_id, fingerprint, notes, updated_at) VALUES (?, ?, ?, ?)",
+                [(project_id, fingerprint, notes, now) for fingerprint, notes in notes_by_fingerprint.items()],
+            )
+            conn.commit()
+
+
+analysis_cache = AnalysisCache(
+    path=settings.ANALYSIS_CACHE_PATH,
+    memory_entries=settings.ANALYSIS_CACHE_MEMORY_ENTRIES,
+    max_disk_bytes=settings.ANALYSIS_CACHE_MAX_BYTES,
+)
+
+scene_notes_store = SceneNotesStore(path=settings.ANALYSIS_CACHE_PATH)
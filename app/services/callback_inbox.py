@@ -0,0 +1,311 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+from app.core.config import settings
+from app.services.metrics import kie_callbacks, callback_batch_size
+
+
+class CallbackRow:
+    """One accepted Kie.ai webhook, as handed to a callback handler."""
+    def __init__(self, row_id: int, kind: str, external_id: str, state: str,
+                 internal_task_id: Optional[str], body: dict, attempts: int, received_at: float):
+        self.id = row_id
+        self.kind = kind
+        self.external_id = external_id
+        self.state = state
+        self.internal_task_id = internal_task_id
+        self.body = body
+        self.attempts = attempts
+        self.received_at = received_at
+
+
+class InboxBusyError(Exception):
+    """The inbox file stayed locked by another process for CALLBACK_INBOX_BUSY_TIMEOUT."""
+
+
+class CallbackInbox:
+    """
+    Durable SQLite inbox and idempotency table for Kie.ai webhooks.
+
+    The webhook handlers only validate a callback and insert it keyed by
+    (taskId, state); Kie.ai's retries of a callback we already have hit the
+    unique key and are dropped. The CallbackProcessor claims pending rows in
+    batches with a lease, so several API processes can share one inbox file.
+    Processed rows keep their key, without the body, for CALLBACK_DEDUP_TTL.
+
+    sqlite3 calls block, so they run in a worker thread, and a write waits
+    at most CALLBACK_INBOX_BUSY_TIMEOUT for another process's write lock.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=settings.CALLBACK_INBOX_BUSY_TIMEOUT, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # Commits survive a crash of the process, not of the machine; this
+            # keeps the fsync off the webhook's acknowledgement path.
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS callbacks ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " kind TEXT NOT NULL,"
+                " external_id TEXT NOT NULL,"
+                " state TEXT NOT NULL,"
+                " internal_task_id TEXT,"
+                " body TEXT NOT NULL,"
+                " status TEXT NOT NULL DEFAULT 'pending',"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at REAL NOT NULL,"
+                " received_at REAL NOT NULL,"
+                " last_error TEXT,"
+                " UNIQUE (external_id, state))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_callbacks_due ON callbacks (status, next_attempt_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_callbacks_received_at ON callbacks (received_at)")
+            self._conn.commit()
+        return self._conn
+
+    async def _run(self, work: Callable[[sqlite3.Connection], object]):
+        return await asyncio.to_thread(self._locked, work)
+
+    def _locked(self, work: Callable[[sqlite3.Connection], object]):
+        with self._lock:
+            return work(self._connection())
+
+    async def accept(self, kind: str, external_id: str, state: str, body: str, internal_task_id: Optional[str] = None) -> bool:
+        """
+        Stores a validated callback for processing. Returns False when the
+        same (external_id, state) was already received; raises InboxBusyError
+        when the inbox stays locked, so Kie.ai can deliver it again.
+        """
+        now = time.time()
+
+        def insert(conn: sqlite3.Connection) -> bool:
+            try:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO callbacks (kind, external_id, state, internal_task_id, body, next_attempt_at, received_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (kind, external_id, state, internal_task_id, body, now, now),
+                )
+                conn.commit()
+            except sqlite3.OperationalError as e:
+                conn.rollback()
+                raise InboxBusyError(str(e)) from e
+            return cursor.rowcount == 1
+
+        accepted = await self._run(insert)
+        kie_callbacks.inc(kind=kind, outcome="accepted" if accepted else "duplicate")
+        return accepted
+
+    async def claim(self, limit: int) -> List[CallbackRow]:
+        """
+        Leases up to limit due callbacks for CALLBACK_LEASE seconds. Rows
+        whose lease runs out (the process died mid-batch) are claimed again.
+        """
+        now = time.time()
+
+        def lease(conn: sqlite3.Connection):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT id, kind, external_id, state, internal_task_id, body, attempts, received_at FROM callbacks"
+                    " WHERE status = 'pending' AND next_attempt_at <= ?"
+                    " ORDER BY id LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE callbacks SET next_attempt_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(now + settings.CALLBACK_LEASE, row[0]) for row in rows],
+                )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            return rows
+
+        rows = await self._run(lease)
+        return [
+            CallbackRow(row_id, kind, external_id, state, internal_task_id, json.loads(body), attempts + 1, received_at)
+            for row_id, kind, external_id, state, internal_task_id, body, attempts, received_at in rows
+        ]
+
+    async def done(self, ids: List[int]):
+        """Marks callbacks processed; only their idempotency key is kept."""
+        if not ids:
+            return
+
+        def mark(conn: sqlite3.Connection):
+            conn.executemany(
+                "UPDATE callbacks SET status = 'done', body = '', last_error = NULL WHERE id = ?",
+                [(row_id,) for row_id in ids],
+            )
+            conn.commit()
+
+        await self._run(mark)
+
+    async def retry_later(self, rows: List[CallbackRow], error: str):
+        """Reschedules failed callbacks with jittered exponential backoff."""
+        now = time.time()
+        updates = []
+        for row in rows:
+            if row.attempts >= settings.CALLBACK_MAX_ATTEMPTS:
+                updates.append(("dead", now, error, row.id))
+                continue
+            delay = min(settings.CALLBACK_RETRY_MAX_DELAY, settings.CALLBACK_RETRY_BASE_DELAY * 2 ** (row.attempts - 1))
+            updates.append(("pending", now + delay * random.uniform(0.5, 1.0), error, row.id))
+
+        def reschedule(conn: sqlite3.Connection):
+            conn.executemany(
+                "UPDATE callbacks SET status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                updates,
+            )
+            conn.commit()
+
+        await self._run(reschedule)
+
+    async def prune(self, older_than: float) -> int:
+        """Forgets processed callbacks received more than older_than seconds ago."""
+        cutoff = time.time() - older_than
+
+        def delete(conn: sqlite3.Connection) -> int:
+            cursor = conn.execute(
+                "DELETE FROM callbacks WHERE status = 'done' AND received_at < ?",
+                (cutoff,),
+            )
+            conn.commit()
+            return cursor.rowcount
+
+        return await self._run(delete)
+
+    async def stats(self):
+        def count(conn: sqlite3.Connection):
+            return conn.execute(
+                "SELECT status, COUNT(*), MIN(received_at) FROM callbacks GROUP BY status"
+            ).fetchall()
+
+        rows = await self._run(count)
+        now = time.time()
+        return {
+            status: {"count": count, "oldest_age": round(now - oldest, 3) if oldest else 0.0}
+            for status, count, oldest in rows
+        }
+
+
+CallbackHandler = Callable[[List[CallbackRow]], Awaitable[None]]
+
+
+class CallbackProcessor:
+    """
+    Background task that drains the callback inbox, up to
+    CALLBACK_BATCH_SIZE callbacks at a time. Each kind of callback has a
+    handler that gets the whole batch of its rows; if it raises, those rows
+    are retried later, so handlers must be safe to run twice.
+    """
+    def __init__(self, inbox: CallbackInbox):
+        self.inbox = inbox
+        self.processed = 0
+        self.failed_attempts = 0
+        self._handlers: Dict[str, CallbackHandler] = {}
+        self._pruners: List[Callable[[float], Awaitable[None]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pruned_at = 0.0
+
+    def register(self, kind: str, handler: CallbackHandler, prune: Optional[Callable[[float], Awaitable[None]]] = None):
+        """
+        Registers the handler for a kind of callback. prune(older_than), if
+        given, forgets the handler's own state along with processed callbacks.
+        """
+        self._handlers[kind] = handler
+        if prune is not None:
+            self._pruners.append(prune)
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self):
+        """Wakes the processor so a freshly accepted callback is handled right away."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                drained = await self.drain_once()
+                await self._prune()
+            except Exception as e:
+                print(f"CALLBACKS: Processor error: {e}")
+                drained = 0
+            if drained:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.CALLBACK_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain_once(self) -> int:
+        rows = await self.inbox.claim(settings.CALLBACK_BATCH_SIZE)
+        if not rows:
+            return 0
+        by_kind: Dict[str, List[CallbackRow]] = {}
+        for row in rows:
+            by_kind.setdefault(row.kind, []).append(row)
+        for kind, kind_rows in by_kind.items():
+            await self._process(kind, kind_rows)
+        return len(rows)
+
+    async def _process(self, kind: str, rows: List[CallbackRow]):
+        handler = self._handlers.get(kind)
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler registered for '{kind}' callbacks")
+            await handler(rows)
+        except Exception as e:
+            self.failed_attempts += len(rows)
+            print(f"CALLBACKS: Processing {len(rows)} '{kind}' callback(s) failed: {e}")
+            await self.inbox.retry_later(rows, str(e) or e.__class__.__name__)
+            return
+        await self.inbox.done([row.id for row in rows])
+        self.processed += len(rows)
+        callback_batch_size.observe(len(rows), kind=kind)
+
+    async def _prune(self):
+        now = time.monotonic()
+        if now - self._pruned_at < settings.CALLBACK_PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        pruned = await self.inbox.prune(settings.CALLBACK_DEDUP_TTL)
+        if pruned:
+            print(f"CALLBACKS: Forgot {pruned} processed callback(s)")
+        for prune in self._pruners:
+            await prune(settings.CALLBACK_DEDUP_TTL)
+
+
+callback_inbox = CallbackInbox(path=settings.CALLBACK_INBOX_PATH)
+callback_processor = CallbackProcessor(callback_inbox)
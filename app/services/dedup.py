@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from app.core.config import settings
+
+# Roles handed back by GenerationDeduplicator.claim()
+LEADER = "leader"  # no identical job is known; the caller must submit it
+JOINED = "joined"  # an identical job is in flight; the caller waits for its leader's outcome
+CACHED = "cached"  # an identical job finished recently; its result can be reused
+
+
+def make_generation_key(prompt: str, service_type: str, quality: str) -> tuple:
+    """
+    Builds the dedup key for a generation request. Whitespace differences in
+    the prompt do not produce a new paid job. The key holds the quality tier
+    rather than the model, since the model router may pick any model of it.
+    """
+    normalized_prompt = " ".join(prompt.split())
+    return (normalized_prompt, service_type, quality)
+
+
+class GenerationDeduplicator:
+    """
+    Single-flight deduplication and result cache for Kie.ai generation jobs.
+
+    Identical requests that arrive while a job is in flight join it instead of
+    starting a new one, and finished results are kept in a TTL/LRU cache.
+    State is per process: the links from followers to their leader are also
+    stored (in the tasks table, or the callback inbox for forwarded results)
+    so the process that receives the callback can complete the followers.
+    """
+    def __init__(self, result_ttl: float, max_results: int, inflight_timeout: float):
+        self.result_ttl = result_ttl
+        self.max_results = max_results
+        self.inflight_timeout = inflight_timeout
+        self.hits = 0
+        self.joins = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._inflight = {}
+        self._key_by_task = {}
+        self._key_by_external = {}
+
+    def claim(self, key: tuple, task_id: str):
+        """
+        Registers task_id for key and returns a (role, value) pair: the
+        cached result_url when the role is CACHED, the leader's task ID when
+        it is JOINED, and for a LEADER the Kie.ai task ID an earlier attempt
+        already submitted, if any.
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None:
+                result_url, expires_at = cached
+                if expires_at > now:
+                    self._results.move_to_end(key)
+                    self.hits += 1
+                    return CACHED, result_url
+                del self._results[key]
+
+            flight = self._inflight.get(key)
+            if flight is not None and flight["leader"] == task_id:
+                # The leader is retrying its own submission, which may have
+                # reached Kie.ai before a later step failed.
+                flight["started_at"] = now
+                return LEADER, flight["external_id"]
+            if flight is not None and now - flight["started_at"] < self.inflight_timeout:
+                flight["followers"].append(task_id)
+                self.joins += 1
+                return JOINED, flight["leader"]
+            if flight is not None:
+                # The previous job never reported back; let this request start over.
+                self._forget(key, flight)
+
+            self._inflight[key] = {
+                "leader": task_id,
+                "followers": [],
+                "external_id": None,
+                "started_at": now,
+            }
+            self._key_by_task[task_id] = key
+            self.misses += 1
+            return LEADER, None
+
+    def bind_external(self, key: tuple, external_id: str):
+        """
+        Records the Kie.ai task ID of the leader's job so callbacks can find
+        it, and returns the followers that joined so far.
+        """
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is None:
+                return []
+            flight["external_id"] = external_id
+            self._key_by_external[external_id] = key
+            return list(flight["followers"])
+
+    def followers(self, key: tuple):
+        """The task IDs that joined the in-flight job for key so far."""
+        with self._lock:
+            flight = self._inflight.get(key)
+            return list(flight["followers"]) if flight is not None else []
+
+    def complete(self, result_url: Optional[str], success: bool, task_id: Optional[str] = None, external_id: Optional[str] = None):
+        """
+        Closes the in-flight job identified by the leader's task_id or the
+        Kie.ai external_id, caches successful results and returns the follower
+        task IDs that are still waiting for this outcome.
+        """
+        with self._lock:
+            key = None
+            if task_id is not None:
+                key = self._key_by_task.get(task_id)
+            if key is None and external_id is not None:
+                key = self._key_by_external.get(external_id)
+            if key is None:
+                return []
+
+            flight = self._inflight.get(key)
+            if flight is None:
+                return []
+            self._forget(key, flight)
+
+            if success and result_url:
+                self._results[key] = (result_url, time.monotonic() + self.result_ttl)
+                self._results.move_to_end(key)
+                while len(self._results) > self.max_results:
+                    self._results.popitem(last=False)
+            return list(flight["followers"])
+
+    def abandon(self, key: tuple):
+        """
+        Drops an in-flight job whose submission failed and returns the
+        followers that were waiting on it.
+        """
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is None:
+                return []
+            self._forget(key, flight)
+            return list(flight["followers"])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "joins": self.joins,
+                "misses": self.misses,
+                "in_flight": len(self._inflight),
+                "cached_results": len(self._results),
+            }
+
+    def _forget(self, key: tuple, flight: dict):
+        self._inflight.pop(key, None)
+        self._key_by_task.pop(flight["leader"], None)
+        if flight["external_id"] is not None:
+            self._key_by_external.pop(flight["external_id"], None)
+
+
+generation_dedup = GenerationDeduplicator(
+    result_ttl=settings.GENERATION_DEDUP_RESULT_TTL,
+    max_results=settings.GENERATION_DEDUP_MAX_RESULTS,
+    inflight_timeout=settings.GENERATION_DEDUP_INFLIGHT_TIMEOUT,
+)
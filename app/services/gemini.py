@@ -0,0 +1,67 @@
+import asyncio
+import time
+from app.services.metrics import gemini_request_duration, observe_gemini_usage
+from app.services.providers import get_gemini_async
+from app.services.resilience import gemini_upstream, is_transient
+from app.services.tracing import tracer
+
+
+async def generate_text(model_name: str, prompt: str, operation: str) -> str:
+    """
+    Runs one Gemini generation. Transient errors are retried, a call slower
+    than the recent p95 of the same model and operation is hedged with a
+    duplicate (generation has no side effects), and CircuitOpenError is
+    raised while Gemini keeps failing.
+    """
+    return await gemini_upstream.call(_generate_once, model_name, prompt, operation, hedge=True,
+                                      operation=f"{model_name} {operation}")
+
+
+async def _generate_once(model_name: str, prompt: str, operation: str) -> str:
+    """Runs one Gemini generation and records its latency and token usage."""
+    started = time.perf_counter()
+    outcome = "error"
+    with tracer.span(f"gemini {operation}", model=model_name, prompt_chars=len(prompt)):
+        try:
+            model = (await get_gemini_async()).GenerativeModel(model_name)
+            response = await model.generate_content_async(prompt)
+            text = response.text
+            outcome = "ok"
+        finally:
+            gemini_request_duration.observe(time.perf_counter() - started, model=model_name, operation=operation, outcome=outcome)
+    observe_gemini_usage(model_name, operation, getattr(response, "usage_metadata", None))
+    return text
+
+
+async def stream_text(model_name: str, prompt: str, operation: str):
+    """
+    Streams a Gemini generation chunk by chunk. Latency is measured until the
+    last chunk; token usage comes from the final chunk's metadata. Streams
+    are not retried once chunks have been sent, but they respect Gemini's
+    circuit breaker and count towards it.
+    """
+    gemini_upstream.breaker.before_call()
+    started_at = time.time()
+    started = time.perf_counter()
+    outcome = "error"
+    usage_metadata = None
+    try:
+        model = (await get_gemini_async()).GenerativeModel(model_name)
+        response = await model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+            yield chunk.text
+        outcome = "ok"
+        gemini_upstream.breaker.record(healthy=True)
+    except (GeneratorExit, asyncio.CancelledError):
+        gemini_upstream.breaker.abandon()
+        raise
+    except Exception as e:
+        gemini_upstream.breaker.record(healthy=not is_transient(e))
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        gemini_request_duration.observe(elapsed, model=model_name, operation=operation, outcome=outcome)
+        tracer.record(f"gemini {operation}", started_at, elapsed, None if outcome == "ok" else outcome,
+                      model=model_name, prompt_chars=len(prompt))
+        observe_gemini_usage(model_name, operation, usage_metadata)
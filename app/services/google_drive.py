@@ -1,33 +1,459 @@
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google.auth.transport.requests import Request
 from app.core.config import settings
+from app.services.providers import providers
+from app.services.metrics import drive_upload_bytes, drive_upload_duration, drive_upload_throughput
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, AsyncIterator, Optional
+import asyncio
+import threading
+import time
+import uuid
+import httpx
 import os
 
+# The Google client libraries take a few hundred milliseconds to import, so
+# they are loaded on first use rather than when the API process starts.
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 
-def get_drive_service():
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                settings.GOOGLE_DRIVE_CREDENTIALS_FILE, SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
+DRIVE_DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/drive/v3/rest"
+# Drive requires every chunk except the last to be a multiple of 256 KiB.
+UPLOAD_CHUNK_ALIGNMENT = 256 * 1024
+
+
+class DriveCredentialManager:
+    """
+    Process-wide holder for the Drive OAuth credentials.
+
+    token.json is read once, and a daemon thread refreshes the access token
+    DRIVE_TOKEN_REFRESH_MARGIN seconds before it expires, so uploads almost
+    never pay for a refresh themselves.
+    """
+    def __init__(self, token_path: str = 'token.json'):
+        self.token_path = token_path
+        self.refreshes = 0
+        self._lock = threading.Lock()
+        self._creds: Optional["Credentials"] = None
+        self._refresher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def get(self) -> "Credentials":
+        with self._lock:
+            if self._creds is None:
+                self._creds = self._load()
+            elif self._needs_refresh(self._creds):
+                self._refresh(self._creds)
+            creds = self._creds
+        self._start_refresher()
+        return creds
+
+    def _load(self) -> "Credentials":
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        creds = None
+        if os.path.exists(self.token_path):
+            creds = Credentials.from_authorized_user_file(self.token_path, SCOPES)
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                self._refresh(creds)
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    settings.GOOGLE_DRIVE_CREDENTIALS_FILE, SCOPES)
+                creds = flow.run_local_server(port=0)
+                self._save(creds)
+        return creds
+
+    def refresh_rejected(self, token: Optional[str]) -> "Credentials":
+        """
+        Refreshes the access token after Drive rejected token with a 401,
+        unless another caller already replaced it, and returns the credentials.
+        """
+        with self._lock:
+            if self._creds is None:
+                self._creds = self._load()
+            elif self._creds.token == token:
+                self._refresh(self._creds)
+            return self._creds
+
+    def _needs_refresh(self, creds: "Credentials") -> bool:
+        if not creds.valid:
+            return True
+        if creds.expiry is None:
+            return False
+        margin = timedelta(seconds=settings.DRIVE_TOKEN_REFRESH_MARGIN)
+        return creds.expiry - margin <= datetime.utcnow()
+
+    def _refresh(self, creds: "Credentials"):
+        from google.auth.transport.requests import Request
+        creds.refresh(Request())
+        self.refreshes += 1
+        self._save(creds)
+
+    def _save(self, creds: "Credentials"):
+        with open(self.token_path, 'w') as token:
             token.write(creds.to_json())
-    return build('drive', 'v3', credentials=creds)
+
+    def _start_refresher(self):
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        with self._lock:
+            if self._refresher is not None and self._refresher.is_alive():
+                return
+            self._stop.clear()
+            self._refresher = threading.Thread(target=self._refresh_loop, name="drive-token-refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            with self._lock:
+                creds = self._creds
+            wait = settings.DRIVE_TOKEN_REFRESH_MARGIN
+            if creds is not None and creds.expiry is not None:
+                margin = timedelta(seconds=settings.DRIVE_TOKEN_REFRESH_MARGIN)
+                wait = max(1.0, (creds.expiry - margin - datetime.utcnow()).total_seconds())
+            if self._stop.wait(wait):
+                return
+            try:
+                with self._lock:
+                    if self._creds is not None and self._needs_refresh(self._creds):
+                        self._refresh(self._creds)
+                        print("DRIVE: Refreshed access token ahead of expiry.")
+            except Exception as e:
+                print(f"DRIVE: Background token refresh failed: {e}")
+                self._stop.wait(30)
+
+    def stop(self):
+        self._stop.set()
+
+
+def load_drive_discovery_document() -> str:
+    """
+    Returns the Drive v3 discovery document, read from the local cache file
+    when present. Otherwise the copy bundled with google-api-python-client
+    (or, failing that, the live document) is used and written to the cache.
+    """
+    path = settings.DRIVE_DISCOVERY_CACHE_PATH
+    if os.path.exists(path):
+        with open(path) as cached:
+            return cached.read()
+    from googleapiclient import discovery_cache
+    document = discovery_cache.get_static_doc('drive', 'v3')
+    if document is None:
+        response = httpx.get(DRIVE_DISCOVERY_URL, timeout=30)
+        response.raise_for_status()
+        document = response.text
+    with open(path, 'w') as cached:
+        cached.write(document)
+    return document
+
+
+class DriveServicePool:
+    """
+    Hands out Drive API clients that are safe to use from many threads.
+
+    googleapiclient services wrap a non-thread-safe httplib2 connection, so
+    each thread gets its own client, built once from the cached discovery
+    document and sharing the process-wide credentials.
+    """
+    def __init__(self, credential_manager: DriveCredentialManager):
+        self.credential_manager = credential_manager
+        self.builds = 0
+        self._lock = threading.Lock()
+        self._document: Optional[str] = None
+        self._local = threading.local()
+
+    def _discovery_document(self) -> str:
+        if self._document is None:
+            with self._lock:
+                if self._document is None:
+                    self._document = load_drive_discovery_document()
+        return self._document
+
+    def get(self):
+        creds = self.credential_manager.get()
+        service = getattr(self._local, "service", None)
+        if service is None or getattr(self._local, "creds", None) is not creds:
+            from googleapiclient.discovery import build_from_document
+            service = build_from_document(self._discovery_document(), credentials=creds)
+            self._local.service = service
+            self._local.creds = creds
+            with self._lock:
+                self.builds += 1
+        return service
+
+
+drive_credentials = DriveCredentialManager()
+drive_services = DriveServicePool(drive_credentials)
+
+def get_drive_credentials():
+    return drive_credentials.get()
+
+def get_drive_service():
+    return drive_services.get()
+
+def _observe_upload(method: str, outcome: str, started: float, size: int):
+    elapsed = time.perf_counter() - started
+    drive_upload_duration.observe(elapsed, method=method, outcome=outcome)
+    if outcome == "ok":
+        drive_upload_bytes.inc(size, method=method)
+        if elapsed > 0:
+            drive_upload_throughput.observe(size / elapsed, method=method)
+
 
 def upload_file_to_drive(file_path: str, file_name: str, folder_id: str = None):
-    service = get_drive_service()
-    file_metadata = {'name': file_name}
-    if folder_id:
-        file_metadata['parents'] = [folder_id]
-    media = MediaFileUpload(file_path)
-    file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-    return file.get('id')
\ No newline at end of file
+    from googleapiclient.http import MediaFileUpload
+    started = time.perf_counter()
+    try:
+        service = get_drive_service()
+        file_metadata = {'name': file_name}
+        if folder_id:
+            file_metadata['parents'] = [folder_id]
+        media = MediaFileUpload(file_path)
+        file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+    except Exception:
+        _observe_upload("simple", "error", started, 0)
+        raise
+    _observe_upload("simple", "ok", started, os.path.getsize(file_path))
+    return file.get('id')
+
+
+# --- Streaming resumable uploads ---
+class DriveUploadError(Exception):
+    """Raised when a resumable Drive upload cannot be completed."""
+
+
+class UploadProgressRegistry:
+    """
+    Tracks the progress of concurrent streaming uploads. Finished uploads are
+    kept for a while (up to max_finished) so clients can read the outcome.
+    """
+    def __init__(self, max_finished: int = 200):
+        self.max_finished = max_finished
+        self._lock = threading.Lock()
+        self._uploads = OrderedDict()
+
+    def start(self, upload_id: str, file_name: str, total_bytes: Optional[int]):
+        with self._lock:
+            self._uploads[upload_id] = {
+                "upload_id": upload_id,
+                "file_name": file_name,
+                "status": "uploading",
+                "bytes_uploaded": 0,
+                "total_bytes": total_bytes,
+                "retries": 0,
+                "file_id": None,
+                "error": None,
+                "started_at": time.time(),
+                "finished_at": None,
+            }
+
+    def update(self, upload_id: str, **fields):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            if upload is not None:
+                upload.update(fields)
+
+    def finish(self, upload_id: str, status: str, file_id: Optional[str] = None, error: Optional[str] = None):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            if upload is None:
+                return
+            upload.update(status=status, file_id=file_id, error=error, finished_at=time.time())
+            self._uploads.move_to_end(upload_id)
+            finished = [key for key, value in self._uploads.items() if value["status"] != "uploading"]
+            for key in finished[:max(0, len(finished) - self.max_finished)]:
+                del self._uploads[key]
+
+    def get(self, upload_id: str) -> Optional[dict]:
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            return dict(upload) if upload is not None else None
+
+    def all(self):
+        with self._lock:
+            return [dict(upload) for upload in self._uploads.values()]
+
+
+upload_progress = UploadProgressRegistry()
+
+def _create_upload_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(timeout=settings.DRIVE_UPLOAD_TIMEOUT)
+
+providers.register("drive_upload", _create_upload_client, close=lambda client: client.aclose())
+
+def _get_upload_client() -> httpx.AsyncClient:
+    return providers.get("drive_upload")
+
+
+class _RetryableUploadError(Exception):
+    pass
+
+
+class ResumableDriveUpload:
+    """
+    One Drive resumable upload session fed from an async stream of bytes.
+
+    Only the chunk that Drive has not yet acknowledged is held in memory, so
+    memory use is bounded by the chunk size regardless of the file size.
+    Transient failures are retried with backoff after asking Drive how many
+    bytes it has already committed. The access token is looked up for every
+    request, so an upload may outlive the token it started with; a 401 is
+    answered by refreshing the token and sending the request once more.
+    """
+    def __init__(self, client: httpx.AsyncClient, credentials: DriveCredentialManager, upload_id: str, chunk_size: int):
+        self.client = client
+        self.credentials = credentials
+        self.upload_id = upload_id
+        self.chunk_size = max(UPLOAD_CHUNK_ALIGNMENT, chunk_size - chunk_size % UPLOAD_CHUNK_ALIGNMENT)
+        self.session_url = None
+        self.offset = 0
+        self.buffer = bytearray()
+        self.result = None
+
+    async def _request(self, method: str, url: str, headers: dict, **kwargs) -> httpx.Response:
+        creds = await asyncio.to_thread(self.credentials.get)
+        response = await self.client.request(method, url, headers={**headers, "Authorization": f"Bearer {creds.token}"}, **kwargs)
+        if response.status_code == 401:
+            print(f"DRIVE UPLOAD {self.upload_id}: access token rejected, refreshing it and retrying...")
+            creds = await asyncio.to_thread(self.credentials.refresh_rejected, creds.token)
+            response = await self.client.request(method, url, headers={**headers, "Authorization": f"Bearer {creds.token}"}, **kwargs)
+        return response
+
+    async def start(self, file_name: str, mime_type: str, total_size: Optional[int], folder_id: Optional[str]):
+        metadata = {"name": file_name}
+        if folder_id:
+            metadata["parents"] = [folder_id]
+        headers = {"X-Upload-Content-Type": mime_type}
+        if total_size is not None:
+            headers["X-Upload-Content-Length"] = str(total_size)
+        # An unused session costs nothing, so opening one is retried like a chunk
+        for attempt in range(settings.DRIVE_UPLOAD_MAX_RETRIES + 1):
+            try:
+                response = await self._request(
+                    "POST",
+                    settings.DRIVE_UPLOAD_URL,
+                    params={"uploadType": "resumable", "fields": "id"},
+                    json=metadata,
+                    headers=headers,
+                )
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise _RetryableUploadError(f"Drive returned status {response.status_code}")
+            except (httpx.TransportError, _RetryableUploadError) as e:
+                if attempt == settings.DRIVE_UPLOAD_MAX_RETRIES:
+                    raise DriveUploadError(f"Could not start the upload after {attempt + 1} attempts: {e}") from e
+                print(f"DRIVE UPLOAD {self.upload_id}: transient failure starting the session ({e}), retrying...")
+                await asyncio.sleep(settings.DRIVE_UPLOAD_RETRY_BACKOFF * 2 ** attempt)
+                continue
+            break
+        if not response.is_success or "Location" not in response.headers:
+            raise DriveUploadError(f"Drive refused the upload session with status {response.status_code}: {response.text}")
+        self.session_url = response.headers["Location"]
+
+    async def write(self, data: bytes):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.chunk_size:
+            await self._send(self.chunk_size, final=False)
+
+    async def finish(self) -> dict:
+        while self.result is None:
+            await self._send(len(self.buffer), final=True)
+        return self.result
+
+    async def _send(self, length: int, final: bool):
+        target_offset = self.offset + length
+        for attempt in range(settings.DRIVE_UPLOAD_MAX_RETRIES + 1):
+            try:
+                await self._put(length, final)
+                return
+            except (httpx.TransportError, _RetryableUploadError) as e:
+                if attempt == settings.DRIVE_UPLOAD_MAX_RETRIES:
+                    raise DriveUploadError(f"Upload failed after {attempt + 1} attempts: {e}") from e
+                upload_progress.update(self.upload_id, retries=attempt + 1)
+                print(f"DRIVE UPLOAD {self.upload_id}: transient failure ({e}), retrying...")
+                await asyncio.sleep(settings.DRIVE_UPLOAD_RETRY_BACKOFF * 2 ** attempt)
+                try:
+                    await self._resync(final)
+                except (httpx.TransportError, _RetryableUploadError):
+                    continue
+                if self.result is not None or (not final and self.offset >= target_offset):
+                    return
+                # Resend only what Drive has not acknowledged yet
+                length = len(self.buffer) if final else target_offset - self.offset
+
+    async def _put(self, length: int, final: bool):
+        total = str(self.offset + len(self.buffer)) if final else "*"
+        if length == 0:
+            content_range = f"bytes */{total}"
+        else:
+            content_range = f"bytes {self.offset}-{self.offset + length - 1}/{total}"
+        response = await self._request(
+            "PUT",
+            self.session_url,
+            content=bytes(self.buffer[:length]),
+            headers={"Content-Range": content_range},
+        )
+        self._handle(response)
+
+    async def _resync(self, final: bool):
+        # Ask Drive how much of the upload it already has.
+        total = str(self.offset + len(self.buffer)) if final else "*"
+        response = await self._request(
+            "PUT",
+            self.session_url,
+            headers={"Content-Range": f"bytes */{total}"},
+        )
+        self._handle(response)
+
+    def _handle(self, response: httpx.Response):
+        if response.status_code in (200, 201):
+            self._commit(self.offset + len(self.buffer))
+            self.result = response.json()
+            return
+        if response.status_code == 308:
+            committed = 0
+            range_header = response.headers.get("Range")
+            if range_header:
+                committed = int(range_header.rsplit("-", 1)[1]) + 1
+            self._commit(committed)
+            return
+        if response.status_code == 429 or response.status_code >= 500:
+            raise _RetryableUploadError(f"Drive returned status {response.status_code}")
+        raise DriveUploadError(f"Drive returned status {response.status_code}: {response.text}")
+
+    def _commit(self, committed: int):
+        if committed > self.offset:
+            del self.buffer[:committed - self.offset]
+            self.offset = committed
+            upload_progress.update(self.upload_id, bytes_uploaded=self.offset)
+
+
+async def upload_stream_to_drive(
+    chunks: AsyncIterator[bytes],
+    file_name: str,
+    mime_type: str = "application/octet-stream",
+    total_size: Optional[int] = None,
+    folder_id: Optional[str] = None,
+    upload_id: Optional[str] = None,
+) -> str:
+    """
+    Streams an async iterator of bytes into a Drive resumable upload session
+    without writing a temp file, and returns the Drive file ID.
+    """
+    upload_id = upload_id or str(uuid.uuid4())
+    upload_progress.start(upload_id, file_name, total_size)
+    started = time.perf_counter()
+    try:
+        upload = ResumableDriveUpload(_get_upload_client(), drive_credentials, upload_id, settings.DRIVE_UPLOAD_CHUNK_SIZE)
+        await upload.start(file_name, mime_type, total_size, folder_id)
+        async for chunk in chunks:
+            await upload.write(chunk)
+        result = await upload.finish()
+    except Exception as e:
+        upload_progress.finish(upload_id, "failed", error=str(e))
+        _observe_upload("resumable", "error", started, 0)
+        raise
+    upload_progress.finish(upload_id, "completed", file_id=result.get("id"))
+    _observe_upload("resumable", "ok", started, upload.offset)
+    return result.get("id")
@@ -0,0 +1,150 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import delete, insert, select, update
+from app.database import AsyncSessionLocal
+from app.models.models import KieJob
+
+# Core statements on the table, like the job queue: one round-trip each and
+# no ORM objects.
+kie_jobs_table = KieJob.__table__
+
+
+def _epoch(moment: datetime) -> float:
+    # Timestamps are stored as naive UTC, like every other DateTime column
+    return moment.replace(tzinfo=timezone.utc).timestamp()
+
+
+class KieJobLedger:
+    """
+    Records every Kie.ai generation job in the application database: which
+    model it went to, when it was submitted and how it ended. Every process
+    and host writes to and reads from the same table, so the model router
+    learns from all the results, wherever they were received.
+    """
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+
+    async def record_submission(self, external_id: Optional[str], service_type: Optional[str], model: str,
+                                succeeded: Optional[bool] = None, forward_task_id: Optional[str] = None):
+        """
+        Adds a job to the ledger. A submission the model refused is recorded
+        already finished, with succeeded=False and no external_id. Jobs with
+        a forward_task_id are watched by the reconciler.
+        """
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            await db.execute(insert(kie_jobs_table).values(
+                external_id=external_id,
+                service_type=service_type,
+                model=model,
+                submitted_at=now,
+                finished_at=now if succeeded is not None else None,
+                succeeded=succeeded,
+                forward_task_id=forward_task_id,
+                checked_at=now if forward_task_id else None,
+            ))
+            await db.commit()
+
+    async def finish(self, outcomes: List[Tuple[str, bool]]) -> Dict[str, tuple]:
+        """
+        Records (external_id, succeeded) outcomes. Returns the (service_type,
+        model, submitted_at) of each job that was still running, with
+        submitted_at in epoch seconds; jobs finished before (a repeated
+        callback) are left out.
+        """
+        outcomes = [(external_id, succeeded) for external_id, succeeded in outcomes if external_id]
+        if not outcomes:
+            return {}
+        now = datetime.utcnow()
+        succeeded_by_id = dict(outcomes)
+        async with self.session_factory() as db:
+            running = (await db.execute(
+                select(kie_jobs_table.c.id, kie_jobs_table.c.external_id, kie_jobs_table.c.service_type,
+                       kie_jobs_table.c.model, kie_jobs_table.c.submitted_at)
+                .where(kie_jobs_table.c.external_id.in_(list(succeeded_by_id)), kie_jobs_table.c.finished_at.is_(None))
+                .with_for_update()
+            )).all()
+            finished = {}
+            for row in running:
+                # The guard leaves a job finished concurrently by another process alone
+                result = await db.execute(
+                    update(kie_jobs_table)
+                    .where(kie_jobs_table.c.id == row.id, kie_jobs_table.c.finished_at.is_(None))
+                    .values(finished_at=now, succeeded=succeeded_by_id[row.external_id])
+                )
+                if result.rowcount:
+                    finished[row.external_id] = (row.service_type, row.model, _epoch(row.submitted_at))
+            await db.commit()
+        return finished
+
+    async def claim_stale(self, checked_before: datetime, limit: int = 100):
+        """
+        Claims up to limit running forwarded jobs last checked before
+        checked_before, by bumping their checked_at, and returns their rows.
+        A job claimed by another process in the meantime is left out.
+        """
+        async with self.session_factory() as db:
+            job_ids = (await db.execute(
+                select(kie_jobs_table.c.id)
+                .where(kie_jobs_table.c.finished_at.is_(None), kie_jobs_table.c.checked_at < checked_before,
+                       kie_jobs_table.c.forward_task_id.is_not(None))
+                .order_by(kie_jobs_table.c.checked_at)
+                .limit(limit)
+            )).scalars().all()
+            if not job_ids:
+                return []
+            claimed_at = datetime.utcnow()
+            statement = (
+                update(kie_jobs_table)
+                .where(kie_jobs_table.c.id.in_(job_ids), kie_jobs_table.c.finished_at.is_(None),
+                       kie_jobs_table.c.checked_at < checked_before)
+                .values(checked_at=claimed_at)
+            )
+            if db.get_bind().dialect.update_returning:
+                rows = (await db.execute(statement.returning(*kie_jobs_table.c))).all()
+            else:
+                await db.execute(statement)
+                rows = (await db.execute(
+                    select(kie_jobs_table)
+                    .where(kie_jobs_table.c.id.in_(job_ids), kie_jobs_table.c.checked_at == claimed_at)
+                )).all()
+            await db.commit()
+        return rows
+
+    async def model_jobs(self, model: str, running_since: float, finished_limit: int):
+        """
+        Returns the submission times (epoch seconds, oldest first) of model's
+        running jobs submitted after running_since, and (succeeded, seconds)
+        for its last finished_limit jobs, oldest first; seconds is None for
+        refused submissions.
+        """
+        since = datetime.utcfromtimestamp(running_since)
+        async with self.session_factory() as db:
+            running = (await db.execute(
+                select(kie_jobs_table.c.submitted_at)
+                .where(kie_jobs_table.c.model == model, kie_jobs_table.c.finished_at.is_(None),
+                       kie_jobs_table.c.submitted_at >= since)
+                .order_by(kie_jobs_table.c.submitted_at)
+            )).scalars().all()
+            finished = (await db.execute(
+                select(kie_jobs_table.c.external_id, kie_jobs_table.c.succeeded,
+                       kie_jobs_table.c.submitted_at, kie_jobs_table.c.finished_at)
+                .where(kie_jobs_table.c.model == model, kie_jobs_table.c.finished_at.is_not(None))
+                .order_by(kie_jobs_table.c.finished_at.desc())
+                .limit(finished_limit)
+            )).all()
+        return [_epoch(submitted_at) for submitted_at in running], [
+            (bool(row.succeeded), (row.finished_at - row.submitted_at).total_seconds() if row.external_id else None)
+            for row in reversed(finished)
+        ]
+
+    async def prune(self, older_than: float) -> int:
+        """Forgets jobs submitted more than older_than seconds ago."""
+        cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+        async with self.session_factory() as db:
+            result = await db.execute(delete(kie_jobs_table).where(kie_jobs_table.c.submitted_at < cutoff))
+            await db.commit()
+        return result.rowcount
+
+
+job_ledger = KieJobLedger()
@@ -0,0 +1,373 @@
+import asyncio
+import os
+import random
+import socket
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+from app.core.config import settings
+from app.services.admission import PRIORITY_INTERACTIVE, WaitStats, current_priority, priority_name
+from app.services.metrics import job_queue_wait, job_run_duration
+from app.services.tracing import tracer
+from app.database import AsyncSessionLocal
+from app.models.models import Job, JobStatus
+
+# Claims, retries and completions are Core statements on the table, so each
+# is a single round-trip and never loads ORM objects.
+jobs_table = Job.__table__
+
+
+class PermanentJobError(Exception):
+    """Raised by a job handler for failures that retrying cannot fix."""
+
+
+class DeferJobError(Exception):
+    """
+    Raised by a job handler to put its job back for `delay` seconds without
+    using up an attempt, e.g. while an upstream's circuit breaker is open.
+    """
+    def __init__(self, message: str, delay: float):
+        super().__init__(message)
+        self.delay = delay
+
+
+class JobType:
+    def __init__(self, name: str, handler: Callable, on_failure: Optional[Callable], concurrency: int, max_attempts: int):
+        self.name = name
+        self.handler = handler
+        self.on_failure = on_failure
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+
+
+class JobQueue:
+    """
+    Persistent job queue stored in the application database.
+
+    Workers claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED on
+    PostgreSQL/MySQL; on SQLite the claim is a single UPDATE, which SQLite
+    serializes. A claim leases the job for JOB_VISIBILITY_TIMEOUT seconds;
+    if the worker dies the lease expires and another worker picks it up.
+    Failed jobs are retried with jittered exponential backoff.
+    """
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+        self.job_types = {}
+        self.waits = defaultdict(WaitStats)
+        self._wakeups = set()
+
+    def register(
+        self,
+        name: str,
+        handler: Callable,
+        on_failure: Optional[Callable] = None,
+        concurrency: Optional[int] = None,
+        max_attempts: Optional[int] = None,
+    ):
+        """
+        Registers an async handler(payload) for a job type. on_failure(payload,
+        error) runs once a job has used up its attempts.
+        """
+        self.job_types[name] = JobType(
+            name,
+            handler,
+            on_failure,
+            concurrency or settings.JOB_TYPE_CONCURRENCY.get(name, settings.JOB_WORKER_CONCURRENCY),
+            max_attempts or settings.JOB_MAX_ATTEMPTS,
+        )
+
+    async def enqueue(self, job_type: str, payload: dict, delay: float = 0, priority: int = PRIORITY_INTERACTIVE) -> int:
+        ids = await self.enqueue_many(job_type, [payload], delay, priority)
+        return ids[0]
+
+    async def enqueue_many(self, job_type: str, payloads: list, delay: float = 0, priority: int = PRIORITY_INTERACTIVE) -> list:
+        """Adds jobs in one transaction and returns their IDs. Lower priority values run first."""
+        if job_type not in self.job_types:
+            raise KeyError(f"No handler registered for job type '{job_type}'")
+        now = datetime.utcnow()
+        rows = [{
+            "job_type": job_type,
+            "payload": payload,
+            "status": JobStatus.QUEUED,
+            "priority": priority,
+            "attempts": 0,
+            "max_attempts": self.job_types[job_type].max_attempts,
+            "run_at": now + timedelta(seconds=delay),
+            "created_at": now,
+            "updated_at": now,
+        } for payload in payloads]
+        async with self.session_factory() as db:
+            if db.get_bind().dialect.insert_executemany_returning:
+                result = await db.execute(insert(jobs_table).returning(jobs_table.c.id), rows)
+                ids = list(result.scalars())
+            else:
+                ids = []
+                for row in rows:
+                    result = await db.execute(insert(jobs_table).values(**row))
+                    ids.append(result.inserted_primary_key[0])
+            await db.commit()
+        self.notify()
+        return ids
+
+    async def claim(self, job_type: str, limit: int, worker_id: str) -> list:
+        """Leases up to limit due jobs of a type to worker_id and returns them."""
+        now = datetime.utcnow()
+        claimable = and_(
+            jobs_table.c.job_type == job_type,
+            or_(
+                and_(jobs_table.c.status == JobStatus.QUEUED, jobs_table.c.run_at <= now),
+                and_(jobs_table.c.status == JobStatus.RUNNING, jobs_table.c.locked_until <= now),
+            ),
+        )
+        candidates = (
+            select(jobs_table.c.id)
+            .where(claimable)
+            .order_by(jobs_table.c.priority, jobs_table.c.run_at, jobs_table.c.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        values = dict(
+            status=JobStatus.RUNNING,
+            attempts=jobs_table.c.attempts + 1,
+            locked_by=worker_id,
+            locked_until=now + timedelta(seconds=settings.JOB_VISIBILITY_TIMEOUT),
+            updated_at=now,
+        )
+        columns = (
+            jobs_table.c.id, jobs_table.c.payload, jobs_table.c.priority,
+            jobs_table.c.attempts, jobs_table.c.max_attempts, jobs_table.c.run_at,
+        )
+        async with self.session_factory() as db:
+            dialect = db.get_bind().dialect
+            if dialect.update_returning:
+                statement = update(jobs_table).where(jobs_table.c.id.in_(candidates.scalar_subquery())).values(**values)
+                rows = (await db.execute(statement.returning(*columns))).all()
+            else:
+                # MySQL cannot UPDATE a table it selects from in a subquery
+                ids = list((await db.execute(candidates)).scalars())
+                rows = []
+                if ids:
+                    await db.execute(update(jobs_table).where(jobs_table.c.id.in_(ids)).values(**values))
+                    rows = (await db.execute(select(*columns).where(jobs_table.c.id.in_(ids)))).all()
+            await db.commit()
+        for row in rows:
+            if row.attempts == 1:
+                waited = max(0.0, (now - row.run_at).total_seconds())
+                self.waits[priority_name(row.priority)].record(waited)
+                job_queue_wait.observe(waited, job_type=job_type, priority=priority_name(row.priority))
+        return rows
+
+    async def depth(self, job_types: list) -> int:
+        """Number of queued jobs of the given types."""
+        async with self.session_factory() as db:
+            return await db.scalar(
+                select(func.count()).select_from(jobs_table)
+                .where(jobs_table.c.job_type.in_(job_types), jobs_table.c.status == JobStatus.QUEUED)
+            )
+
+    async def extend(self, ids: list, worker_id: str):
+        """Renews the leases of jobs worker_id is still running."""
+        if not ids:
+            return
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            await db.execute(
+                update(jobs_table)
+                .where(jobs_table.c.id.in_(ids), jobs_table.c.locked_by == worker_id)
+                .values(locked_until=now + timedelta(seconds=settings.JOB_VISIBILITY_TIMEOUT), updated_at=now)
+            )
+            await db.commit()
+
+    async def complete(self, job_id: int, worker_id: str):
+        async with self.session_factory() as db:
+            await db.execute(
+                delete(jobs_table).where(jobs_table.c.id == job_id, jobs_table.c.locked_by == worker_id)
+            )
+            await db.commit()
+
+    async def fail(self, job, error: Exception, worker_id: str, permanent: bool = False) -> bool:
+        """
+        Schedules a retry of a failed job, or parks it as DEAD when it is out
+        of attempts or the error is permanent. Returns True if the job is dead.
+        """
+        now = datetime.utcnow()
+        values = dict(locked_by=None, locked_until=None, last_error=(str(error) or error.__class__.__name__)[:1000], updated_at=now)
+        if isinstance(error, DeferJobError):
+            # Spread deferred jobs out so they do not all come back at once
+            values.update(status=JobStatus.QUEUED, attempts=job.attempts - 1,
+                          run_at=now + timedelta(seconds=error.delay * random.uniform(1.0, 1.5)))
+            dead = False
+        elif permanent or job.attempts >= job.max_attempts:
+            values["status"] = JobStatus.DEAD
+            dead = True
+        else:
+            dead = False
+            delay = min(settings.JOB_RETRY_MAX_DELAY, settings.JOB_RETRY_BASE_DELAY * 2 ** (job.attempts - 1))
+            values["status"] = JobStatus.QUEUED
+            values["run_at"] = now + timedelta(seconds=delay * random.uniform(0.5, 1.0))
+        async with self.session_factory() as db:
+            await db.execute(
+                update(jobs_table).where(jobs_table.c.id == job.id, jobs_table.c.locked_by == worker_id).values(**values)
+            )
+            await db.commit()
+        return dead
+
+    async def stats(self):
+        """Job counts and the age of the oldest job, per type, status and priority."""
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            rows = (await db.execute(
+                select(jobs_table.c.job_type, jobs_table.c.status, jobs_table.c.priority, func.count(), func.min(jobs_table.c.created_at))
+                .group_by(jobs_table.c.job_type, jobs_table.c.status, jobs_table.c.priority)
+            )).all()
+        stats = {}
+        for job_type, status, priority, count, oldest in rows:
+            stats.setdefault(job_type, {}).setdefault(status.value, {})[priority_name(priority)] = {
+                "count": count,
+                "oldest_age": round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+            }
+        return stats
+
+    def wait_stats(self):
+        """Time jobs spent queued before their first claim, per priority."""
+        return {priority: stats.snapshot() for priority, stats in self.waits.items()}
+
+    def notify(self):
+        """Wakes workers running in this process so new jobs start right away."""
+        for wakeup in list(self._wakeups):
+            wakeup.set()
+
+
+class JobWorker:
+    """
+    Async worker pool that runs queued jobs. At most `concurrency` jobs run
+    at once, and no more than each job type's own limit. Leases of running
+    jobs are renewed while they run.
+    """
+    def __init__(self, queue: JobQueue, job_types: Optional[list] = None, concurrency: Optional[int] = None, worker_id: Optional[str] = None):
+        self.queue = queue
+        self.job_types = job_types
+        self.concurrency = concurrency or settings.JOB_WORKER_CONCURRENCY
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.completed = 0
+        self.failed = 0
+        self._running = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self.queue._wakeups.add(self._wakeup)
+        self._task = asyncio.create_task(self._run())
+        print(f"JOBS: Worker {self.worker_id} started with concurrency {self.concurrency}.")
+
+    async def stop(self):
+        """
+        Stops claiming jobs and gives running ones JOB_SHUTDOWN_GRACE seconds
+        to finish. Jobs still running after that are cancelled; their leases
+        expire and another worker retries them.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._wakeup is not None:
+            self.queue._wakeups.discard(self._wakeup)
+        running = [task for task, _ in self._running.values()]
+        if running:
+            _, pending = await asyncio.wait(running, timeout=settings.JOB_SHUTDOWN_GRACE)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _run(self):
+        lease_interval = settings.JOB_VISIBILITY_TIMEOUT / 3
+        loop = asyncio.get_running_loop()
+        next_extend = loop.time() + lease_interval
+        while True:
+            try:
+                claimed = await self.poll_once()
+                if loop.time() >= next_extend:
+                    await self.queue.extend(list(self._running), self.worker_id)
+                    next_extend = loop.time() + lease_interval
+            except Exception as e:
+                print(f"JOBS: Worker error: {e}")
+                claimed = 0
+            if claimed:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=min(settings.JOB_POLL_INTERVAL, lease_interval))
+            except asyncio.TimeoutError:
+                pass
+
+    async def poll_once(self) -> int:
+        """Claims as many due jobs as there are free slots and starts them."""
+        claimed = 0
+        for job_type in self._job_types():
+            free = min(
+                self.concurrency - len(self._running),
+                job_type.concurrency - sum(1 for _, name in self._running.values() if name == job_type.name),
+            )
+            if free <= 0:
+                continue
+            for job in await self.queue.claim(job_type.name, free, self.worker_id):
+                task = asyncio.create_task(self._execute(job_type, job))
+                self._running[job.id] = (task, job_type.name)
+                claimed += 1
+        return claimed
+
+    def _job_types(self):
+        names = self.job_types or list(self.queue.job_types)
+        return [self.queue.job_types[name] for name in names]
+
+    async def _execute(self, job_type: JobType, job):
+        current_priority.set(job.priority)
+        started = time.perf_counter()
+        try:
+            if job.attempts > job.max_attempts:
+                # The job's lease kept expiring, e.g. because it crashed its worker.
+                raise PermanentJobError(f"Lease expired on all {job.max_attempts} attempts")
+            with tracer.span(f"job {job_type.name}", job_id=job.id, attempt=job.attempts):
+                await job_type.handler(job.payload)
+        except Exception as e:
+            job_run_duration.observe(time.perf_counter() - started, job_type=job_type.name, outcome="failed")
+            self.failed += 1
+            permanent = isinstance(e, PermanentJobError)
+            try:
+                dead = await self.queue.fail(job, e, self.worker_id, permanent)
+                print(f"JOBS: {job_type.name} job {job.id} failed (attempt {job.attempts}): {e}")
+                if dead and job_type.on_failure is not None:
+                    await job_type.on_failure(job.payload, e)
+            except Exception as hook_error:
+                print(f"JOBS: Could not record failure of {job_type.name} job {job.id}: {hook_error}")
+        else:
+            job_run_duration.observe(time.perf_counter() - started, job_type=job_type.name, outcome="completed")
+            self.completed += 1
+            try:
+                await self.queue.complete(job.id, self.worker_id)
+            except Exception as e:
+                print(f"JOBS: Could not mark {job_type.name} job {job.id} complete: {e}")
+        finally:
+            self._running.pop(job.id, None)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def stats(self):
+        return {
+            "worker_id": self.worker_id,
+            "running": len(self._running),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+job_queue = JobQueue()
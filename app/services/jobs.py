@@ -0,0 +1,190 @@
+import asyncio
+import httpx
+from sqlalchemy.exc import SQLAlchemyError
+from app import crud
+from app.core.config import settings
+from app.database import AsyncSessionLocal
+from app.models.models import TaskStatus
+from app.services import ai_services, service
+from app.services.admission import AdmissionController, kie_rate_limiter
+from app.services.dedup import generation_dedup, make_generation_key, CACHED, JOINED
+from app.services.job_queue import job_queue, DeferJobError, PermanentJobError
+from app.services.kie_client import KieSubmissionError
+from app.services.media_cache import MEDIA_INGEST, media_cache
+from app.services.model_router import model_router
+from app.services.resilience import CircuitOpenError, upstream_stats
+from app.services.task_events import task_events
+
+# Job types handled by the worker pool
+KIE_SUBMIT = "kie_submit"            # forwards results to the main backend (endpoints1)
+TASK_GENERATION = "task_generation"  # tracks results in the tasks table (endpoints)
+
+
+def _is_permanent(error: Exception) -> bool:
+    """Bad requests and unusable responses fail the same way on every retry."""
+    if isinstance(error, (KieSubmissionError, ValueError, KeyError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return 400 <= status_code < 500 and status_code not in (408, 429)
+    return False
+
+
+async def _retrying(submit, *args):
+    try:
+        return await submit(*args)
+    except CircuitOpenError as e:
+        # Wait out the open breaker without spending the job's attempts
+        raise DeferJobError(str(e), e.retry_after) from e
+    except Exception as e:
+        if _is_permanent(e):
+            raise PermanentJobError(str(e) or e.__class__.__name__) from e
+        raise
+
+
+async def _persisting(write, **kwargs):
+    """
+    Runs a crud write that records a job Kie.ai already accepted. The write
+    is retried on its own, each time in a fresh session, so a database
+    hiccup does not make the job queue submit (and pay for) the job again.
+    """
+    for attempt in range(1, settings.JOB_PERSIST_MAX_ATTEMPTS + 1):
+        try:
+            async with AsyncSessionLocal() as db:
+                return await write(db, **kwargs)
+        except SQLAlchemyError as e:
+            if attempt == settings.JOB_PERSIST_MAX_ATTEMPTS:
+                raise
+            print(f"JOBS: {write.__name__} failed (attempt {attempt}), retrying: {e}")
+            await asyncio.sleep(min(settings.JOB_RETRY_MAX_DELAY, settings.JOB_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+# --- Kie.ai submissions for the main backend ---
+
+async def run_kie_submit(payload: dict):
+    await _retrying(service.submit_kie_job, payload["prompt"], payload["internal_task_id"], payload["service_type"], payload.get("quality"))
+
+
+async def fail_kie_submit(payload: dict, error: Exception):
+    await service.fail_kie_job(payload["prompt"], payload["internal_task_id"], payload["service_type"], error, payload.get("quality"))
+
+
+# --- Kie.ai submissions tracked in the tasks table ---
+
+def _generation_request(payload: dict):
+    quality = payload.get("quality") or settings.MODEL_ROUTER_DEFAULT_QUALITY
+    key = make_generation_key(payload["prompt"], payload["service_type"], quality)
+    if payload["service_type"] == "video":
+        return key, ai_services.generate_video_from_prompt
+    return key, ai_services.generate_image_from_prompt_async
+
+
+async def run_task_generation(payload: dict):
+    """
+    Submits a generation job unless an identical one is already in flight
+    (the task then waits for that job's callback) or finished recently (the
+    task completes immediately with the cached result).
+    """
+    task_id, prompt = payload["task_id"], payload["prompt"]
+    key, submit = _generation_request(payload)
+    async with AsyncSessionLocal() as db:
+        role, value = generation_dedup.claim(key, task_id)
+        if role == CACHED:
+            await crud.update_task_async(db, task_id=task_id, status=TaskStatus.COMPLETED, result_url=value)
+            print(f"Task {task_id}: Completed from the result cache.")
+            return
+        if role == JOINED:
+            # The follower takes the leader's external_id, so the callback
+            # completes it in whichever process receives it
+            [db_task] = await crud.join_tasks_async(db, leader_task_id=value, task_ids=[task_id])
+            if db_task.status != TaskStatus.PROCESSING:
+                # The leader's callback was handled by another process; close
+                # the flight here so new requests do not join a finished job
+                generation_dedup.complete(db_task.result_url, db_task.status == TaskStatus.COMPLETED, task_id=value)
+                print(f"Task {task_id}: Took the outcome of an identical finished job.")
+                return
+            print(f"Task {task_id}: Joined an identical in-flight job.")
+            return
+
+        if value is None:
+            await crud.update_task_async(db, task_id=task_id, status=TaskStatus.PROCESSING)
+
+            kie_task_id = await _retrying(submit, prompt, payload.get("quality"))
+            # Bound before anything can fail, so a retry of this job in this
+            # process links the job Kie.ai accepted instead of submitting again
+            generation_dedup.bind_external(key, kie_task_id)
+        else:
+            kie_task_id = value
+            print(f"Task {task_id}: Linking the Kie.ai job {kie_task_id} submitted by an earlier attempt.")
+
+    await _persisting(crud.link_task_ids_async, internal_task_id=task_id, external_task_id=kie_task_id,
+                      service_type=payload["service_type"], model=model_router.model_for(kie_task_id))
+    # Followers that joined before the leader's row had its external_id
+    await _persisting(crud.join_tasks_async, leader_task_id=task_id, task_ids=generation_dedup.followers(key))
+
+    print(f"Task {task_id}: Job successfully submitted to Kie.ai and linked with their Task ID: {kie_task_id}.")
+
+
+async def fail_task_generation(payload: dict, error: Exception):
+    task_id = payload["task_id"]
+    key, _ = _generation_request(payload)
+    async with AsyncSessionLocal() as db:
+        await crud.update_tasks_async(db, [
+            {"task_id": failed_id, "status": TaskStatus.FAILED, "result_url": str(error)}
+            for failed_id in [task_id, *generation_dedup.abandon(key)]
+        ])
+    print(f"Task {task_id}: Failed during submission. Error: {error}")
+
+
+# --- Local copies of generated media ---
+
+async def run_media_ingest(payload: dict):
+    entry = await _retrying(media_cache.ingest, payload["url"])
+    media_url = media_cache.url_for(entry.hash)
+    if payload.get("forward"):
+        for task_id in payload["task_ids"]:
+            await service.forward_result(task_id, "completed", media_url)
+            task_events.publish({"id": task_id, "status": "completed", "result_url": media_url})
+    else:
+        async with AsyncSessionLocal() as db:
+            await crud.update_tasks_async(db, [
+                {"task_id": task_id, "status": TaskStatus.COMPLETED, "result_url": media_url} for task_id in payload["task_ids"]
+            ])
+    print(f"MEDIA: Cached {payload['url']} as {entry.hash} ({entry.size} bytes) for {len(payload['task_ids'])} task(s).")
+
+
+async def fail_media_ingest(payload: dict, error: Exception):
+    # The tasks keep Kie.ai's link; nothing else to undo
+    print(f"MEDIA: Could not cache {payload['url']}, keeping the Kie.ai link. Error: {error}")
+
+
+job_queue.register(KIE_SUBMIT, run_kie_submit, on_failure=fail_kie_submit)
+job_queue.register(TASK_GENERATION, run_task_generation, on_failure=fail_task_generation)
+job_queue.register(MEDIA_INGEST, run_media_ingest, on_failure=fail_media_ingest)
+
+
+async def _queued_submissions() -> int:
+    return await job_queue.depth([KIE_SUBMIT, TASK_GENERATION])
+
+
+# Admission control for generation requests, shared by both routers
+submission_admission = AdmissionController(
+    depth_source=_queued_submissions,
+    user_rate=settings.ADMISSION_USER_RATE,
+    user_burst=settings.ADMISSION_USER_BURST,
+    max_queued=settings.ADMISSION_MAX_QUEUED,
+    max_queued_bulk=settings.ADMISSION_MAX_QUEUED_BULK,
+    drain_rate=settings.ADMISSION_GLOBAL_RATE,
+    max_users=settings.ADMISSION_MAX_TRACKED_USERS,
+)
+
+
+async def admission_stats():
+    return {
+        "admission": submission_admission.stats(),
+        "kie_rate_limiter": kie_rate_limiter.stats(),
+        "queue": await job_queue.stats(),
+        "queue_wait_seconds": job_queue.wait_stats(),
+        "upstreams": upstream_stats(),
+        "models": await model_router.stats(),
+    }
@@ -0,0 +1,174 @@
+import time
+from collections import deque
+from typing import Optional
+import httpx
+from app.core.config import settings
+from app.services.admission import current_priority, kie_rate_limiter
+from app.services.metrics import kie_request_duration
+from app.services.tracing import tracer
+from app.services.providers import providers
+from app.services.resilience import is_unsent, kie_upstream
+
+
+class KieSubmissionError(Exception):
+    """Raised when Kie.ai accepts a request but does not hand back a usable job ID."""
+
+
+class KieClientMetrics:
+    """
+    Per-call counters for the shared Kie.ai client.
+    """
+    def __init__(self, history_size: int = 100):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.recent = deque(maxlen=history_size)
+
+    def record(self, path: str, status_code: Optional[int], elapsed: float, error: Optional[str] = None):
+        self.calls += 1
+        if error or status_code is None or status_code >= 400:
+            self.errors += 1
+        self.total_latency += elapsed
+        self.max_latency = max(self.max_latency, elapsed)
+        self.recent.append({
+            "path": path,
+            "status_code": status_code,
+            "elapsed": round(elapsed, 4),
+            "error": error,
+        })
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "avg_latency": round(self.total_latency / self.calls, 4) if self.calls else 0.0,
+            "max_latency": round(self.max_latency, 4),
+            "recent": list(self.recent),
+        }
+
+
+class KieClient:
+    """
+    Long-lived, connection-pooled async client for the Kie.ai job API.
+
+    One instance is shared by the whole process, so every video and image
+    submission reuses keep-alive HTTP/2 connections instead of opening a new
+    TCP/TLS session, and never blocks the event loop.
+    """
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        http2: bool = True,
+    ):
+        self.base_url = base_url or settings.KIE_API_ROOT
+        self.api_key = api_key or settings.KIE_API_KEY
+        self.timeout = httpx.Timeout(
+            timeout or settings.KIE_HTTP_TIMEOUT,
+            connect=connect_timeout or settings.KIE_HTTP_CONNECT_TIMEOUT,
+        )
+        self.limits = httpx.Limits(
+            max_connections=max_connections or settings.KIE_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=max_keepalive_connections or settings.KIE_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=keepalive_expiry or settings.KIE_HTTP_KEEPALIVE_EXPIRY,
+        )
+        self.http2 = http2
+        self.metrics = KieClientMetrics()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created on first use so importing this module never opens sockets.
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                timeout=self.timeout,
+                limits=self.limits,
+                http2=self.http2,
+            )
+        return self._client
+
+    async def post(self, path: str, payload: dict) -> dict:
+        """
+        POSTs a JSON payload to a Kie.ai endpoint and returns the decoded body.
+        Raises httpx.HTTPStatusError for non-2xx responses. Calls are paced by
+        the process-wide Kie.ai rate limiter, highest priority first.
+
+        A POST may start a paid job, so it is only retried when Kie.ai cannot
+        have received it, and never hedged. CircuitOpenError is raised while
+        Kie.ai keeps failing.
+        """
+        return await kie_upstream.call(self._request, "POST", path, retry_if=is_unsent,
+                                       operation=f"POST {path}", gate=self._pace, json=payload)
+
+    async def get(self, path: str, params: dict) -> dict:
+        """
+        GETs a Kie.ai endpoint (e.g. a task record) and returns the decoded
+        body. Reads are retried and hedged when slower than usual.
+        """
+        return await kie_upstream.call(self._request, "GET", path, hedge=True,
+                                       operation=f"GET {path}", gate=self._pace, params=params)
+
+    async def _pace(self):
+        # Awaited by the upstream before each attempt, so a call's measured
+        # latency leaves out the time spent waiting for the rate limiter
+        await kie_rate_limiter.acquire(current_priority.get())
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        status_code = None
+        error = None
+        self.metrics.in_flight += 1
+        started = time.perf_counter()
+        with tracer.span(f"kie {method} {path}", path=path) as span:
+            try:
+                response = await self.client.request(method, path, **kwargs)
+                status_code = response.status_code
+                span.set(status_code=status_code)
+                if status_code != 200:
+                    print(f"KIE CLIENT: ERROR - Kie.ai returned status {status_code} for {path}")
+                    print(f"KIE CLIENT: Response Body: {response.text}")
+                response.raise_for_status()
+                return response.json()
+            except Exception as e:
+                error = str(e) or e.__class__.__name__
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                self.metrics.in_flight -= 1
+                self.metrics.record(path, status_code, elapsed, error)
+                kie_request_duration.observe(elapsed, method=method, path=path, status=status_code or "error")
+
+    async def submit(self, path: str, payload: dict) -> str:
+        """
+        Submits a generation job and returns the Kie.ai task ID.
+        """
+        response_data = await self.post(path, payload)
+        data_dict = response_data.get("data") or {}
+        job_id = data_dict.get("taskId")
+        if not job_id:
+            raise KieSubmissionError("API reported success but did not return a recognizable job ID.")
+        return job_id
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+
+providers.register("kie", KieClient, close=KieClient.aclose)
+
+
+def get_kie_client() -> KieClient:
+    return providers.get("kie")
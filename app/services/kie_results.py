@@ -0,0 +1,194 @@
+import json
+from datetime import timezone
+from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import crud
+from app.database import AsyncSessionLocal
+from app.models.models import TaskStatus
+from app.services.callback_inbox import CallbackRow, callback_inbox, callback_processor
+from app.services.model_router import model_router
+from app.services.dedup import generation_dedup
+from app.services.metrics import submission_clock
+from app.services.media_cache import schedule_ingest
+
+# Inbox kind of webhooks that update task rows (the endpoints router)
+TASK_CALLBACK = "task"
+
+# States of a Kie.ai job
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# successFlag / status values reported by the record-info endpoints
+_SUCCESS_FLAGS = {1}
+_FAILURE_FLAGS = {2, 3}
+_SUCCESS_STATUSES = {"SUCCESS"}
+_FAILURE_STATUSES = {"CREATE_TASK_FAILED", "GENERATE_FAILED"}
+# state values reported by Runway's record-detail endpoint
+_SUCCESS_STATES = {"success"}
+_FAILURE_STATES = {"fail"}
+
+
+class KieOutcome:
+    """The state of one Kie.ai job, from a webhook or a task-record lookup."""
+    def __init__(self, external_id: str, state: str, result_url: Optional[str] = None, error: Optional[str] = None):
+        self.external_id = external_id
+        self.state = state
+        self.result_url = result_url
+        self.error = error
+
+
+def _result_urls(container: dict):
+    urls = container.get("resultUrls") or container.get("result_urls")
+    if urls and isinstance(urls, list):
+        return urls
+    # Single-result models: Flux Kontext images and Runway videos
+    for key in ("resultImageUrl", "video_url", "videoUrl"):
+        if container.get(key):
+            return [container[key]]
+    return None
+
+
+def callback_task_id(callback_body: dict) -> Optional[str]:
+    """Kie.ai's task ID in a webhook body (Runway spells it task_id)."""
+    data = callback_body.get("data") or {}
+    return data.get("taskId") or data.get("task_id")
+
+
+def callback_result_url(callback_body: dict) -> Optional[str]:
+    """The first result URL of a webhook body, or None."""
+    data = callback_body.get("data") or {}
+    result_urls = _result_urls(data.get("info") or data)
+    return result_urls[0] if result_urls else None
+
+
+def record_paths(service_type: Optional[str], model: Optional[str]) -> List[str]:
+    """
+    The record endpoints to ask about a job: its model's, or for jobs from
+    before model routing, those of every model of its service type.
+    """
+    backend = model_router.get(model)
+    if backend is not None:
+        return [backend.record_path]
+    backends = model_router.backends(service_type if service_type in ("video", "image") else None, enabled_only=False)
+    return list(dict.fromkeys(backend.record_path for backend in backends))
+
+
+def parse_callback(callback_body: dict) -> KieOutcome:
+    """
+    Reads a Kie.ai webhook body. Raises ValueError when a success callback
+    does not carry what we need.
+    """
+    if callback_body.get("code") != 200:
+        return KieOutcome(callback_task_id(callback_body), FAILED, error=str(callback_body.get("msg", "Unknown error from callback")))
+
+    if not callback_body.get("data"):
+        raise ValueError("Callback data does not contain a 'data' field.")
+
+    external_task_id = callback_task_id(callback_body)
+    if not external_task_id:
+        raise ValueError("Callback 'data' object does not contain a 'taskId'.")
+
+    result_url = callback_result_url(callback_body)
+    if not result_url:
+        raise ValueError("Callback does not contain a valid result URL.")
+
+    return KieOutcome(external_task_id, SUCCEEDED, result_url=result_url)
+
+
+def parse_record(external_id: str, record_body: dict) -> KieOutcome:
+    """
+    Reads a record-info response. Jobs that are still generating come back
+    as RUNNING. Raises ValueError when Kie.ai has no usable record.
+    """
+    data = record_body.get("data")
+    if record_body.get("code") != 200 or not data:
+        raise ValueError(f"Kie.ai returned no record for {external_id}: {record_body.get('msg')}")
+
+    flag = data.get("successFlag")
+    status = data.get("status")
+    state = data.get("state")
+    if flag in _SUCCESS_FLAGS or status in _SUCCESS_STATUSES or state in _SUCCESS_STATES:
+        result_urls = (_result_urls(data.get("response") or {}) or _result_urls(data.get("info") or {})
+                       or _result_urls(data.get("videoInfo") or {}))
+        if result_urls:
+            return KieOutcome(external_id, SUCCEEDED, result_url=result_urls[0])
+        return KieOutcome(external_id, FAILED, error="Kie.ai reported success without result URLs")
+    if flag in _FAILURE_FLAGS or status in _FAILURE_STATUSES or state in _FAILURE_STATES:
+        error = data.get("errorMessage") or data.get("failMsg") or record_body.get("msg") or "Generation failed"
+        return KieOutcome(external_id, FAILED, error=error)
+    return KieOutcome(external_id, RUNNING)
+
+
+async def apply_outcome(db: AsyncSession, outcome: KieOutcome, source: str = "callback"):
+    """
+    Writes a finished Kie.ai job to its task and to every identical request
+    that joined it, in one transaction. Returns the updated task rows.
+    source says who found the result (callback or reconciler), for metrics.
+    Only PROCESSING tasks are updated: a late or repeated outcome never
+    overwrites a result that was already recorded.
+    """
+    return await apply_outcomes(db, [outcome], source)
+
+
+async def apply_outcomes(db: AsyncSession, outcomes: List[KieOutcome], source: str = "callback"):
+    """apply_outcome for several finished jobs, still in one transaction."""
+    updates, succeeded_jobs = [], []
+    for outcome in outcomes:
+        succeeded = outcome.state == SUCCEEDED
+        status = TaskStatus.COMPLETED if succeeded else TaskStatus.FAILED
+        result_url = outcome.result_url if succeeded else f"Error: {outcome.error}"
+
+        if outcome.external_id:
+            updates.append({"external_id": outcome.external_id, "status": status, "result_url": result_url})
+        follower_ids = generation_dedup.complete(outcome.result_url, success=succeeded, external_id=outcome.external_id)
+        for follower_id in follower_ids:
+            updates.append({"task_id": follower_id, "status": status, "result_url": result_url})
+        if succeeded:
+            succeeded_jobs.append((outcome, set(follower_ids)))
+
+    db_tasks = await crud.update_tasks_async(db, updates, only_status=TaskStatus.PROCESSING)
+    # Timed from the submitting task's row; an outcome that changed nothing
+    # was already counted
+    submitted = {db_task.external_id: db_task for db_task in db_tasks if db_task.submitted_at is not None}
+    await model_router.finished([(outcome.external_id, outcome.state == SUCCEEDED) for outcome in outcomes if outcome.external_id in submitted])
+    for outcome in outcomes:
+        db_task = submitted.get(outcome.external_id)
+        if db_task is not None:
+            submission_clock.finished(outcome.external_id, outcome.state, source,
+                                      submitted_at=db_task.submitted_at.replace(tzinfo=timezone.utc).timestamp(),
+                                      service_type=db_task.service_type)
+    for outcome, follower_ids in succeeded_jobs:
+        task_ids = [db_task.id for db_task in db_tasks if db_task.external_id == outcome.external_id or db_task.id in follower_ids]
+        await schedule_ingest(outcome.result_url, task_ids)
+    return db_tasks
+
+
+async def accept_callback(raw_body: bytes) -> bool:
+    """
+    Validates a webhook and records it in the callback inbox. Returns False
+    when Kie.ai already delivered it; raises ValueError if it is malformed
+    and InboxBusyError if the inbox could not take it right now.
+    """
+    try:
+        outcome = parse_callback(json.loads(raw_body))
+    except AttributeError:
+        raise ValueError("Callback body is not a JSON object.")
+    if not outcome.external_id:
+        raise ValueError("Callback does not contain a 'taskId'.")
+    return await callback_inbox.accept(TASK_CALLBACK, outcome.external_id, outcome.state, raw_body.decode())
+
+
+async def process_callbacks(rows: List[CallbackRow]):
+    """Applies a batch of webhooks from the inbox to their tasks."""
+    outcomes = [parse_callback(row.body) for row in rows]
+    async with AsyncSessionLocal() as db:
+        db_tasks = await apply_outcomes(db, outcomes)
+    found = {db_task.external_id for db_task in db_tasks}
+    for outcome in outcomes:
+        if outcome.external_id not in found:
+            print(f"CALLBACK: No unfinished task found in our database with external_id: {outcome.external_id}")
+        elif outcome.state == SUCCEEDED:
+            print(f"CALLBACK SUCCESS: Updated task for '{outcome.external_id}' with URL '{outcome.result_url}'")
+
+callback_processor.register(TASK_CALLBACK, process_callbacks)
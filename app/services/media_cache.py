@@ -0,0 +1,272 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Optional
+import httpx
+from fastapi import Request
+from fastapi.responses import FileResponse, RedirectResponse, Response
+from app.core.config import settings
+from app.services.admission import PRIORITY_BACKGROUND
+from app.services.job_queue import job_queue
+from app.services.providers import providers
+
+# Job type that copies a finished result into the cache
+MEDIA_INGEST = "media_ingest"
+
+_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# Accessed-at timestamps are only rewritten this often, so scrubbing through
+# a video (many Range requests) does not turn into a write per request.
+_TOUCH_INTERVAL = 60.0
+
+
+class MediaEntry:
+    """Cached media; path is None once the file was evicted."""
+    def __init__(self, media_hash: str, size: int, content_type: str, path: Optional[str], source_url: Optional[str] = None):
+        self.hash = media_hash
+        self.size = size
+        self.content_type = content_type
+        self.path = path
+        self.source_url = source_url
+
+
+def _create_download_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(timeout=settings.MEDIA_INGEST_TIMEOUT, follow_redirects=True)
+
+providers.register("media_download", _create_download_client, close=lambda client: client.aclose())
+
+
+class MediaCache:
+    """
+    Content-addressed store for generated videos and images.
+
+    Results are streamed from Kie.ai's CDN to disk chunk by chunk while being
+    hashed, then moved to <root>/<hash[:2]>/<hash>, so identical media is
+    stored once. A SQLite index next to the files tracks size, content type,
+    source URL and last access; once the store grows past max_bytes the
+    least recently used files are deleted. An evicted file's row is kept, so
+    the /media URLs already handed out redirect to the source URL instead
+    of breaking.
+    """
+    def __init__(self, root: str, max_bytes: int, max_file_bytes: int, chunk_size: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.chunk_size = chunk_size
+        self.ingested = 0
+        self.reused = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(self.root, "index.sqlite3"), check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS media ("
+                " hash TEXT PRIMARY KEY,"
+                " size INTEGER NOT NULL,"
+                " content_type TEXT NOT NULL,"
+                " source_url TEXT,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(media)")}
+            if "evicted_at" not in columns:
+                self._conn.execute("ALTER TABLE media ADD COLUMN evicted_at REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_media_accessed_at ON media (accessed_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_media_source_url ON media (source_url)")
+            self._conn.commit()
+        return self._conn
+
+    def path_for(self, media_hash: str) -> str:
+        return os.path.join(self.root, media_hash[:2], media_hash)
+
+    def url_for(self, media_hash: str) -> str:
+        base_url = settings.MEDIA_PUBLIC_BASE_URL or f"{settings.PUBLIC_SERVER_URL}/api/v1/media"
+        return f"{base_url.rstrip('/')}/{media_hash}"
+
+    def get(self, media_hash: str) -> Optional[MediaEntry]:
+        """
+        Looks up cached media and marks it as recently used. Evicted media
+        comes back without a path.
+        """
+        if not _HASH_PATTERN.match(media_hash):
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT size, content_type, source_url, evicted_at FROM media WHERE hash = ?", (media_hash,)
+            ).fetchone()
+            if row is None:
+                return None
+            size, content_type, source_url, evicted_at = row
+            path = self.path_for(media_hash)
+            if evicted_at is None and not os.path.exists(path):
+                # The file was removed behind our back
+                conn.execute("UPDATE media SET evicted_at = ? WHERE hash = ?", (now, media_hash))
+                conn.commit()
+                evicted_at = now
+            if evicted_at is not None:
+                return MediaEntry(media_hash, size, content_type, None, source_url)
+            cursor = conn.execute(
+                "UPDATE media SET accessed_at = ? WHERE hash = ? AND accessed_at < ?",
+                (now, media_hash, now - _TOUCH_INTERVAL),
+            )
+            if cursor.rowcount:
+                conn.commit()
+        return MediaEntry(media_hash, size, content_type, path, source_url)
+
+    def _find_source(self, url: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection().execute("SELECT hash FROM media WHERE source_url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    async def ingest(self, url: str) -> MediaEntry:
+        """
+        Downloads url into the store unless it is already there. Raises
+        ValueError for files over max_file_bytes and httpx errors for failed
+        downloads; partial downloads are discarded.
+        """
+        known_hash = self._find_source(url)
+        if known_hash is not None:
+            entry = self.get(known_hash)
+            if entry is not None and entry.path is not None:
+                self.reused += 1
+                return entry
+
+        self._connection()
+        temp_path = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with providers.get("media_download").stream("GET", url) as response:
+                response.raise_for_status()
+                content_type = response.headers.get("content-type", "").split(";")[0].strip()
+                declared = response.headers.get("content-length")
+                if declared and int(declared) > self.max_file_bytes:
+                    raise ValueError(f"{url} is {declared} bytes, over the {self.max_file_bytes}-byte limit")
+                with open(temp_path, "wb") as out:
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        size += len(chunk)
+                        if size > self.max_file_bytes:
+                            raise ValueError(f"{url} is over the {self.max_file_bytes}-byte limit")
+                        digest.update(chunk)
+                        await asyncio.to_thread(out.write, chunk)
+            content_type = content_type or mimetypes.guess_type(url.split("?")[0])[0] or "application/octet-stream"
+            media_hash = digest.hexdigest()
+            await asyncio.to_thread(self._store, temp_path, media_hash, size, content_type, url)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.ingested += 1
+        return MediaEntry(media_hash, size, content_type, self.path_for(media_hash), url)
+
+    def _store(self, temp_path: str, media_hash: str, size: int, content_type: str, url: str):
+        path = self.path_for(media_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Identical content may already be stored under another source URL
+        if not os.path.exists(path):
+            os.replace(temp_path, path)
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            # The first source URL is kept: it is where /media/{hash}
+            # redirects once the file is evicted
+            conn.execute(
+                "INSERT INTO media (hash, size, content_type, source_url, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (hash) DO UPDATE SET accessed_at = excluded.accessed_at, evicted_at = NULL,"
+                " source_url = COALESCE(media.source_url, excluded.source_url)",
+                (media_hash, size, content_type, url, now, now),
+            )
+            self._evict(conn, keep=media_hash)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection, keep: str):
+        total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM media WHERE evicted_at IS NULL").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        rows = conn.execute(
+            "SELECT hash, size FROM media WHERE evicted_at IS NULL AND hash != ? ORDER BY accessed_at", (keep,)
+        ).fetchall()
+        now = time.time()
+        for media_hash, size in rows:
+            if total_bytes <= self.max_bytes:
+                break
+            conn.execute("UPDATE media SET evicted_at = ? WHERE hash = ?", (now, media_hash))
+            try:
+                os.remove(self.path_for(media_hash))
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            total_bytes, entries = self._connection().execute(
+                "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM media WHERE evicted_at IS NULL"
+            ).fetchone()
+        return {
+            "ingested": self.ingested,
+            "reused": self.reused,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+media_cache = MediaCache(
+    root=settings.MEDIA_CACHE_DIR,
+    max_bytes=settings.MEDIA_CACHE_MAX_BYTES,
+    max_file_bytes=settings.MEDIA_CACHE_MAX_FILE_BYTES,
+    chunk_size=settings.MEDIA_INGEST_CHUNK_SIZE,
+)
+
+
+async def schedule_ingest(url: str, task_ids: List[str], forward: bool = False):
+    """
+    Queues a copy of a finished result into the cache. Once it is stored the
+    tasks' result_url points at /media/{hash}; with forward=True the new URL
+    is also sent to the main backend. No-op unless MEDIA_CACHE_ENABLED.
+    """
+    if not settings.MEDIA_CACHE_ENABLED or not url or not task_ids:
+        return
+    await job_queue.enqueue(
+        MEDIA_INGEST, {"url": url, "task_ids": list(task_ids), "forward": forward}, priority=PRIORITY_BACKGROUND
+    )
+
+
+async def media_response(request: Request, media_hash: str) -> Response:
+    """
+    Serves cached media. The ETag is the content hash, so revalidation is a
+    cheap 304 and the file can be cached forever. FileResponse answers Range
+    and If-Range requests, and hands the file to the server for zero-copy
+    sending when the ASGI server supports the pathsend extension (Granian,
+    Hypercorn); under uvicorn it is streamed in chunks from a thread.
+    Evicted media redirects to the URL it was copied from. The cache lookup
+    reads (and may update) its SQLite index, so it runs in a worker thread.
+    """
+    entry = await asyncio.to_thread(media_cache.get, media_hash)
+    if entry is not None and entry.path is None and entry.source_url:
+        return RedirectResponse(entry.source_url, status_code=307)
+    if entry is None or entry.path is None:
+        return Response(status_code=404, content="Media not found")
+    headers = {"ETag": f'"{entry.hash}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or headers["ETag"] in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(entry.path, media_type=entry.content_type, headers=headers)
@@ -0,0 +1,272 @@
+import functools
+import inspect
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from app.services.tracing import tracer
+
+# Latency buckets in seconds, from fast DB queries to slow generation jobs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+SIZE_BUCKETS = (10, 100, 1000, 5000, 10000, 50000, 100000, 500000, 1000000)
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key: tuple, value) -> list:
+        return [f"{self.name}{self._labels(key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def replace(self, samples: dict):
+        """Replaces every series at once; samples maps label dicts (as tuples of items) to values."""
+        with self._lock:
+            self._values = {self._key(dict(labels)): value for labels, value in samples.items()}
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_sample(self, key: tuple, state) -> list:
+        counts, total, count = state
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket{self._labels(key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(key)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds the process's metrics and renders them in Prometheus text format."""
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ("method", "route", "status"))
+kie_request_duration = registry.histogram(
+    "kie_request_duration_seconds", "Kie.ai API call latency.", ("method", "path", "status"))
+kie_job_duration = registry.histogram(
+    "kie_job_duration_seconds", "Time from Kie.ai submission to the job's result.", ("service_type", "outcome", "source"))
+gemini_request_duration = registry.histogram(
+    "gemini_request_duration_seconds", "Gemini generation latency.", ("model", "operation", "outcome"))
+gemini_tokens = registry.counter(
+    "gemini_tokens_total", "Gemini tokens used.", ("model", "operation", "kind"))
+gemini_request_tokens = registry.histogram(
+    "gemini_request_tokens", "Gemini tokens per request.", ("model", "operation", "kind"), buckets=SIZE_BUCKETS)
+drive_upload_duration = registry.histogram(
+    "drive_upload_duration_seconds", "Drive upload duration.", ("method", "outcome"))
+drive_upload_bytes = registry.counter(
+    "drive_upload_bytes_total", "Bytes uploaded to Drive.", ("method",))
+drive_upload_throughput = registry.histogram(
+    "drive_upload_throughput_bytes_per_second", "Per-upload Drive throughput.", ("method",), buckets=THROUGHPUT_BUCKETS)
+db_query_duration = registry.histogram(
+    "db_query_duration_seconds", "Time spent in each crud function.", ("function",))
+job_queue_wait = registry.histogram(
+    "job_queue_wait_seconds", "Time jobs spent queued before their first claim.", ("job_type", "priority"))
+job_run_duration = registry.histogram(
+    "job_run_duration_seconds", "Job handler run time.", ("job_type", "outcome"))
+job_queue_depth = registry.gauge(
+    "job_queue_jobs", "Jobs in the queue.", ("job_type", "status", "priority"))
+job_queue_oldest_age = registry.gauge(
+    "job_queue_oldest_job_age_seconds", "Age of the oldest job in the queue.", ("job_type", "status", "priority"))
+outbox_depth = registry.gauge(
+    "outbox_results", "Results waiting in the main-backend outbox.", ("status",))
+outbox_oldest_age = registry.gauge(
+    "outbox_oldest_result_age_seconds", "Age of the oldest result in the outbox.", ("status",))
+upstream_circuit_state = registry.gauge(
+    "upstream_circuit_state", "Circuit breaker state per upstream: 0 closed, 1 half-open, 2 open.", ("upstream",))
+upstream_rejections = registry.counter(
+    "upstream_rejections_total", "Calls failed fast by an open circuit breaker.", ("upstream",))
+upstream_retries = registry.counter(
+    "upstream_retries_total", "Retries of failed upstream calls.", ("upstream",))
+upstream_hedges = registry.counter(
+    "upstream_hedges_total", "Hedged duplicate requests sent, and how many finished first.", ("upstream", "outcome"))
+model_route_choices = registry.counter(
+    "model_route_submissions_total", "Generation jobs offered to each Kie.ai model, by whether it accepted them.", ("model", "outcome"))
+kie_callbacks = registry.counter(
+    "kie_callbacks_total", "Kie.ai webhooks received, by whether they were new.", ("kind", "outcome"))
+callback_batch_size = registry.histogram(
+    "kie_callback_batch_size", "Callbacks handled per processing batch.", ("kind",), buckets=BATCH_BUCKETS)
+script_ingest_files = registry.counter(
+    "script_ingest_files_total", "Uploaded script files, by format and whether they could be read.", ("format", "outcome"))
+script_ingest_duration = registry.histogram(
+    "script_ingest_parse_seconds", "Time to extract the text of an uploaded script.", ("format",))
+callback_inbox_depth = registry.gauge(
+    "kie_callback_inbox", "Callbacks in the inbox.", ("status",))
+callback_inbox_oldest_age = registry.gauge(
+    "kie_callback_inbox_oldest_age_seconds", "Age of the oldest callback in the inbox.", ("status",))
+
+
+def timed_db(function):
+    """Records how long a crud function takes, for sync and async functions."""
+    name = function.__name__
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            with tracer.span(f"db.{name}"):
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    db_query_duration.observe(time.perf_counter() - started, function=name)
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        with tracer.span(f"db.{name}"):
+            try:
+                return function(*args, **kwargs)
+            finally:
+                db_query_duration.observe(time.perf_counter() - started, function=name)
+    return wrapper
+
+
+def observe_gemini_usage(model: str, operation: str, usage_metadata):
+    """Counts prompt and completion tokens from a Gemini response's usage metadata."""
+    if usage_metadata is None:
+        return
+    for kind, attribute in (("prompt", "prompt_token_count"), ("completion", "candidates_token_count")):
+        tokens = getattr(usage_metadata, attribute, None)
+        if tokens:
+            gemini_tokens.inc(tokens, model=model, operation=operation, kind=kind)
+            gemini_request_tokens.observe(tokens, model=model, operation=operation, kind=kind)
+
+
+class SubmissionClock:
+    """
+    Measures the time from a Kie.ai submission to its result. The submission
+    time is stored with the job (on the task row, or in the job ledger for
+    forwarded results), so the result can be timed by whichever process
+    receives it.
+    """
+    def finished(self, external_id: Optional[str], outcome: str, source: str,
+                 submitted_at: Optional[float] = None, service_type: Optional[str] = None):
+        """submitted_at is the job's submission time in epoch seconds, if known."""
+        if not external_id or submitted_at is None:
+            return
+        kie_job_duration.observe(time.time() - submitted_at, service_type=service_type or "unknown", outcome=outcome, source=source)
+
+
+submission_clock = SubmissionClock()
+
+
+async def collect_queue_metrics():
+    """Refreshes the job queue, outbox and callback inbox gauges; called on each scrape."""
+    from app.services.job_queue import job_queue
+    from app.services.outbox import result_outbox
+    from app.services.callback_inbox import callback_inbox
+
+    depth, age = {}, {}
+    for job_type, by_status in (await job_queue.stats()).items():
+        for status, by_priority in by_status.items():
+            for priority, stats in by_priority.items():
+                labels = (("job_type", job_type), ("status", status), ("priority", priority))
+                depth[labels] = stats["count"]
+                age[labels] = stats["oldest_age"]
+    job_queue_depth.replace(depth)
+    job_queue_oldest_age.replace(age)
+
+    outbox = await result_outbox.stats()
+    outbox_depth.replace({(("status", status),): stats["count"] for status, stats in outbox.items()})
+    outbox_oldest_age.replace({(("status", status),): stats["oldest_age"] for status, stats in outbox.items()})
+
+    inbox = await callback_inbox.stats()
+    callback_inbox_depth.replace({(("status", status),): stats["count"] for status, stats in inbox.items()})
+    callback_inbox_oldest_age.replace({(("status", status),): stats["oldest_age"] for status, stats in inbox.items()})
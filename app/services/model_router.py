@@ -0,0 +1,283 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+import httpx
+from sqlalchemy.exc import SQLAlchemyError
+from app.core.config import settings
+from app.services.job_ledger import job_ledger
+from app.services.kie_client import KieSubmissionError, get_kie_client
+from app.services.metrics import model_route_choices
+from app.services.resilience import is_unsent
+
+# Quality tiers, lowest first; a request is served by models of its tier or better
+QUALITY_TIERS = ["standard", "high"]
+
+
+class ModelBackend:
+    """
+    One Kie.ai generation model: where jobs are submitted and looked up, how
+    its payload is built, and its recent success rate and turnaround.
+    """
+    def __init__(self, name: str, service_type: str, quality: str, submit_path: str, record_path: str,
+                 build_payload: Callable[[str, str], dict], expected_latency: float):
+        self.name = name
+        self.service_type = service_type
+        self.quality = quality
+        self.submit_path = submit_path
+        self.record_path = record_path
+        self.build_payload = build_payload
+        self.expected_latency = expected_latency
+        # Submissions from this process, for stats
+        self.submitted = 0
+        self.rejected = 0
+        # Loaded from the job ledger, shared by all processes
+        self.latency: Optional[float] = None
+        self.latency_samples = 0
+        self.outcomes = deque(maxlen=settings.MODEL_ROUTER_HEALTH_WINDOW)
+        # Submission times of the jobs still running, oldest first
+        self.running: List[float] = []
+
+    def load(self, running: List[float], finished: List[Tuple[bool, Optional[float]]]):
+        """Replaces the stats with the ledger's running jobs and recent outcomes."""
+        self.running = running
+        self.outcomes.clear()
+        self.latency, self.latency_samples = None, 0
+        alpha = settings.MODEL_ROUTER_LATENCY_ALPHA
+        for succeeded, duration in finished:
+            self.outcomes.append(1 if succeeded else 0)
+            if succeeded and duration is not None:
+                self.latency = duration if self.latency is None else alpha * duration + (1 - alpha) * self.latency
+                self.latency_samples += 1
+
+    def success_rate(self) -> Optional[float]:
+        if len(self.outcomes) < settings.MODEL_ROUTER_MIN_SAMPLES:
+            return None
+        return sum(self.outcomes) / len(self.outcomes)
+
+    def healthy(self) -> bool:
+        rate = self.success_rate()
+        return rate is None or rate >= settings.MODEL_ROUTER_MIN_SUCCESS_RATE
+
+    def estimated_latency(self, now: float) -> float:
+        """
+        Submit-to-callback time to expect: the moving average of finished
+        jobs (the configured prior until there are enough), raised to the
+        median age of the jobs still running when the model's queue backs up.
+        """
+        if self.latency is not None and self.latency_samples >= settings.MODEL_ROUTER_MIN_SAMPLES:
+            estimate = self.latency
+        else:
+            estimate = self.expected_latency
+        if self.running:
+            estimate = max(estimate, now - self.running[len(self.running) // 2])
+        return estimate
+
+    def prune(self, now: float):
+        """Forgets running jobs older than the horizon; their results were lost."""
+        del self.running[:bisect.bisect_left(self.running, now - settings.MODEL_ROUTER_IN_FLIGHT_HORIZON)]
+
+    def stats(self, now: float):
+        rate = self.success_rate()
+        return {
+            "service_type": self.service_type,
+            "quality": self.quality,
+            "healthy": self.healthy(),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "running": len(self.running),
+            "success_rate": round(rate, 3) if rate is not None else None,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "estimated_latency": round(self.estimated_latency(now), 3),
+        }
+
+
+class ModelRouter:
+    """
+    Picks the Kie.ai model for each generation: among the enabled models of
+    the requested kind and quality tier (or better), healthy ones come first,
+    fastest expected turnaround first; unhealthy ones are kept as a last
+    resort. Submission falls through the list when a model rejects the job.
+
+    Submissions and outcomes go to the job ledger in the application
+    database, and every process reloads its stats from there at most every
+    MODEL_ROUTER_REFRESH_INTERVAL seconds. Standalone workers on any host
+    therefore route on the results that the API processes received.
+    """
+    def __init__(self):
+        self._backends: Dict[str, ModelBackend] = {}
+        self._lock = threading.Lock()
+        self._refreshed_at = 0.0
+        self._pruned_at = 0.0
+        # Kie.ai task ID -> model, for linking the job to its task
+        self._jobs = OrderedDict()
+
+    def register(self, backend: ModelBackend):
+        self._backends[backend.name] = backend
+
+    def get(self, name: Optional[str]) -> Optional[ModelBackend]:
+        return self._backends.get(name) if name else None
+
+    def backends(self, service_type: Optional[str] = None, enabled_only: bool = True) -> List[ModelBackend]:
+        enabled = settings.MODEL_ROUTER_MODELS if enabled_only else []
+        return [
+            backend for backend in self._backends.values()
+            if (not enabled or backend.name in enabled) and (service_type is None or backend.service_type == service_type)
+        ]
+
+    async def _refresh(self, now: float):
+        # Claimed before the first await, so concurrent submissions in this
+        # process do not all reload the same numbers
+        if now - self._refreshed_at < settings.MODEL_ROUTER_REFRESH_INTERVAL:
+            return
+        self._refreshed_at = now
+        try:
+            for backend in self.backends():
+                jobs = await job_ledger.model_jobs(
+                    backend.name, now - settings.MODEL_ROUTER_IN_FLIGHT_HORIZON, settings.MODEL_ROUTER_HEALTH_WINDOW
+                )
+                with self._lock:
+                    backend.load(*jobs)
+            if now - self._pruned_at >= settings.MODEL_ROUTER_LEDGER_PRUNE_INTERVAL:
+                self._pruned_at = now
+                await job_ledger.prune(settings.MODEL_ROUTER_LEDGER_TTL)
+        except SQLAlchemyError as e:
+            # Route on the last numbers rather than fail the submission
+            print(f"MODEL ROUTER: Could not load the job ledger: {e}")
+
+    async def candidates(self, service_type: str, quality: Optional[str] = None) -> List[ModelBackend]:
+        quality = quality or settings.MODEL_ROUTER_DEFAULT_QUALITY
+        if quality not in QUALITY_TIERS:
+            raise ValueError(f"Unknown quality tier '{quality}'")
+        eligible = [
+            backend for backend in self.backends(service_type)
+            if QUALITY_TIERS.index(backend.quality) >= QUALITY_TIERS.index(quality)
+        ]
+        if not eligible:
+            raise ValueError(f"No {service_type} model is enabled for quality '{quality}'")
+        now = time.time()
+        await self._refresh(now)
+        with self._lock:
+            for backend in eligible:
+                backend.prune(now)
+            return sorted(eligible, key=lambda backend: (not backend.healthy(), backend.estimated_latency(now)))
+
+    async def submitted(self, backend: ModelBackend, external_id: str, forward_task_id: Optional[str] = None):
+        with self._lock:
+            backend.submitted += 1
+            # Counted here until the next refresh loads it from the ledger
+            backend.running.append(time.time())
+            self._jobs[external_id] = backend.name
+            while len(self._jobs) > settings.MODEL_ROUTER_MAX_TRACKED_JOBS:
+                self._jobs.popitem(last=False)
+        await self._record(external_id, backend, forward_task_id=forward_task_id)
+
+    async def rejected(self, backend: ModelBackend):
+        """A submission the model did not accept counts as a failure."""
+        with self._lock:
+            backend.rejected += 1
+            backend.outcomes.append(0)
+        await self._record(None, backend, succeeded=False)
+
+    async def _record(self, external_id: Optional[str], backend: ModelBackend, succeeded: Optional[bool] = None,
+                      forward_task_id: Optional[str] = None):
+        # The job was already submitted (or refused); losing its ledger entry
+        # only costs a sample, while raising would have it submitted again
+        try:
+            await job_ledger.record_submission(external_id, backend.service_type, backend.name, succeeded, forward_task_id)
+        except SQLAlchemyError as e:
+            print(f"MODEL ROUTER: Could not record a {backend.name} job in the ledger: {e}")
+
+    async def finished(self, outcomes: List[Tuple[str, bool]]) -> Dict[str, tuple]:
+        """
+        Records (external_id, succeeded) job outcomes in the ledger and
+        returns the (service_type, model, submitted_at) of the jobs that were
+        still running.
+        """
+        return await job_ledger.finish(outcomes)
+
+    def model_for(self, external_id: str) -> Optional[str]:
+        with self._lock:
+            return self._jobs.get(external_id)
+
+    async def stats(self):
+        now = time.time()
+        await self._refresh(now)
+        with self._lock:
+            for backend in self.backends():
+                backend.prune(now)
+            return {backend.name: backend.stats(now) for backend in self.backends()}
+
+
+model_router = ModelRouter()
+
+
+def _not_started(error: Exception) -> bool:
+    """
+    Submission errors after which Kie.ai cannot be running the job, so
+    another model can be tried without paying twice: the request never got
+    through, or Kie.ai turned it down.
+    """
+    if isinstance(error, KieSubmissionError) or is_unsent(error):
+        return True
+    return isinstance(error, httpx.HTTPStatusError) and 400 <= error.response.status_code < 500
+
+
+async def submit_generation(service_type: str, prompt: str, callback_url: str, quality: Optional[str] = None,
+                            forward_task_id: Optional[str] = None) -> Tuple[ModelBackend, str]:
+    """
+    Submits a generation job to the best model for it and returns the model
+    and Kie.ai's task ID. If a model rejects the job the next candidate is
+    tried, up to MODEL_ROUTER_MAX_FALLBACKS times; the last error is raised
+    when none accepts it. Any other error (an open circuit breaker, a
+    timeout after the request went out) is raised at once: the job may be
+    running, and resubmitting it elsewhere could pay for it twice.
+    forward_task_id marks a job whose result is forwarded to the main
+    backend, so the reconciler can find it in the job ledger.
+    """
+    candidates = (await model_router.candidates(service_type, quality))[:settings.MODEL_ROUTER_MAX_FALLBACKS + 1]
+    error = None
+    for backend in candidates:
+        try:
+            external_id = await get_kie_client().submit(backend.submit_path, backend.build_payload(prompt, callback_url))
+        except Exception as e:
+            if not _not_started(e):
+                raise
+            error = e
+            model_route_choices.inc(model=backend.name, outcome="rejected")
+            await model_router.rejected(backend)
+            print(f"MODEL ROUTER: {backend.name} did not accept the {service_type} job: {str(e) or e.__class__.__name__}")
+            continue
+        model_route_choices.inc(model=backend.name, outcome="submitted")
+        await model_router.submitted(backend, external_id, forward_task_id)
+        return backend, external_id
+    raise error
+
+
+def _veo_payload(model: str):
+    def build(prompt: str, callback_url: str) -> dict:
+        return {"prompt": prompt, "model": model, "aspectRatio": "16:9", "callBackUrl": callback_url}
+    return build
+
+
+def _runway_payload(prompt: str, callback_url: str) -> dict:
+    return {"prompt": prompt, "duration": 5, "quality": "720p", "aspectRatio": "16:9", "waterMark": "", "callBackUrl": callback_url}
+
+
+def _gpt4o_image_payload(prompt: str, callback_url: str) -> dict:
+    return {"prompt": prompt, "filesUrl": [], "size": "1:1", "callBackUrl": callback_url, "isEnhance": False, "nVariants": 1}
+
+
+def _flux_kontext_payload(model: str):
+    def build(prompt: str, callback_url: str) -> dict:
+        return {"prompt": prompt, "model": model, "aspectRatio": "1:1", "callBackUrl": callback_url}
+    return build
+
+
+# Expected latencies are priors used until a model has finished enough jobs
+model_router.register(ModelBackend("veo3", "video", "high", "/veo/generate", "/veo/record-info", _veo_payload("veo3"), 180.0))
+model_router.register(ModelBackend("veo3_fast", "video", "standard", "/veo/generate", "/veo/record-info", _veo_payload("veo3_fast"), 90.0))
+model_router.register(ModelBackend("runway", "video", "standard", "/runway/generate", "/runway/record-detail", _runway_payload, 120.0))
+model_router.register(ModelBackend("gpt4o-image", "image", "high", "/gpt4o-image/generate", "/gpt4o-image/record-info", _gpt4o_image_payload, 60.0))
+model_router.register(ModelBackend("flux-kontext-pro", "image", "standard", "/flux/kontext/generate", "/flux/kontext/record-info", _flux_kontext_payload("flux-kontext-pro"), 30.0))
@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional
+import httpx
+from app.core.config import settings
+
+
+class ResultOutbox:
+    """
+    Durable SQLite outbox for task results bound for the main backend.
+
+    Webhook handlers append to it and return immediately; the
+    ResultForwarder drains it in the background. A forwarder claims rows
+    with a lease of OUTBOX_LEASE seconds, so several processes sharing the
+    file never send the same row at once, and rows of a forwarder that died
+    are claimed again once the lease runs out. Rows are deleted once the
+    backend accepts them, and parked as 'dead' after OUTBOX_MAX_ATTEMPTS.
+
+    sqlite3 calls block, so they run in a worker thread.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " payload TEXT NOT NULL,"
+                " status TEXT NOT NULL DEFAULT 'pending',"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at REAL NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_error TEXT,"
+                " lease_until REAL)"
+            )
+            # Outbox files created before leases existed
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}
+            if "lease_until" not in columns:
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN lease_until REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox (status, next_attempt_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_outbox_lease ON outbox (status, lease_until)")
+            self._conn.commit()
+        return self._conn
+
+    async def _run(self, work: Callable[[sqlite3.Connection], object]):
+        return await asyncio.to_thread(self._locked, work)
+
+    def _locked(self, work: Callable[[sqlite3.Connection], object]):
+        with self._lock:
+            return work(self._connection())
+
+    async def append(self, payload: dict):
+        await self.append_many([payload])
+
+    async def append_many(self, payloads: List[dict]):
+        """Appends several results in one transaction."""
+        now = time.time()
+        rows = [(json.dumps(payload), now, now) for payload in payloads]
+
+        def insert(conn: sqlite3.Connection):
+            conn.executemany(
+                "INSERT INTO outbox (payload, next_attempt_at, created_at) VALUES (?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+
+        await self._run(insert)
+
+    async def claim(self, limit: int) -> List[tuple]:
+        """
+        Leases up to limit rows that are ready to send, including rows whose
+        lease ran out, and returns them as (id, payload, attempts).
+        """
+        now = time.time()
+
+        def lease(conn: sqlite3.Connection):
+            # One UPDATE picks and marks the rows, so two forwarders never claim the same one
+            rows = conn.execute(
+                "UPDATE outbox SET status = 'sending', lease_until = ?"
+                " WHERE id IN (SELECT id FROM outbox"
+                "  WHERE (status = 'pending' AND next_attempt_at <= ?)"
+                "  OR (status = 'sending' AND lease_until <= ?)"
+                "  ORDER BY id LIMIT ?)"
+                " RETURNING id, payload, attempts",
+                (now + settings.OUTBOX_LEASE, now, now, limit),
+            ).fetchall()
+            conn.commit()
+            return rows
+
+        rows = sorted(await self._run(lease))
+        return [(row_id, json.loads(payload), attempts) for row_id, payload, attempts in rows]
+
+    async def ack(self, ids: List[int]):
+        if not ids:
+            return
+
+        def delete(conn: sqlite3.Connection):
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids])
+            conn.commit()
+
+        await self._run(delete)
+
+    async def retry_later(self, rows: List[tuple], error: str):
+        """Releases failed rows and reschedules them with jittered exponential backoff."""
+        now = time.time()
+        updates = []
+        for row_id, _, attempts in rows:
+            attempts += 1
+            if attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                updates.append(("dead", attempts, now, error, row_id))
+                continue
+            delay = min(settings.OUTBOX_RETRY_MAX_DELAY, settings.OUTBOX_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+            updates.append(("pending", attempts, now + delay * random.uniform(0.5, 1.0), error, row_id))
+
+        def reschedule(conn: sqlite3.Connection):
+            conn.executemany(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, lease_until = NULL WHERE id = ?",
+                updates,
+            )
+            conn.commit()
+
+        await self._run(reschedule)
+
+    async def stats(self):
+        def count(conn: sqlite3.Connection):
+            return conn.execute(
+                "SELECT status, COUNT(*), MIN(created_at) FROM outbox GROUP BY status"
+            ).fetchall()
+
+        rows = await self._run(count)
+        now = time.time()
+        return {
+            status: {"count": count, "oldest_age": round(now - oldest, 3) if oldest else 0.0}
+            for status, count, oldest in rows
+        }
+
+
+class ResultForwarder:
+    """
+    Background task that drains the outbox to the main backend over a shared
+    connection pool. When MAIN_BACKEND_BATCH_SAVE_URL is set, up to
+    OUTBOX_BATCH_SIZE results are sent per POST; otherwise each result is
+    posted to MAIN_BACKEND_SAVE_URL individually, concurrently.
+    """
+    def __init__(self, outbox: ResultOutbox):
+        self.outbox = outbox
+        self.forwarded = 0
+        self.failed_attempts = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._client = httpx.AsyncClient(
+            timeout=settings.OUTBOX_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=settings.OUTBOX_MAX_CONNECTIONS),
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def notify(self):
+        """Wakes the forwarder so a freshly appended result goes out right away."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                drained = await self.drain_once()
+            except Exception as e:
+                print(f"OUTBOX: Forwarder error: {e}")
+                drained = 0
+            if drained:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain_once(self) -> int:
+        rows = await self.outbox.claim(settings.OUTBOX_BATCH_SIZE)
+        if not rows:
+            return 0
+        if settings.MAIN_BACKEND_BATCH_SAVE_URL:
+            await self._send_batch(rows)
+        else:
+            await asyncio.gather(*(self._send_one(row) for row in rows))
+        return len(rows)
+
+    async def _send_batch(self, rows: List[tuple]):
+        try:
+            response = await self._client.post(
+                settings.MAIN_BACKEND_BATCH_SAVE_URL,
+                json={"results": [payload for _, payload, _ in rows]},
+            )
+            response.raise_for_status()
+        except Exception as e:
+            await self._failed(rows, e)
+            return
+        await self.outbox.ack([row_id for row_id, _, _ in rows])
+        self.forwarded += len(rows)
+
+    async def _send_one(self, row: tuple):
+        row_id, payload, _ = row
+        try:
+            response = await self._client.post(settings.MAIN_BACKEND_SAVE_URL, json=payload)
+            response.raise_for_status()
+        except Exception as e:
+            await self._failed([row], e)
+            return
+        await self.outbox.ack([row_id])
+        self.forwarded += 1
+
+    async def _failed(self, rows: List[tuple], error: Exception):
+        self.failed_attempts += len(rows)
+        print(f"OUTBOX: Forwarding {len(rows)} result(s) to the main backend failed: {error}")
+        await self.outbox.retry_later(rows, str(error) or error.__class__.__name__)
+
+
+result_outbox = ResultOutbox(path=settings.OUTBOX_PATH)
+result_forwarder = ResultForwarder(result_outbox)
@@ -0,0 +1,128 @@
+import asyncio
+import inspect
+import os
+import threading
+from typing import Callable, Optional
+from app.core.config import settings
+
+
+class ProviderRegistry:
+    """
+    Creates provider clients (Gemini, Vertex AI, Kie.ai, ...) lazily on first
+    use instead of at import time, so the API process starts quickly.
+
+    After a fork the child drops every instance inherited from the parent
+    and builds its own on first use; pooled sockets, gRPC channels and locks
+    are never shared across processes.
+    """
+    def __init__(self):
+        self._factories = {}
+        self._closers = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def register(self, name: str, factory: Callable, close: Optional[Callable] = None):
+        with self._lock:
+            self._factories[name] = factory
+            if close is not None:
+                self._closers[name] = close
+
+    def get(self, name: str):
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        with self._lock:
+            instance = self._instances.get(name)
+            if instance is None:
+                if name not in self._factories:
+                    raise KeyError(f"No provider registered under '{name}'")
+                instance = self._factories[name]()
+                self._instances[name] = instance
+        return instance
+
+    async def aget(self, name: str):
+        """get() for async code: a provider not created yet is created in a worker thread."""
+        if self._pid == os.getpid():
+            instance = self._instances.get(name)
+            if instance is not None:
+                return instance
+        return await asyncio.to_thread(self.get, name)
+
+    def is_initialized(self, name: str) -> bool:
+        return name in self._instances
+
+    async def warm_up(self, names: list):
+        """
+        Initializes the named providers ahead of the first request. Factories
+        may import heavy SDKs, so they run in a worker thread.
+        """
+        for name in names:
+            try:
+                await asyncio.to_thread(self.get, name)
+                print(f"PROVIDERS: Warmed up '{name}'.")
+            except Exception as e:
+                print(f"PROVIDERS: Warm-up of '{name}' failed: {e}")
+
+    async def aclose(self):
+        with self._lock:
+            instances = list(self._instances.items())
+            self._instances = {}
+        for name, instance in instances:
+            close = self._closers.get(name)
+            if close is None:
+                continue
+            result = close(instance)
+            if inspect.isawaitable(result):
+                await result
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._instances = {}
+        self._pid = os.getpid()
+
+
+providers = ProviderRegistry()
+
+
+def _create_gemini():
+    import google.generativeai as genai
+    genai.configure(api_key=settings.GOOGLE_API_KEY)
+    return genai
+
+
+def _create_vertexai():
+    import vertexai
+    from google.oauth2 import service_account
+    credentials = service_account.Credentials.from_service_account_file(
+        settings.GOOGLE_DRIVE_CREDENTIALS_FILE
+    )
+    vertexai.init(
+        project=settings.GOOGLE_CLOUD_PROJECT_ID,
+        location=settings.GOOGLE_CLOUD_LOCATION,
+        credentials=credentials
+    )
+    return vertexai
+
+
+providers.register("gemini", _create_gemini)
+providers.register("vertexai", _create_vertexai)
+
+
+def get_gemini():
+    """Returns the configured google.generativeai module."""
+    return providers.get("gemini")
+
+
+async def get_gemini_async():
+    """get_gemini() for async code; the first call imports the SDK in a worker thread."""
+    return await providers.aget("gemini")
+
+
+def get_vertexai():
+    """Returns the vertexai module, initialized with the service account."""
+    return providers.get("vertexai")
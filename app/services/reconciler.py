@@ -0,0 +1,178 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+from app import crud
+from app.core.config import settings
+from app.database import AsyncSessionLocal
+from app.models.models import TaskStatus
+from app.services.admission import PRIORITY_BACKGROUND, current_priority
+from app.services.kie_client import get_kie_client
+from app.services.kie_results import RUNNING, SUCCEEDED, KieOutcome, apply_outcome, parse_record, record_paths
+from app.services.job_ledger import job_ledger
+from app.services import service
+
+
+class TaskReconciler:
+    """
+    Background poller for tasks whose Kie.ai callback never arrived.
+
+    Every RECONCILE_INTERVAL seconds it claims the PROCESSING tasks that
+    have not changed for RECONCILE_STALE_AFTER seconds, asks Kie.ai for
+    their job records (at most RECONCILE_CONCURRENCY at a time) and applies
+    finished results exactly like the webhook does. Tasks still unfinished
+    RECONCILE_DEADLINE seconds after creation are marked FAILED.
+
+    Jobs of the endpoints1 router have no task rows; they are claimed from
+    the job ledger the same way and their results forwarded to the main
+    backend, so whichever router is in use, its jobs are reconciled.
+
+    Claiming bumps a task's updated_at (a job's checked_at), which works as
+    a lease: every API process and worker can run a reconciler without two
+    of them checking the same task in the same round.
+    """
+    def __init__(self, session_factory=AsyncSessionLocal, client_factory=get_kie_client):
+        self.session_factory = session_factory
+        self.client_factory = client_factory
+        self.runs = 0
+        self.recovered = 0
+        self.expired = 0
+        self.lookup_errors = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                counts = await self.reconcile_once()
+                if any(counts.values()):
+                    print(f"RECONCILER: {counts}")
+            except Exception as e:
+                print(f"RECONCILER: Run failed: {e}")
+            await asyncio.sleep(settings.RECONCILE_INTERVAL)
+
+    async def reconcile_once(self) -> dict:
+        """Checks one batch of stale tasks and forwarded jobs and returns what happened to them."""
+        current_priority.set(PRIORITY_BACKGROUND)
+        tasks = await self.reconcile_tasks_once()
+        forwarded = await self.reconcile_forwarded_once()
+        self.runs += 1
+        return {key: tasks[key] + forwarded[key] for key in tasks}
+
+    async def reconcile_tasks_once(self) -> dict:
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            tasks = await crud.claim_stale_tasks_async(
+                db, updated_before=now - timedelta(seconds=settings.RECONCILE_STALE_AFTER), limit=settings.RECONCILE_BATCH_SIZE
+            )
+        if not tasks:
+            return {"checked": 0, "recovered": 0, "expired": 0, "pending": 0}
+
+        semaphore = asyncio.Semaphore(settings.RECONCILE_CONCURRENCY)
+
+        async def lookup(task):
+            async with semaphore:
+                # Tasks without an external_id are still being submitted, or are
+                # waiting on an identical job; only the deadline applies to them.
+                if not task.external_id:
+                    return None
+                return await self._lookup(task.external_id, task.service_type, task.model, f"task {task.id}")
+
+        outcomes = await asyncio.gather(*(lookup(task) for task in tasks))
+
+        deadline = now - timedelta(seconds=settings.RECONCILE_DEADLINE)
+        recovered, expired, pending = 0, [], 0
+        # The callback may have finished a task during the lookups, so
+        # writes only apply to tasks that are still PROCESSING
+        async with self.session_factory() as db:
+            for task, outcome in zip(tasks, outcomes):
+                if outcome is not None and outcome.state != RUNNING:
+                    if await apply_outcome(db, outcome, source="reconciler"):
+                        recovered += 1
+                elif task.created_at is not None and task.created_at < deadline:
+                    expired.append(task.id)
+                else:
+                    # Claiming moved it to the back of the scan order
+                    pending += 1
+            if expired:
+                expired = await crud.update_tasks_async(db, [
+                    {"task_id": task_id, "status": TaskStatus.FAILED, "result_url": "Error: Kie.ai did not finish the job before the deadline"}
+                    for task_id in expired
+                ], only_status=TaskStatus.PROCESSING)
+
+        self.recovered += recovered
+        self.expired += len(expired)
+        return {"checked": len(tasks), "recovered": recovered, "expired": len(expired), "pending": pending}
+
+    async def reconcile_forwarded_once(self) -> dict:
+        """Checks one batch of stale jobs of the endpoints1 router, from the job ledger."""
+        now = datetime.utcnow()
+        jobs = await job_ledger.claim_stale(
+            checked_before=now - timedelta(seconds=settings.RECONCILE_STALE_AFTER), limit=settings.RECONCILE_BATCH_SIZE
+        )
+        if not jobs:
+            return {"checked": 0, "recovered": 0, "expired": 0, "pending": 0}
+
+        semaphore = asyncio.Semaphore(settings.RECONCILE_CONCURRENCY)
+
+        async def lookup(job):
+            async with semaphore:
+                return await self._lookup(job.external_id, job.service_type, job.model, f"internal task {job.forward_task_id}")
+
+        outcomes = await asyncio.gather(*(lookup(job) for job in jobs))
+
+        deadline = now - timedelta(seconds=settings.RECONCILE_DEADLINE)
+        finished, expired, pending = [], [], 0
+        for job, outcome in zip(jobs, outcomes):
+            if outcome is not None and outcome.state != RUNNING:
+                if outcome.state == SUCCEEDED:
+                    finished.append((job.forward_task_id, "completed", outcome.result_url, job.external_id))
+                else:
+                    finished.append((job.forward_task_id, "failed", f"Error: {outcome.error}", job.external_id))
+            elif job.submitted_at < deadline:
+                expired.append((job.forward_task_id, "failed", "Error: Kie.ai did not finish the job before the deadline", job.external_id))
+            else:
+                pending += 1
+        # Jobs whose callback was processed during the lookups are not forwarded twice
+        forwarded = set(await service.forward_outcomes(finished + expired, source="reconciler", require_running=True))
+        recovered = sum(1 for outcome in finished if outcome[0] in forwarded)
+        expired_count = sum(1 for outcome in expired if outcome[0] in forwarded)
+
+        self.recovered += recovered
+        self.expired += expired_count
+        return {"checked": len(jobs), "recovered": recovered, "expired": expired_count, "pending": pending}
+
+    async def _lookup(self, external_id: str, service_type: Optional[str], model: Optional[str], owner: str) -> Optional[KieOutcome]:
+        paths = record_paths(service_type, model)
+        client = self.client_factory()
+        for path in paths:
+            try:
+                record = await client.get(path, {"taskId": external_id})
+                return parse_record(external_id, record)
+            except Exception as e:
+                error = e
+        self.lookup_errors += 1
+        print(f"RECONCILER: Could not look up Kie.ai job {external_id} for {owner}: {error}")
+        return None
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "recovered": self.recovered,
+            "expired": self.expired,
+            "lookup_errors": self.lookup_errors,
+        }
+
+
+task_reconciler = TaskReconciler()
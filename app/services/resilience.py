@@ -0,0 +1,280 @@
+import asyncio
+import math
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional
+import httpx
+from app.core.config import settings
+from app.services.admission import WaitStats
+from app.services.metrics import upstream_circuit_state, upstream_hedges, upstream_rejections, upstream_retries
+
+# Circuit breaker states, with the values exported by the upstream_circuit_state gauge
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# The hedge delay (recent p95 latency) is recomputed after this many calls
+_HEDGE_DELAY_REFRESH = 20
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} is failing; calls are paused for {retry_after:.1f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+def is_transient(error: Exception) -> bool:
+    """Timeouts, dropped connections, throttling and 5xx responses."""
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code >= 500 or status_code in (408, 429)
+    # Imported here: google.api_core is slow to import and only Gemini errors need it
+    from google.api_core import exceptions as google_exceptions
+    return isinstance(error, (google_exceptions.ServerError, google_exceptions.TooManyRequests))
+
+
+def is_unsent(error: Exception) -> bool:
+    """
+    Transient errors after which the upstream cannot have acted on the
+    request, so even a non-idempotent call (a paid Kie.ai job) is safe to
+    repeat: the connection never got through, or the request was refused.
+    """
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code in (429, 503)
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive transient failures and then
+    rejects calls for reset_timeout seconds. After that one trial call is
+    let through (half-open): if it succeeds the breaker closes, otherwise it
+    opens again.
+    """
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probing = False
+        upstream_circuit_state.set(_STATE_VALUES[CLOSED], upstream=name)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            print(f"RESILIENCE: {self.name} circuit breaker is now {state}")
+        self.state = state
+        upstream_circuit_state.set(_STATE_VALUES[state], upstream=self.name)
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call must not go out."""
+        if self.state == OPEN:
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                self._reject(remaining)
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probing:
+                self._reject(self.reset_timeout)
+            self._probing = True
+
+    def _reject(self, retry_after: float):
+        self.rejected += 1
+        upstream_rejections.inc(upstream=self.name)
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, healthy: bool):
+        """Reports the outcome of a call let through by before_call."""
+        self._probing = False
+        if healthy:
+            self.failures = 0
+            self._set_state(CLOSED)
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            self._set_state(OPEN)
+
+    def abandon(self):
+        """The call was cancelled (e.g. a losing hedge) and tells us nothing."""
+        self._probing = False
+
+    def stats(self):
+        retry_in = self.opened_at + self.reset_timeout - time.monotonic() if self.state == OPEN else 0.0
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+            "retry_in": round(max(0.0, retry_in), 3),
+        }
+
+
+class OperationLatency:
+    """
+    Recent latency of one kind of call to an upstream (a Kie.ai endpoint, a
+    Gemini model and operation), and the hedge delay derived from it.
+    Operations are kept apart so quick calls are not hedged at the p95 of
+    slow ones, nor slow ones hedged too early.
+    """
+    def __init__(self):
+        self.latency = WaitStats(history_size=settings.RESILIENCE_LATENCY_HISTORY)
+        self._hedge_delay: Optional[float] = None
+        self._hedge_delay_at = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        """Recent p95 latency, or None until there are enough samples to trust it."""
+        if not settings.RESILIENCE_HEDGE_ENABLED or len(self.latency.recent) < settings.RESILIENCE_HEDGE_MIN_SAMPLES:
+            return None
+        if self._hedge_delay is None or self.latency.count - self._hedge_delay_at >= _HEDGE_DELAY_REFRESH:
+            self._hedge_delay = max(settings.RESILIENCE_HEDGE_MIN_DELAY, self.latency.snapshot()["p95"])
+            self._hedge_delay_at = self.latency.count
+        return self._hedge_delay
+
+    def stats(self):
+        return {
+            "hedge_delay": round(self._hedge_delay, 4) if self._hedge_delay is not None else None,
+            "latency_seconds": self.latency.snapshot(),
+        }
+
+
+class Upstream:
+    """
+    Resilient calls to one upstream service: jittered exponential retries of
+    transient errors, an optional hedged duplicate for idempotent calls that
+    run past their operation's recent p95 latency, and a circuit breaker that
+    fails fast while the upstream keeps failing.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.breaker = CircuitBreaker(name, settings.RESILIENCE_BREAKER_FAILURES, settings.RESILIENCE_BREAKER_RESET_TIMEOUT)
+        self.operations: Dict[str, OperationLatency] = {}
+        self.retries = 0
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def _operation(self, operation: str) -> OperationLatency:
+        stats = self.operations.get(operation)
+        if stats is None:
+            stats = self.operations[operation] = OperationLatency()
+        return stats
+
+    async def call(self, function: Callable, *args, hedge: bool = False, retry_if: Callable = is_transient,
+                   operation: str = "default", gate: Optional[Callable[[], Awaitable]] = None, **kwargs):
+        """
+        Awaits function(*args, **kwargs) until it succeeds, it fails in a way
+        retry_if does not accept, or RESILIENCE_MAX_RETRIES retries are used
+        up. Only pass hedge=True for calls that are safe to run twice.
+        Latency is tracked per operation; gate (e.g. a rate limiter) is
+        awaited before each attempt and its wait is not counted.
+        """
+        stats = self._operation(operation)
+        attempt = 0
+        while True:
+            try:
+                if hedge:
+                    return await self._hedged(function, args, kwargs, stats, gate)
+                return await self._attempt(function, args, kwargs, stats, gate)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt > settings.RESILIENCE_MAX_RETRIES or not retry_if(e):
+                    raise
+                # Full jitter, so callers that failed together do not retry together
+                delay = random.uniform(0, min(settings.RESILIENCE_RETRY_MAX_DELAY, settings.RESILIENCE_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+                self.retries += 1
+                upstream_retries.inc(upstream=self.name)
+                print(f"RESILIENCE: {self.name} call failed ({str(e) or e.__class__.__name__}); retry {attempt} of {settings.RESILIENCE_MAX_RETRIES} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def _attempt(self, function: Callable, args: tuple, kwargs: dict, stats: OperationLatency,
+                       gate: Optional[Callable[[], Awaitable]] = None, sent: Optional[asyncio.Event] = None):
+        self.breaker.before_call()
+        try:
+            if gate is not None:
+                await gate()
+            if sent is not None:
+                sent.set()
+            started = time.perf_counter()
+            result = await function(*args, **kwargs)
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        except Exception as e:
+            # A rejected request (4xx) still shows the upstream is up
+            self.breaker.record(healthy=not is_transient(e))
+            raise
+        self.breaker.record(healthy=True)
+        stats.latency.record(time.perf_counter() - started)
+        return result
+
+    async def _hedged(self, function: Callable, args: tuple, kwargs: dict, stats: OperationLatency,
+                      gate: Optional[Callable[[], Awaitable]] = None):
+        delay = stats.hedge_delay()
+        if delay is None:
+            return await self._attempt(function, args, kwargs, stats, gate)
+        sent = asyncio.Event()
+        first = asyncio.ensure_future(self._attempt(function, args, kwargs, stats, gate, sent))
+        # The hedge delay counts from when the request went out, not from
+        # when it started waiting at the gate
+        waiting = asyncio.ensure_future(sent.wait())
+        try:
+            await asyncio.wait({first, waiting}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiting.cancel()
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or self.breaker.state != CLOSED:
+            return await first
+
+        self.hedges += 1
+        upstream_hedges.inc(upstream=self.name, outcome="sent")
+        hedged = asyncio.ensure_future(self._attempt(function, args, kwargs, stats, gate))
+        pending = {first, hedged}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedged:
+                            self.hedges_won += 1
+                            upstream_hedges.inc(upstream=self.name, outcome="won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "circuit_breaker": self.breaker.stats(),
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "operations": {operation: stats.stats() for operation, stats in self.operations.items()},
+        }
+
+
+kie_upstream = Upstream("kie")
+gemini_upstream = Upstream("gemini")
+
+
+def upstream_stats():
+    return {upstream.name: upstream.stats() for upstream in (kie_upstream, gemini_upstream)}
@@ -0,0 +1,209 @@
+import asyncio
+import re
+from typing import List, Optional
+from app.core.config import settings
+from app.services.gemini import generate_text, stream_text
+from app.services.analysis_cache import analysis_cache, scene_notes_store, make_analysis_key
+
+CONDENSE_INSTRUCTION = "condense-notes"
+
+# Scene headings such as "INT. COFFEE SHOP - DAY" or "EXT./INT. CAR - NIGHT"
+SLUGLINE_RE = re.compile(r"^[ \t]*(?:INT\./EXT\.|EXT\./INT\.|INT/EXT\.?|I/E\.?|INT\.|EXT\.)[ \t]", re.MULTILINE)
+
+
+def split_scenes(script_text: str) -> List[str]:
+    """
+    Splits a screenplay on its scene headings. Anything before the first
+    heading (title page, cold open) is kept as its own leading scene.
+    """
+    starts = [match.start() for match in SLUGLINE_RE.finditer(script_text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    bounds = starts + [len(script_text)]
+    scenes = [script_text[begin:end].strip() for begin, end in zip(bounds, bounds[1:])]
+    return [scene for scene in scenes if scene]
+
+
+def _split_oversized(scene: str, max_chars: int) -> List[str]:
+    # A single scene longer than max_chars is cut on paragraph boundaries,
+    # and hard-cut only when one paragraph is itself too long.
+    pieces, current = [], ""
+    for paragraph in scene.split("\n\n"):
+        while len(paragraph) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def chunk_scenes(scenes: List[str], max_chars: int) -> List[str]:
+    """
+    Groups consecutive scenes into chunks of at most max_chars characters.
+    """
+    chunks, current = [], ""
+    for scene in scenes:
+        for piece in (_split_oversized(scene, max_chars) if len(scene) > max_chars else [scene]):
+            if current and len(current) + len(piece) + 2 > max_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def is_long_script(script_text: str, project_id: Optional[str] = None) -> bool:
+    """
+    Whether the script goes through the scene map-reduce path. Scripts tied
+    to a project always do, so later drafts can reuse per-scene notes.
+    """
+    return bool(project_id) or len(script_text) > settings.SCRIPT_LONG_MODE_THRESHOLD_CHARS
+
+
+def _map_prompt(instruction: str, chunk: str, index: int, total: int) -> str:
+    return (
+        f"You are reading part {index} of {total} of a feature-length screenplay. "
+        "Write concise analysis notes for these scenes only: key plot events, characters introduced "
+        "or developed, and the quality of the dialogue. Reference scenes by their headings.\n"
+        f"The final report will follow this instruction: '{instruction}'\n\n"
+        f"--- SCENES START ---\n{chunk}\n--- SCENES END ---"
+    )
+
+
+def _scene_prompt(instruction: str, scene: str) -> str:
+    return (
+        "Write concise analysis notes for this single screenplay scene: key plot events, characters "
+        "introduced or developed, and the quality of the dialogue. Start with the scene heading.\n"
+        f"The final report will follow this instruction: '{instruction}'\n\n"
+        f"--- SCENE START ---\n{scene}\n--- SCENE END ---"
+    )
+
+
+def _condense_prompt(notes: str) -> str:
+    return (
+        "Condense the following consecutive screenplay analysis notes into shorter notes. "
+        "Keep every plot event, character beat and dialogue observation that matters, and keep scene references.\n\n"
+        f"{notes}"
+    )
+
+
+def _reduce_prompt(instruction: str, notes: List[str]) -> str:
+    joined_notes = "\n\n".join(f"--- PART {index} NOTES ---\n{note}" for index, note in enumerate(notes, start=1))
+    return (
+        "The following are scene-by-scene analysis notes covering a complete screenplay, in order. "
+        "Merge them into a single report on plot structure, character development, and dialogue quality "
+        f"that follows this user instruction: '{instruction}'\n\n{joined_notes}"
+    )
+
+
+async def _condense_notes(notes: List[str], model_name: str, generate) -> List[str]:
+    # Notes that together exceed SCRIPT_CHUNK_MAX_CHARS are condensed group
+    # by group until they fit, so the reduce prompt stays bounded however
+    # long the script is. Condensed groups are cached by content.
+    while len(notes) > 1 and sum(len(note) for note in notes) > settings.SCRIPT_CHUNK_MAX_CHARS:
+        groups = chunk_scenes(list(notes), settings.SCRIPT_CHUNK_MAX_CHARS)
+        if len(groups) >= len(notes):
+            break
+
+        async def condense(group: str) -> str:
+            cache_key = make_analysis_key(group, CONDENSE_INSTRUCTION, model_name)
+            condensed = await asyncio.to_thread(analysis_cache.get, cache_key)
+            if condensed is None:
+                condensed = await generate(_condense_prompt(group), "condense")
+                await asyncio.to_thread(analysis_cache.set, cache_key, condensed)
+            return condensed
+
+        notes = await asyncio.gather(*(condense(group) for group in groups))
+    return list(notes)
+
+
+async def map_scene_notes(script_text: str, instruction: str, model_name: str) -> List[str]:
+    """
+    Map step: analyzes scene chunks concurrently, at most
+    SCRIPT_ANALYSIS_PARALLELISM at a time, and returns the notes in script
+    order.
+    """
+    chunks = chunk_scenes(split_scenes(script_text), settings.SCRIPT_CHUNK_MAX_CHARS)
+    semaphore = asyncio.Semaphore(settings.SCRIPT_ANALYSIS_PARALLELISM)
+
+    async def generate(prompt: str, operation: str = "map") -> str:
+        async with semaphore:
+            return await generate_text(model_name, prompt, operation)
+
+    print(f"Analyzing {len(chunks)} scene chunks with up to {settings.SCRIPT_ANALYSIS_PARALLELISM} in parallel...")
+    notes = await asyncio.gather(*(
+        generate(_map_prompt(instruction, chunk, index, len(chunks)))
+        for index, chunk in enumerate(chunks, start=1)
+    ))
+    return await _condense_notes(list(notes), model_name, generate)
+
+
+async def map_draft_notes(project_id: str, script_text: str, instruction: str, model_name: str) -> List[str]:
+    """
+    Draft-aware map step. Every scene is fingerprinted and only scenes that
+    are new or changed since the project's previous draft are sent to the
+    model; the notes of unchanged scenes are reused from the scene store.
+    """
+    scenes = []
+    for scene in split_scenes(script_text):
+        scenes.extend(_split_oversized(scene, settings.SCRIPT_CHUNK_MAX_CHARS) if len(scene) > settings.SCRIPT_CHUNK_MAX_CHARS else [scene])
+    fingerprints = [make_analysis_key(scene, instruction, model_name) for scene in scenes]
+
+    known_notes = await asyncio.to_thread(scene_notes_store.load, project_id)
+    changed = {}
+    for index, fingerprint in enumerate(fingerprints):
+        if fingerprint not in known_notes and fingerprint not in changed:
+            changed[fingerprint] = index
+
+    semaphore = asyncio.Semaphore(settings.SCRIPT_ANALYSIS_PARALLELISM)
+
+    async def generate(prompt: str, operation: str = "map") -> str:
+        async with semaphore:
+            return await generate_text(model_name, prompt, operation)
+
+    print(f"Project {project_id}: {len(changed)} of {len(scenes)} scenes are new or changed, analyzing them...")
+    new_notes = await asyncio.gather(*(
+        generate(_scene_prompt(instruction, scenes[index])) for index in changed.values()
+    ))
+
+    notes_by_fingerprint = {fingerprint: known_notes.get(fingerprint) for fingerprint in fingerprints}
+    notes_by_fingerprint.update(zip(changed.keys(), new_notes))
+    await asyncio.to_thread(scene_notes_store.replace, project_id, notes_by_fingerprint)
+
+    notes = [notes_by_fingerprint[fingerprint] for fingerprint in fingerprints]
+    return await _condense_notes(notes, model_name, generate)
+
+
+async def _map_notes(script_text: str, instruction: str, model_name: str, project_id: Optional[str]) -> List[str]:
+    if project_id:
+        return await map_draft_notes(project_id, script_text, instruction, model_name)
+    return await map_scene_notes(script_text, instruction, model_name)
+
+
+async def analyze_long_script(script_text: str, instruction: str, model_name: str, project_id: Optional[str] = None) -> str:
+    """
+    Map-reduce analysis for feature-length screenplays: scene chunks are
+    analyzed in parallel and a final pass merges the notes into one report.
+    With a project_id, unchanged scenes of earlier drafts are not re-analyzed.
+    """
+    notes = await _map_notes(script_text, instruction, model_name, project_id)
+    print("Merging scene notes into the final analysis...")
+    return await generate_text(model_name, _reduce_prompt(instruction, notes), "reduce")
+
+
+async def stream_long_script(script_text: str, instruction: str, model_name: str, project_id: Optional[str] = None):
+    """
+    Streaming variant of analyze_long_script. The map step runs to completion
+    first, then the reduce pass is streamed chunk by chunk.
+    """
+    notes = await _map_notes(script_text, instruction, model_name, project_id)
+    async for text in stream_text(model_name, _reduce_prompt(instruction, notes), "reduce_stream"):
+        yield text
@@ -0,0 +1,151 @@
+import os
+import re
+import xml.etree.ElementTree as ET
+
+# Kept free of app imports: this module is what the script ingestion
+# process pool loads, so worker processes start without the app's settings,
+# clients or background threads.
+
+PDF = "pdf"
+FDX = "fdx"
+FOUNTAIN = "fountain"
+TEXT = "text"
+
+# Rough size of a Gemini token, used to enforce token limits before any call
+CHARS_PER_TOKEN = 4
+
+_FOUNTAIN_EXTENSIONS = (".fountain", ".spmd")
+_BONEYARD_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+_NOTE_RE = re.compile(r"\[\[.*?\]\]", re.DOTALL)
+# Section headings (#), synopses (=) and page breaks (===) are not script text
+_OUTLINE_LINE_RE = re.compile(r"^[ \t]*[#=].*\n?", re.MULTILINE)
+# Forced scene headings (.), action (!), characters (@) and lyrics (~); a
+# leading ellipsis is left alone
+_FORCING_RE = re.compile(r"^([ \t]*)(?:\.(?!\.)|[!@~])", re.MULTILINE)
+# Centered text (> THE END <) and forced transitions (> CUT TO:)
+_CENTERED_RE = re.compile(r"^([ \t]*)>[ \t]*(.*?)[ \t]*<?[ \t]*$", re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+# Final Draft paragraph types that continue the block of the one before
+_FDX_DIALOGUE_TYPES = ("Character", "Parenthetical", "Dialogue")
+_FDX_UPPERCASE_TYPES = ("Scene Heading", "Character", "Transition", "Shot")
+
+
+class ScriptIngestError(ValueError):
+    """An uploaded script could not be read."""
+
+
+class ScriptTooLargeError(ScriptIngestError):
+    """An upload, or the uploads together, are over an ingestion limit."""
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+def detect_format(filename: str, head: bytes) -> str:
+    """Picks the parser from the file's first bytes, then its extension."""
+    extension = os.path.splitext(filename or "")[1].lower()
+    if head.startswith(b"%PDF-") or extension == ".pdf":
+        return PDF
+    if extension == ".fdx" or b"<FinalDraft" in head:
+        return FDX
+    if extension in _FOUNTAIN_EXTENSIONS:
+        return FOUNTAIN
+    return TEXT
+
+
+def _check_tokens(filename: str, text_length: int, max_tokens: int):
+    if text_length // CHARS_PER_TOKEN > max_tokens:
+        raise ScriptTooLargeError(f"{filename} is over the {max_tokens}-token limit per file")
+
+
+def _read_text(path: str, filename: str) -> str:
+    with open(path, "rb") as source:
+        contents = source.read()
+    try:
+        return contents.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ScriptIngestError(f"Could not decode {filename}; it might not be a text file")
+
+
+def _normalize_fountain(text: str) -> str:
+    """Reduces Fountain markup to plain screenplay text."""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = _BONEYARD_RE.sub("", text)
+    text = _NOTE_RE.sub("", text)
+    text = _OUTLINE_LINE_RE.sub("", text)
+    text = _FORCING_RE.sub(r"\1", text)
+    text = _CENTERED_RE.sub(r"\1\2", text)
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def _parse_fdx(path: str, filename: str, max_tokens: int) -> str:
+    """
+    Renders a Final Draft document's script body as plain screenplay text:
+    a blank line between blocks, with a character's cue, parentheticals and
+    dialogue kept together. Title page, headers and footers are left out.
+    """
+    content = ET.parse(path).getroot().find("Content")
+    if content is None:
+        raise ScriptIngestError(f"{filename} has no script content")
+    blocks, length, previous_type = [], 0, None
+    # iter() also reaches the paragraphs nested in dual dialogue
+    for paragraph in content.iter("Paragraph"):
+        text = "".join(part.text or "" for part in paragraph.findall("Text")).strip()
+        if not text:
+            continue
+        paragraph_type = paragraph.get("Type", "Action")
+        if paragraph_type in _FDX_UPPERCASE_TYPES:
+            text = text.upper()
+        if blocks and paragraph_type in _FDX_DIALOGUE_TYPES[1:] and previous_type in _FDX_DIALOGUE_TYPES:
+            blocks[-1].append(text)
+        else:
+            blocks.append([text])
+        previous_type = paragraph_type
+        length += len(text) + 2
+        _check_tokens(filename, length, max_tokens)
+    return "\n\n".join("\n".join(block) for block in blocks)
+
+
+def _parse_pdf(path: str, filename: str, max_tokens: int) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ScriptIngestError(f"{filename} is a PDF, but PDF support needs the pypdf package")
+    reader = PdfReader(path)
+    if reader.is_encrypted and not reader.decrypt(""):
+        raise ScriptIngestError(f"{filename} is password-protected")
+    pages, length = [], 0
+    # Page by page, so an oversized PDF is rejected without extracting all of it
+    for page in reader.pages:
+        text = (page.extract_text() or "").strip()
+        if text:
+            pages.append(text)
+            length += len(text) + 2
+            _check_tokens(filename, length, max_tokens)
+    return "\n\n".join(pages)
+
+
+def parse_script_file(path: str, filename: str, script_format: str, max_tokens: int) -> str:
+    """
+    Extracts the screenplay text of a spooled upload. Runs in the ingestion
+    process pool; raises ScriptTooLargeError as soon as the text passes
+    max_tokens and ScriptIngestError when the file cannot be read.
+    """
+    try:
+        if script_format == PDF:
+            return _parse_pdf(path, filename, max_tokens)
+        if script_format == FDX:
+            return _parse_fdx(path, filename, max_tokens)
+        text = _read_text(path, filename)
+        if script_format == FOUNTAIN:
+            text = _normalize_fountain(text)
+        _check_tokens(filename, len(text), max_tokens)
+        return text
+    except ScriptIngestError:
+        raise
+    except Exception as e:
+        # Parser errors are re-raised as ours: they may not survive the trip
+        # back from the worker process, and callers only need the message.
+        raise ScriptIngestError(f"{filename} could not be read as {script_format}: {e}")
@@ -0,0 +1,167 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, List, Optional
+from app.core.config import settings
+from app.services.metrics import script_ingest_duration, script_ingest_files
+from app.services.script_formats import (
+    FDX, PDF, ScriptIngestError, ScriptTooLargeError, detect_format, estimate_tokens, parse_script_file,
+)
+
+# Bytes read up front to recognise a file's format
+_HEAD_BYTES = 1024
+
+
+class ScriptDocument:
+    """One uploaded script file: its text, or why it could not be read."""
+    def __init__(self, filename: str, script_format: str, size: int,
+                 text: Optional[str] = None, error: Optional[str] = None):
+        self.filename = filename
+        self.format = script_format
+        self.size = size
+        self.text = text
+        self.error = error
+
+
+class ScriptParser:
+    """
+    Process pool that extracts text from spooled script uploads, so PDF and
+    Final Draft parsing never holds the event loop or the GIL. The pool is
+    started on first use with the spawn method: workers only load
+    app.services.script_formats, never a fork of a process running threads.
+    Small plain-text and Fountain files are cheaper to decode in a thread
+    than to ship to a worker, as is everything when SCRIPT_INGEST_WORKERS is 0.
+    """
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # The parent's worker processes are not ours to use
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _in_pool(self, script_format: str, size: int) -> bool:
+        if self.workers <= 0:
+            return False
+        return script_format in (PDF, FDX) or size > settings.SCRIPT_INGEST_INLINE_MAX_BYTES
+
+    async def parse(self, path: str, filename: str, script_format: str, size: int) -> str:
+        args = (path, filename, script_format, settings.SCRIPT_INGEST_MAX_FILE_TOKENS)
+        if not self._in_pool(script_format, size):
+            return await asyncio.to_thread(parse_script_file, *args)
+        pool = self._executor()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, parse_script_file, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. a pathological PDF); the next parse gets a fresh pool
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise ScriptIngestError(f"{filename} could not be parsed: the parser process crashed")
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+script_parser = ScriptParser(workers=settings.SCRIPT_INGEST_WORKERS)
+
+
+async def _spool(file: Any, max_bytes: int):
+    """
+    Copies an upload to a spool file in fixed-size chunks, giving up as soon
+    as it passes max_bytes. Returns the path, size and first bytes.
+    """
+    filename = file.filename or "upload"
+    declared = getattr(file, "size", None)
+    if declared is not None and declared > max_bytes:
+        raise ScriptTooLargeError(f"{filename} is over the {max_bytes}-byte limit")
+    descriptor, path = tempfile.mkstemp(prefix="script-", suffix=os.path.splitext(filename)[1], dir=settings.SCRIPT_INGEST_SPOOL_DIR)
+    size, head = 0, b""
+    try:
+        with os.fdopen(descriptor, "wb") as out:
+            while True:
+                chunk = await file.read(settings.SCRIPT_INGEST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ScriptTooLargeError(f"{filename} is over the {max_bytes}-byte limit")
+                if len(head) < _HEAD_BYTES:
+                    head += chunk[:_HEAD_BYTES - len(head)]
+                await asyncio.to_thread(out.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, size, head
+
+
+async def _parse(path: str, filename: str, script_format: str, size: int) -> ScriptDocument:
+    started = time.perf_counter()
+    try:
+        text = await script_parser.parse(path, filename, script_format, size) if size else ""
+    except ScriptTooLargeError:
+        script_ingest_files.inc(format=script_format, outcome="too_large")
+        raise
+    except ScriptIngestError as e:
+        script_ingest_files.inc(format=script_format, outcome="unreadable")
+        return ScriptDocument(filename, script_format, size, error=str(e))
+    script_ingest_files.inc(format=script_format, outcome="parsed")
+    script_ingest_duration.observe(time.perf_counter() - started, format=script_format)
+    return ScriptDocument(filename, script_format, size, text=text)
+
+
+async def ingest_scripts(files: List[Any]) -> List[ScriptDocument]:
+    """
+    Reads uploaded script files (PDF, Final Draft, Fountain or UTF-8 text).
+    Uploads are spooled to disk one after another so the byte limits stop a
+    request before anything is parsed, then parsed in parallel. Raises
+    ScriptTooLargeError when a limit is passed; a file that cannot be read
+    comes back with an error instead of text.
+    """
+    if len(files) > settings.SCRIPT_INGEST_MAX_FILES:
+        raise ScriptTooLargeError(f"At most {settings.SCRIPT_INGEST_MAX_FILES} script files can be analyzed at once")
+    spooled = []
+    try:
+        total_bytes = 0
+        for file in files:
+            remaining = settings.SCRIPT_INGEST_MAX_TOTAL_BYTES - total_bytes
+            try:
+                path, size, head = await _spool(file, min(settings.SCRIPT_INGEST_MAX_FILE_BYTES, remaining))
+            except ScriptTooLargeError:
+                if remaining < settings.SCRIPT_INGEST_MAX_FILE_BYTES:
+                    raise ScriptTooLargeError(f"The scripts together are over the {settings.SCRIPT_INGEST_MAX_TOTAL_BYTES}-byte limit")
+                raise
+            spooled.append((path, file.filename or "upload", detect_format(file.filename or "", head), size))
+            total_bytes += size
+        # Every parse is awaited before the spool files are removed
+        results = await asyncio.gather(*(_parse(*entry) for entry in spooled), return_exceptions=True)
+    finally:
+        for path, *_ in spooled:
+            os.remove(path)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    documents = list(results)
+    total_tokens = sum(estimate_tokens(document.text) for document in documents if document.text)
+    if total_tokens > settings.SCRIPT_INGEST_MAX_TOTAL_TOKENS:
+        raise ScriptTooLargeError(f"The scripts together are over the {settings.SCRIPT_INGEST_MAX_TOTAL_TOKENS}-token limit")
+    return documents
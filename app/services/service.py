@@ -1,63 +1,272 @@
+import asyncio
+import json
 import os
 from fastapi import UploadFile
 from typing import Optional, List
-import requests
-import google.generativeai as genai
+from app import crud
 from app.core.config import settings
+from app.database import AsyncSessionLocal
+from app.services import kie_results
+from app.services.model_router import model_router, submit_generation
+from app.services.gemini import generate_text, stream_text
+from app.services.analysis_cache import analysis_cache, make_analysis_key
+from app.services.script_analysis import is_long_script, analyze_long_script, stream_long_script
+from app.services.script_ingest import ingest_scripts
+from app.services.dedup import generation_dedup, make_generation_key, CACHED, JOINED
+from app.services.outbox import result_outbox, result_forwarder
+from app.services.metrics import submission_clock
+from app.services.task_events import task_events
+from app.services.media_cache import schedule_ingest
+from app.services.callback_inbox import CallbackRow, callback_inbox, callback_processor
 
-# Configure Keys
+# Configure Keys (Gemini is configured lazily by the provider registry)
 os.environ["KIE_API_KEY"] = settings.KIE_API_KEY
-genai.configure(api_key=settings.GOOGLE_API_KEY)
 
 # --- Video & Image Generation ---
-async def submit_kie_job(prompt: str, internal_task_id: str, service_type: str):
-    headers = {"Authorization": f"Bearer {settings.KIE_API_KEY}", "Content-Type": "application/json"}
+
+# Inbox kind of webhooks whose results go to the main backend (the endpoints1 router)
+FORWARD_CALLBACK = "forward"
+
+def _kie_request(prompt: str, internal_task_id: str, service_type: str, quality: Optional[str] = None):
+    """Returns the callback URL and dedup key for a generation job."""
     callback_url = f"{settings.PUBLIC_SERVER_URL}/api/v1/kie-callback"
     
     # Store the internal task ID in the callback URL to get it back later
     # This is a robust way to track which job belongs to whom without a database
     callback_url_with_id = f"{callback_url}?internal_task_id={internal_task_id}"
 
-    payload = {}
-    if service_type == "video":
-        url = "https://api.kie.ai/api/v1/veo/generate"
-        payload = {"prompt": prompt, "model": "veo3", "aspectRatio": "16:9", "callBackUrl": callback_url_with_id}
-    elif service_type == "image":
-        url = "https://api.kie.ai/api/v1/gpt4o-image/generate"
-        payload = {"prompt": prompt, "filesUrl": [], "size": "1:1", "callBackUrl": callback_url_with_id}
-    else:
+    if service_type not in ("video", "image"):
         raise ValueError("Invalid service type specified")
+    key = make_generation_key(prompt, service_type, quality or settings.MODEL_ROUTER_DEFAULT_QUALITY)
+    return callback_url_with_id, key
+
+async def submit_kie_job(prompt: str, internal_task_id: str, service_type: str, quality: Optional[str] = None):
+    """
+    Submits one generation job to the model the router picks for its
+    quality tier. Errors propagate so the job queue can retry the
+    submission; fail_kie_job reports the final failure.
+    """
+    callback_url, key = _kie_request(prompt, internal_task_id, service_type, quality)
 
+    # Identical prompts share one paid Kie.ai job
+    role, value = generation_dedup.claim(key, internal_task_id)
+    if role == JOINED:
+        async with AsyncSessionLocal() as db:
+            joined = await crud.join_flight_async(db, leader_task_id=value, task_id=internal_task_id)
+        if not joined:
+            # The leader's callback was handled by another process, so there
+            # is no result here to join or reuse; this request starts its own job
+            generation_dedup.abandon(key)
+            role, value = generation_dedup.claim(key, internal_task_id)
+    if role == CACHED:
+        print(f"Serving {service_type} result for internal task {internal_task_id} from the result cache.")
+        await forward_result(internal_task_id, "completed", value)
+        return None
+    if role == JOINED:
+        # Recorded in the application database, so whichever process handles
+        # the leader's callback forwards this result too
+        print(f"Internal task {internal_task_id} joined an identical in-flight {service_type} job.")
+        return None
+
+    if value is not None:
+        # An earlier attempt of this job already got it to Kie.ai
+        return value
+
+    async with AsyncSessionLocal() as db:
+        await crud.start_flight_async(db, internal_task_id)
     print(f"Submitting {service_type} job to Kie.ai for internal task {internal_task_id}")
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    print("Kie.ai job submitted successfully.")
-    return response.json()
+    backend, external_task_id = await submit_generation(service_type, prompt, callback_url, quality, forward_task_id=internal_task_id)
+    generation_dedup.bind_external(key, external_task_id)
+    print(f"Kie.ai job submitted successfully to '{backend.name}'.")
+    return external_task_id
 
-# --- Script Analysis ---
-async def analyze_script(prompt: Optional[str] = None, files: Optional[List[UploadFile]] = None):
+async def fail_kie_job(prompt: str, internal_task_id: str, service_type: str, error: Exception, quality: Optional[str] = None):
+    """
+    Reports a submission that will not be retried as failed, together with
+    every request that joined it.
+    """
+    failed_ids = [internal_task_id]
+    try:
+        _, key = _kie_request(prompt, internal_task_id, service_type, quality)
+        failed_ids += generation_dedup.abandon(key)
+    except ValueError:
+        pass
+    # Requests that joined in other processes wait on it too
+    async with AsyncSessionLocal() as db:
+        stored_followers = await crud.finish_flights_async(db, [internal_task_id])
+    failed_ids += [task_id for task_id in stored_followers[internal_task_id] if task_id not in failed_ids]
+    for task_id in failed_ids:
+        await forward_result(task_id, "failed", f"Error: {error}")
+
+async def forward_result(task_id: str, status: str, result_url: str):
     """
-    Analyzes a screenplay by combining a text prompt and the content of uploaded files.
+    Queues a final task result for the main backend. The result is written
+    to the durable outbox and delivered by the background forwarder.
     """
-    model = genai.GenerativeModel('gemini-2.5-flash')
+    result_payload = {
+        "task_id": task_id,
+        "status": status,
+        "result_url": result_url
+    }
     
-    script_content = ""
-    # Read the content from each uploaded file
-    if files:
-        for file in files:
-            contents = await file.read()
-            try:
-                # Append the decoded text to our script_content string
-                script_content += contents.decode("utf-8") + "\n\n"
-            except UnicodeDecodeError:
-                # Handle cases where the file is not a valid text file
-                print(f"Warning: Could not decode file {file.filename}. It might not be a text file.")
-                continue
+    print(f"Queueing final result for main backend: {result_payload}")
+    await result_outbox.append(result_payload)
+    result_forwarder.notify()
+
+def _callback_result(callback_body: dict):
+    """Returns the (status, result_url) a Kie.ai webhook reports."""
+    if callback_body.get("code") == 200:
+        result_url = kie_results.callback_result_url(callback_body)
+        if result_url:
+            return "completed", result_url
+    return "failed", "Error: " + str(callback_body.get("msg", "Unknown error from callback"))
+
+async def accept_callback(raw_body: bytes, internal_task_id: str) -> bool:
+    """
+    Records a webhook in the callback inbox, keyed by Kie.ai's taskId and
+    the reported status. Returns False when Kie.ai already delivered it;
+    raises ValueError if the body is not a callback and InboxBusyError if
+    the inbox could not take it right now.
+    """
+    callback_body = json.loads(raw_body)
+    try:
+        status, _ = _callback_result(callback_body)
+        external_task_id = kie_results.callback_task_id(callback_body)
+    except AttributeError:
+        raise ValueError("Callback body is not a JSON object.")
+    # Failure callbacks may come without data; the internal ID still identifies the job
+    dedup_id = external_task_id or f"internal:{internal_task_id}"
+    return await callback_inbox.accept(FORWARD_CALLBACK, dedup_id, status, raw_body.decode(), internal_task_id)
+
+async def process_callbacks(rows: List[CallbackRow]):
+    """
+    Forwards a batch of webhooks from the inbox to the main backend, for the
+    job's own task and every identical request that joined it.
+    """
+    await forward_outcomes([
+        (row.internal_task_id, *_callback_result(row.body), kie_results.callback_task_id(row.body)) for row in rows
+    ])
+
+async def forward_outcomes(outcomes: List[tuple], source: str = "callback", require_running: bool = False) -> List[str]:
+    """
+    Forwards finished jobs, given as (internal_task_id, status, result_url,
+    external_task_id), to the main backend for each job's own task and
+    every identical request that joined it. With require_running, jobs the
+    job ledger does not show as running (another process already reported
+    them) are skipped. Returns the internal task IDs of the jobs forwarded.
+    """
+    # The job ledger holds the submission time, wherever the job was submitted
+    submissions = await model_router.finished([(external_task_id, status == "completed") for _, status, _, external_task_id in outcomes])
+    if require_running:
+        outcomes = [outcome for outcome in outcomes if outcome[3] in submissions]
+    if not outcomes:
+        return []
+    results = []
+    ingests = []
+    async with AsyncSessionLocal() as db:
+        stored_followers = await crud.finish_flights_async(db, [internal_task_id for internal_task_id, _, _, _ in outcomes if internal_task_id])
+    for internal_task_id, status, result_url, external_task_id in outcomes:
+        if external_task_id in submissions:
+            service_type, _, submitted_at = submissions[external_task_id]
+            submission_clock.finished(external_task_id, "succeeded" if status == "completed" else "failed", source,
+                                      submitted_at=submitted_at, service_type=service_type)
 
+        # Followers are recorded in the database by whichever process they joined in
+        follower_ids = generation_dedup.complete(result_url, success=status == "completed", task_id=internal_task_id)
+        follower_ids += [task_id for task_id in stored_followers.get(internal_task_id, []) if task_id not in follower_ids]
+        task_ids = [internal_task_id, *follower_ids]
+        results += [{"task_id": task_id, "status": status, "result_url": result_url} for task_id in task_ids]
+        if status == "completed":
+            ingests.append((result_url, task_ids))
+
+    print(f"Queueing {len(results)} final result(s) for main backend")
+    await result_outbox.append_many(results)
+    result_forwarder.notify()
+    for result in results:
+        task_events.publish({"id": result["task_id"], "status": result["status"], "result_url": result["result_url"]})
+
+    # With the media cache on, a local copy is made in the background and
+    # its /media URL is forwarded once stored
+    for result_url, task_ids in ingests:
+        await schedule_ingest(result_url, task_ids, forward=True)
+    return [internal_task_id for internal_task_id, _, _, _ in outcomes]
+
+async def _prune_flights(older_than: float):
+    async with AsyncSessionLocal() as db:
+        await crud.prune_flights_async(db, older_than)
+
+callback_processor.register(FORWARD_CALLBACK, process_callbacks, prune=_prune_flights)
+
+# --- Script Analysis ---
+ANALYSIS_MODEL = 'gemini-2.5-flash'
+
+async def read_script_files(files: Optional[List[UploadFile]]) -> str:
+    """
+    Returns the text of the uploaded script files, each followed by a blank
+    line. Files that cannot be read are skipped with a warning; an upload
+    over an ingestion limit raises ScriptTooLargeError.
+    """
+    if not files:
+        return ""
+    documents = await ingest_scripts(files)
+    for document in documents:
+        if document.error:
+            print(f"Warning: Skipping {document.filename}: {document.error}")
+    return "".join(f"{document.text}\n\n" for document in documents if document.error is None)
+
+def _build_analysis_prompt(instruction: str, script_content: str) -> str:
     # Combine the user's prompt (if any) with the file content
-    full_prompt = f"Analyze the following screenplay content based on this user instruction: '{prompt or 'Provide a general analysis.'}'\n\n--- SCRIPT CONTENT START ---\n{script_content}\n--- SCRIPT CONTENT END ---"
-    
-    print("Sending combined prompt and script to Gemini for analysis...")
-    response = model.generate_content(full_prompt)
+    return f"Analyze the following screenplay content based on this user instruction: '{instruction}'\n\n--- SCRIPT CONTENT START ---\n{script_content}\n--- SCRIPT CONTENT END ---"
+
+async def analyze_script(prompt: Optional[str] = None, script_content: str = "", project_id: Optional[str] = None):
+    """
+    Analyzes a screenplay by combining a text prompt and the text of the uploaded files (see read_script_files).
+    Analyses of unchanged scripts with the same instruction are served from the analysis cache.
+    With a project_id, only scenes changed since the project's previous draft are re-analyzed.
+    """
+    instruction = prompt or 'Provide a general analysis.'
+    cache_key = make_analysis_key(script_content, instruction, ANALYSIS_MODEL)
+    cached_analysis = await asyncio.to_thread(analysis_cache.get, cache_key)
+    if cached_analysis is not None:
+        print("Serving script analysis from cache.")
+        return {"analysis": cached_analysis}
+
+    if is_long_script(script_content, project_id):
+        print("Analyzing script scene by scene...")
+        analysis = await analyze_long_script(script_content, instruction, ANALYSIS_MODEL, project_id)
+    else:
+        full_prompt = _build_analysis_prompt(instruction, script_content)
+        
+        print("Sending combined prompt and script to Gemini for analysis...")
+        analysis = await generate_text(ANALYSIS_MODEL, full_prompt, "analyze")
+    await asyncio.to_thread(analysis_cache.set, cache_key, analysis)
     
-    return {"analysis": response.text}
\ No newline at end of file
+    return {"analysis": analysis}
+
+async def stream_analyze_script(prompt: Optional[str] = None, script_content: str = "", project_id: Optional[str] = None):
+    """
+    Streaming variant of analyze_script. Yields the analysis text chunk by
+    chunk as Gemini generates it.
+    """
+    instruction = prompt or 'Provide a general analysis.'
+    cache_key = make_analysis_key(script_content, instruction, ANALYSIS_MODEL)
+    cached_analysis = await asyncio.to_thread(analysis_cache.get, cache_key)
+    if cached_analysis is not None:
+        print("Serving script analysis from cache.")
+        yield cached_analysis
+        return
+
+    if is_long_script(script_content, project_id):
+        print("Analyzing script scene by scene...")
+        chunks = stream_long_script(script_content, instruction, ANALYSIS_MODEL, project_id)
+    else:
+        print("Streaming combined prompt and script analysis from Gemini...")
+        chunks = _stream_generate(_build_analysis_prompt(instruction, script_content))
+    parts = []
+    async for text in chunks:
+        parts.append(text)
+        yield text
+    await asyncio.to_thread(analysis_cache.set, cache_key, "".join(parts))
+
+def _stream_generate(full_prompt: str):
+    return stream_text(ANALYSIS_MODEL, full_prompt, "analyze_stream")
\ No newline at end of file
@@ -0,0 +1,38 @@
+import json
+from typing import AsyncIterator, Optional
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    # Stops reverse proxies such as nginx from buffering the stream
+    "X-Accel-Buffering": "no",
+}
+
+
+def format_sse(data, event: Optional[str] = None) -> str:
+    """
+    Formats one Server-Sent Event. Non-string data is JSON-encoded and
+    multi-line strings are split across several data fields.
+    """
+    if not isinstance(data, str):
+        data = json.dumps(data)
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_analysis_events(chunks: AsyncIterator[str]):
+    """
+    Wraps a stream of analysis text chunks as SSE: one 'chunk' event per
+    piece of text, then a final 'done' event, or an 'error' event if the
+    model call fails part-way.
+    """
+    try:
+        async for chunk in chunks:
+            if chunk:
+                yield format_sse({"text": chunk}, event="chunk")
+    except Exception as e:
+        print(f"Streaming analysis failed: {e}")
+        yield format_sse({"detail": str(e)}, event="error")
+        return
+    yield format_sse({"status": "completed"}, event="done")
@@ -0,0 +1,114 @@
+import asyncio
+import threading
+from collections import defaultdict
+from typing import Optional
+
+
+def task_event(task) -> dict:
+    """Builds the status event published for a Task row."""
+    return {
+        "id": task.id,
+        "owner_id": task.owner_id,
+        "prompt": task.prompt,
+        "status": task.status.value if task.status is not None else None,
+        "result_url": task.result_url,
+        "created_at": task.created_at,
+        "updated_at": task.updated_at,
+    }
+
+
+class Subscription:
+    """
+    One subscriber's queue of task events. Must be created on the event loop
+    that will read it, and closed when the subscriber goes away.
+    """
+    def __init__(self, hub: "TaskEventHub", user_id: Optional[str], task_id: Optional[str], max_queue: int):
+        self.hub = hub
+        self.user_id = user_id
+        self.task_id = task_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queue)
+
+    def deliver(self, event: dict):
+        # Slow subscribers lose their oldest events rather than block publishers.
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TaskEventHub:
+    """
+    In-process pub/sub for task status changes. Subscribers listen per user
+    or per task; publishing is safe from any thread.
+    """
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        self.published = 0
+        self._lock = threading.Lock()
+        self._by_user = defaultdict(set)
+        self._by_task = defaultdict(set)
+
+    def subscribe(self, user_id: Optional[str] = None, task_id: Optional[str] = None) -> Subscription:
+        subscription = Subscription(self, user_id, task_id, self.max_queue)
+        with self._lock:
+            if user_id is not None:
+                self._by_user[user_id].add(subscription)
+            if task_id is not None:
+                self._by_task[task_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            for index, key in ((self._by_user, subscription.user_id), (self._by_task, subscription.task_id)):
+                if key is None:
+                    continue
+                subscribers = index.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del index[key]
+
+    def publish(self, event: dict):
+        with self._lock:
+            subscribers = set(self._by_task.get(event.get("id"), ()))
+            if event.get("owner_id") is not None:
+                subscribers |= self._by_user.get(event["owner_id"], set())
+            self.published += 1
+        if not subscribers:
+            return
+
+        try:
+            current_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            current_loop = None
+        for subscription in subscribers:
+            if subscription.loop is current_loop:
+                subscription.deliver(event)
+            elif not subscription.loop.is_closed():
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "published": self.published,
+                "user_channels": len(self._by_user),
+                "task_channels": len(self._by_task),
+            }
+
+
+task_events = TaskEventHub()
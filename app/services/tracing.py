@@ -0,0 +1,179 @@
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+import httpx
+from app.core.config import settings
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """One timed operation. Use through Tracer.span() as a context manager."""
+    def __init__(self, tracer: "Tracer", name: str, attributes: dict):
+        parent = _current_span.get()
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = secrets.token_hex(8)
+        self.start = 0.0
+        self.duration = 0.0
+        self.error: Optional[str] = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._started
+        if exc is not None:
+            self.error = str(exc) or exc_type.__name__
+        _current_span.reset(self._token)
+        self.tracer.export(self)
+        return False
+
+    def to_zipkin(self, service_name: str) -> dict:
+        tags = {key: str(value) for key, value in self.attributes.items()}
+        if self.error:
+            tags["error"] = self.error
+        span = {
+            "traceId": self.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": int(self.start * 1_000_000),
+            "duration": max(1, int(self.duration * 1_000_000)),
+            "localEndpoint": {"serviceName": service_name},
+            "tags": tags,
+        }
+        if self.parent_id:
+            span["parentId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """
+    Minimal tracer. Spans are exported in Zipkin v2 JSON, which Zipkin,
+    Jaeger and the OpenTelemetry collector all accept: appended as JSON lines
+    to SPAN_EXPORT_PATH and/or POSTed in batches to SPAN_EXPORT_URL (e.g.
+    http://localhost:9411/api/v2/spans) from a background thread.
+    Tracing is off, at no cost, when neither is set.
+    """
+    def __init__(self, service_name: str, export_path: Optional[str], export_url: Optional[str], batch_size: int = 100):
+        self.service_name = service_name
+        self.export_path = export_path
+        self.export_url = export_url
+        self.batch_size = batch_size
+        self.enabled = bool(export_path or export_url)
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def span(self, name: str, **attributes):
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, attributes)
+
+    def record(self, name: str, start: float, duration: float, error: Optional[str] = None, **attributes):
+        """
+        Exports a span for an operation that has already finished, e.g. a
+        stream consumed across several event-loop steps. start is a time.time()
+        timestamp.
+        """
+        if not self.enabled:
+            return
+        span = Span(self, name, attributes)
+        span.start = start
+        span.duration = duration
+        span.error = error
+        self.export(span)
+
+    def export(self, span: Span):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(span.to_zipkin(self.service_name))
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=settings.SPAN_EXPORT_INTERVAL))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch: list):
+        if self.export_path:
+            try:
+                with open(self.export_path, "a") as out:
+                    out.writelines(json.dumps(span) + "\n" for span in batch)
+            except OSError as e:
+                print(f"TRACING: Could not write spans to {self.export_path}: {e}")
+        if self.export_url:
+            try:
+                httpx.post(self.export_url, json=batch, timeout=5).raise_for_status()
+            except Exception as e:
+                self.dropped += len(batch)
+                print(f"TRACING: Could not send {len(batch)} spans to {self.export_url}: {e}")
+
+    def flush(self, timeout: float = 5.0):
+        """Writes out queued spans; used at shutdown."""
+        batch = []
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+
+tracer = Tracer(
+    service_name=settings.SPAN_SERVICE_NAME,
+    export_path=settings.SPAN_EXPORT_PATH,
+    export_url=settings.SPAN_EXPORT_URL,
+)
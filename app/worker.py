@@ -0,0 +1,62 @@
+"""
+Standalone job worker, so Kie.ai submission throughput can be scaled
+separately from the API processes:
+
+    python -m app.worker --concurrency 64 --job-type kie_submit
+
+Run the API with JOB_WORKER_EMBEDDED=false when dedicated workers are used.
+Generation dedup state is per process, so identical prompts are only merged
+into one Kie.ai job when they are handled by the same worker.
+"""
+import argparse
+import asyncio
+import signal
+from app.core.config import settings
+from app.database import engine, async_engine
+from app.migrations import run_migrations
+from app.models import models
+from app.services import jobs  # registers the job handlers
+from app.services.job_queue import job_queue, JobWorker
+from app.services.outbox import result_forwarder
+from app.services.providers import providers
+from app.services.reconciler import task_reconciler
+
+
+async def run_worker(job_types: list, concurrency: int, reconcile: bool = False):
+    await asyncio.to_thread(models.Base.metadata.create_all, bind=engine)
+    await asyncio.to_thread(run_migrations, engine)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    worker = JobWorker(job_queue, job_types=job_types or None, concurrency=concurrency)
+    result_forwarder.start()
+    worker.start()
+    if reconcile:
+        task_reconciler.start()
+    try:
+        await stopping.wait()
+    finally:
+        print("JOBS: Shutting down worker...")
+        await task_reconciler.stop()
+        await worker.stop()
+        await result_forwarder.stop()
+        await providers.aclose()
+        await async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs queued background jobs.")
+    parser.add_argument("--job-type", action="append", dest="job_types", choices=sorted(job_queue.job_types),
+                        help="Only run jobs of this type (repeatable). Defaults to all types.")
+    parser.add_argument("--concurrency", type=int, default=settings.JOB_WORKER_CONCURRENCY)
+    parser.add_argument("--reconcile", action="store_true",
+                        help="Also poll Kie.ai for tasks whose callback never arrived.")
+    args = parser.parse_args()
+    asyncio.run(run_worker(args.job_types, args.concurrency, args.reconcile))
+
+
+if __name__ == "__main__":
+    main()
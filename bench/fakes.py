@@ -0,0 +1,350 @@
+"""
+Local stand-ins for the paid upstream services, for load tests and
+benchmarks. One process serves all of them:
+
+- Kie.ai: the Veo, Runway, GPT-4o image and Flux Kontext generate endpoints
+  hand out task IDs and POST the result, in each model's callback format,
+  to the request's callBackUrl --callback-delay seconds later (per model
+  with --model-delay veo3=30); their record endpoints answer reconciler
+  lookups. The result files themselves (--media-bytes each) are served
+  from /files.
+- Google Drive: /upload/drive/v3/files accepts simple (multipart) uploads and
+  resumable upload sessions, acknowledges every chunk and discards the bytes.
+- Main backend: /backend/save and /backend/save-batch accept the results
+  forwarded by endpoints1.
+
+GET /_bench/stats returns counters and, per prompt, when its callback was
+processed by the API; POST /_bench/reset clears them between scenarios.
+
+Gemini is faked in-process by FakeGemini below rather than over HTTP: the
+SDK's async client speaks gRPC, so bench/serve.py installs FakeGemini as the
+"gemini" provider instead.
+
+    python bench/fakes.py --port 8765 --callback-delay 2
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Optional
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+
+class FakeKie:
+    def __init__(self, callback_delay: float, callback_jitter: float, submit_latency: float, failure_rate: float, media_bytes: int,
+                 model_delays: Optional[dict] = None):
+        self.callback_delay = callback_delay
+        self.model_delays = model_delays or {}
+        self.callback_jitter = callback_jitter
+        self.submit_latency = submit_latency
+        self.failure_rate = failure_rate
+        self.media_block = random.randbytes(media_bytes)
+        self.jobs = {}
+        self.client: Optional[httpx.AsyncClient] = None
+        self.reset()
+
+    def reset(self):
+        self.submissions = 0
+        self.callbacks_sent = 0
+        self.callbacks_failed = 0
+        self.delivered = {}
+
+    async def submit(self, request: Request, kind: str, family: str):
+        if not request.headers.get("authorization"):
+            return JSONResponse({"code": 401, "msg": "Missing API key"}, status_code=401)
+        payload = await request.json()
+        if self.submit_latency:
+            await asyncio.sleep(self.submit_latency)
+        task_id = uuid.uuid4().hex
+        succeeded = random.random() >= self.failure_rate
+        self.jobs[task_id] = {
+            "prompt": payload.get("prompt"), "kind": kind, "family": family, "model": payload.get("model", family),
+            "succeeded": succeeded, "finished": False, "files_url": str(request.base_url).rstrip("/") + "/files",
+        }
+        self.submissions += 1
+        if payload.get("callBackUrl"):
+            asyncio.create_task(self._callback(task_id, payload["callBackUrl"]))
+        return {"code": 200, "msg": "success", "data": {"taskId": task_id}}
+
+    def _result_url(self, task_id: str) -> str:
+        job = self.jobs[task_id]
+        return f"{job['files_url']}/{task_id}.{'mp4' if job['kind'] == 'video' else 'png'}"
+
+    def file(self, name: str) -> Response:
+        # Unique content per file, so the media cache stores each one
+        media_type = "video/mp4" if name.endswith(".mp4") else "image/png"
+        return Response(name.encode() + self.media_block, media_type=media_type)
+
+    def _success_body(self, task_id: str) -> dict:
+        job = self.jobs[task_id]
+        url = self._result_url(task_id)
+        if job["family"] == "runway":
+            return {"code": 200, "msg": "success", "data": {"task_id": task_id, "video_id": task_id, "video_url": url, "image_url": ""}}
+        if job["family"] == "flux":
+            return {"code": 200, "msg": "success", "data": {"taskId": task_id, "info": {"resultImageUrl": url, "originImageUrl": url}}}
+        return {"code": 200, "msg": "success", "data": {"taskId": task_id, "info": {"resultUrls": [url]}}}
+
+    async def _callback(self, task_id: str, callback_url: str):
+        job = self.jobs[task_id]
+        delay = self.model_delays.get(job["model"], self.callback_delay)
+        await asyncio.sleep(max(0.0, delay + random.uniform(-self.callback_jitter, self.callback_jitter)))
+        job["finished"] = True
+        if job["succeeded"]:
+            body = self._success_body(task_id)
+        else:
+            body = {"code": 501, "msg": "Generation failed (fake)", "data": {"taskId": task_id}}
+        try:
+            response = await self.client.post(callback_url, json=body)
+            response.raise_for_status()
+            self.callbacks_sent += 1
+            self.delivered[job["prompt"]] = time.time()
+        except Exception as e:
+            self.callbacks_failed += 1
+            print(f"FAKE KIE: Callback for {task_id} failed: {e}")
+
+    def record(self, task_id: str):
+        job = self.jobs.get(task_id)
+        if job is None:
+            return {"code": 404, "msg": "Task not found", "data": None}
+        if job["family"] == "runway":
+            data = {"taskId": task_id, "state": "generating"}
+            if job["finished"]:
+                if job["succeeded"]:
+                    data.update(state="success", videoInfo={"videoUrl": self._result_url(task_id)})
+                else:
+                    data.update(state="fail", failMsg="Generation failed (fake)")
+            return {"code": 200, "msg": "success", "data": data}
+        data = {"taskId": task_id, "successFlag": 0}
+        if job["finished"]:
+            if job["succeeded"]:
+                response = {"resultImageUrl": self._result_url(task_id)} if job["family"] == "flux" else {"resultUrls": [self._result_url(task_id)]}
+                data.update(successFlag=1, response=response)
+            else:
+                data.update(successFlag=2, errorMessage="Generation failed (fake)")
+        return {"code": 200, "msg": "success", "data": data}
+
+
+class FakeDrive:
+    def __init__(self, chunk_latency: float):
+        self.chunk_latency = chunk_latency
+        self.sessions = {}
+        self.reset()
+
+    def reset(self):
+        self.uploads = 0
+        self.bytes_received = 0
+
+    async def create(self, request: Request):
+        if request.query_params.get("uploadType") == "resumable":
+            session_id = uuid.uuid4().hex
+            self.sessions[session_id] = 0
+            location = str(request.base_url).rstrip("/") + f"/upload/drive/v3/sessions/{session_id}"
+            return Response(status_code=200, headers={"Location": location})
+        # Simple and multipart uploads carry the whole file in one request
+        body = await request.body()
+        self.bytes_received += len(body)
+        self.uploads += 1
+        return {"id": uuid.uuid4().hex}
+
+    async def put_chunk(self, session_id: str, request: Request):
+        if session_id not in self.sessions:
+            return JSONResponse({"error": "Unknown upload session"}, status_code=404)
+        body = await request.body()
+        if self.chunk_latency:
+            await asyncio.sleep(self.chunk_latency)
+        self.sessions[session_id] += len(body)
+        self.bytes_received += len(body)
+        received = self.sessions[session_id]
+        total = request.headers.get("content-range", "").rsplit("/", 1)[-1]
+        if total != "*" and total.isdigit() and received >= int(total):
+            del self.sessions[session_id]
+            self.uploads += 1
+            return {"id": session_id}
+        headers = {"Range": f"bytes=0-{received - 1}"} if received else {}
+        return Response(status_code=308, headers=headers)
+
+
+class FakeBackend:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.results = 0
+        self.media_urls = []
+
+    def _record(self, result: dict):
+        self.results += 1
+        if "/media/" in (result.get("result_url") or ""):
+            self.media_urls = (self.media_urls + [result["result_url"]])[-100:]
+
+    async def save(self, request: Request):
+        self._record(await request.json())
+        return {"status": "saved"}
+
+    async def save_batch(self, request: Request):
+        for result in (await request.json()).get("results", []):
+            self._record(result)
+        return {"status": "saved"}
+
+
+def create_app(args) -> FastAPI:
+    model_delays = {name: float(delay) for name, delay in (item.split("=", 1) for item in args.model_delay)}
+    kie = FakeKie(args.callback_delay, args.callback_jitter, args.kie_latency, args.failure_rate, args.media_bytes, model_delays)
+    drive = FakeDrive(args.drive_latency)
+    backend = FakeBackend()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        kie.client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=200))
+        yield
+        await kie.client.aclose()
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.post("/veo/generate")
+    async def veo_generate(request: Request):
+        return await kie.submit(request, "video", "veo")
+
+    @app.post("/runway/generate")
+    async def runway_generate(request: Request):
+        return await kie.submit(request, "video", "runway")
+
+    @app.post("/gpt4o-image/generate")
+    async def image_generate(request: Request):
+        return await kie.submit(request, "image", "gpt4o-image")
+
+    @app.post("/flux/kontext/generate")
+    async def flux_generate(request: Request):
+        return await kie.submit(request, "image", "flux")
+
+    @app.get("/veo/record-info")
+    @app.get("/runway/record-detail")
+    @app.get("/gpt4o-image/record-info")
+    @app.get("/flux/kontext/record-info")
+    async def record_info(taskId: str):
+        return kie.record(taskId)
+
+    @app.get("/files/{name}")
+    async def kie_file(name: str):
+        return kie.file(name)
+
+    @app.post("/upload/drive/v3/files")
+    async def drive_create(request: Request):
+        return await drive.create(request)
+
+    @app.put("/upload/drive/v3/sessions/{session_id}")
+    async def drive_chunk(session_id: str, request: Request):
+        return await drive.put_chunk(session_id, request)
+
+    @app.post("/backend/save")
+    async def backend_save(request: Request):
+        return await backend.save(request)
+
+    @app.post("/backend/save-batch")
+    async def backend_save_batch(request: Request):
+        return await backend.save_batch(request)
+
+    @app.get("/_bench/stats")
+    async def stats():
+        return {
+            "kie_submissions": kie.submissions,
+            "kie_callbacks_sent": kie.callbacks_sent,
+            "kie_callbacks_failed": kie.callbacks_failed,
+            "drive_uploads": drive.uploads,
+            "drive_bytes": drive.bytes_received,
+            "backend_results": backend.results,
+            "backend_media_urls": backend.media_urls,
+            "delivered": kie.delivered,
+        }
+
+    @app.post("/_bench/reset")
+    async def reset():
+        kie.reset()
+        drive.reset()
+        backend.reset()
+        return {"status": "reset"}
+
+    return app
+
+
+class _FakeUsage:
+    def __init__(self, prompt: str, completion: str):
+        # Roughly four characters per token, like Gemini's English text
+        self.prompt_token_count = max(1, len(prompt) // 4)
+        self.candidates_token_count = max(1, len(completion) // 4)
+
+
+class _FakeResponse:
+    def __init__(self, text: str, usage_metadata: Optional[_FakeUsage] = None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class _FakeModel:
+    def __init__(self, gemini: "FakeGemini", model_name: str):
+        self.gemini = gemini
+        self.model_name = model_name
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        text = self.gemini.completion(prompt)
+        if not stream:
+            await asyncio.sleep(self.gemini.latency)
+            return _FakeResponse(text, _FakeUsage(prompt, text))
+        return self._stream(prompt, text)
+
+    async def _stream(self, prompt: str, text: str):
+        chunks = self.gemini.chunks
+        size = max(1, len(text) // chunks)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        await asyncio.sleep(self.gemini.first_chunk_latency)
+        for index, piece in enumerate(pieces):
+            if index:
+                await asyncio.sleep((self.gemini.latency - self.gemini.first_chunk_latency) / max(1, len(pieces) - 1))
+            last = index == len(pieces) - 1
+            yield _FakeResponse(piece, _FakeUsage(prompt, text) if last else None)
+
+
+class FakeGemini:
+    """
+    Stands in for the google.generativeai module: GenerativeModel(name)
+    .generate_content_async(prompt, stream=...) answers after `latency`
+    seconds, or streams `chunks` pieces with the first after
+    `first_chunk_latency` seconds.
+    """
+    def __init__(self, latency: float = 2.0, first_chunk_latency: float = 0.3, chunks: int = 20, completion_chars: int = 4000):
+        self.latency = latency
+        self.first_chunk_latency = min(first_chunk_latency, latency)
+        self.chunks = chunks
+        self.completion_chars = completion_chars
+
+    def GenerativeModel(self, model_name: str) -> _FakeModel:
+        return _FakeModel(self, model_name)
+
+    def completion(self, prompt: str) -> str:
+        line = f"Fake analysis of a {len(prompt)}-character prompt.\n"
+        return (line * (self.completion_chars // len(line) + 1))[:self.completion_chars]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--callback-delay", type=float, default=2.0, help="Seconds from submission to the Kie.ai callback")
+    parser.add_argument("--callback-jitter", type=float, default=0.5)
+    parser.add_argument("--model-delay", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="Callback delay for one model, e.g. veo3_fast=30 (repeatable)")
+    parser.add_argument("--kie-latency", type=float, default=0.05, help="Latency of Kie.ai submissions")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of Kie.ai jobs that fail")
+    parser.add_argument("--drive-latency", type=float, default=0.01, help="Latency per Drive upload chunk")
+    parser.add_argument("--media-bytes", type=int, default=4 * 1024 * 1024, help="Size of each generated result file")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,531 @@
+"""
+Load scenarios for the endpoints of app/api/endpoints.py and
+app/api/endpoints1.py, run against the local fakes of bench/fakes.py so no
+upstream API is called (or paid for).
+
+The runner starts the fakes and the API (bench/serve.py) as subprocesses in
+a scratch directory, then runs each scenario: --requests requests from
+--concurrency concurrent clients. Per scenario it reports throughput,
+latency p50/p95/p99/max, status codes, the API process's resident memory
+(before, after and peak), and for streaming endpoints the time to first
+byte. Generation scenarios also report end-to-end latency: from the request
+until the API has processed Kie.ai's callback for that prompt.
+
+Run from the repository root:
+
+    python bench/load.py                                  # every endpoints1 scenario
+    python bench/load.py --router endpoints               # every endpoints scenario
+    python bench/load.py --router endpoints --scenario generate-video --scenario tasks-list \\
+        --requests 2000 --concurrency 100
+    python bench/load.py --output today.json --baseline yesterday.json
+
+With --baseline, scenarios whose p95 latency or throughput got worse by more
+than --tolerance are listed and the exit status is 1, so the suite can gate
+CI. Any app setting can be overridden for the API process with --env, e.g.
+--env ADMISSION_GLOBAL_RATE=1000.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+SCREENPLAY_SCENE = """INT. COFFEE SHOP - DAY
+
+MAYA (30s) waits by the window, turning a paper cup in her hands.
+
+MAYA
+You said ten minutes. That was an hour ago.
+
+LEO (O.S.)
+Traffic. And a flat tire. And the dog.
+
+"""
+
+
+class Scenario:
+    """
+    One endpoint under load. build(i, ctx) returns the keyword arguments
+    of httpx.AsyncClient.request for the i-th request; prompts(kwargs) lists
+    the generation prompts a request submits, for end-to-end timing.
+    """
+    def __init__(self, name: str, routers: tuple, build: Callable, setup: Optional[Callable] = None,
+                 stream: bool = False, prompts: Optional[Callable] = None, first_line_only: bool = False):
+        self.name = name
+        self.routers = routers
+        self.build = build
+        self.setup = setup
+        self.stream = stream
+        self.prompts = prompts
+        self.first_line_only = first_line_only
+
+
+class Context:
+    """Shared state of one run: arguments, run ID and what setups created."""
+    def __init__(self, args):
+        self.args = args
+        self.run_id = uuid.uuid4().hex[:8]
+        self.task_ids = []
+        self.upload_id = None
+        self.media_path = None
+        self.fakes: Optional[httpx.AsyncClient] = None
+
+    def user(self, i: int) -> str:
+        return f"bench-user-{i % self.args.users}"
+
+    def prompt(self, kind: str, i: int, item: int = 0) -> str:
+        # Unique per request, so identical-request dedup does not collapse the load
+        return f"bench {self.run_id} {kind} {i}.{item}: a slow dolly shot through a neon-lit street"
+
+    def script(self, kind: str, i: int) -> bytes:
+        # Unique per request, so the analysis cache does not answer for Gemini
+        body = SCREENPLAY_SCENE * (self.args.script_chars // len(SCREENPLAY_SCENE) + 1)
+        return (f"BENCH DRAFT {self.run_id} {kind} {i}\n\n" + body[:self.args.script_chars]).encode()
+
+
+# --- Request builders ---
+def _generation(kind: str):
+    def build(i, ctx):
+        if ctx.args.router == "endpoints1":
+            body = {"internal_task_id": f"bench-{ctx.run_id}-{kind}-{i}", "prompt": ctx.prompt(kind, i), "user_id": ctx.user(i)}
+        else:
+            body = {"prompt": ctx.prompt(kind, i), "user_id": ctx.user(i)}
+        return {"method": "POST", "url": f"/api/v1/generate-{kind}", "json": body}
+    return build
+
+
+def _batch(kind: str):
+    def build(i, ctx):
+        items = [{"prompt": ctx.prompt(f"{kind}-batch", i, item), "internal_task_id": f"bench-{ctx.run_id}-{kind}-batch-{i}-{item}"}
+                 for item in range(ctx.args.batch_size)]
+        return {"method": "POST", "url": f"/api/v1/generate-{kind}/batch", "json": {"items": items, "user_id": ctx.user(i)}}
+    return build
+
+
+def _json_prompts(kwargs) -> list:
+    body = kwargs["json"]
+    return [item["prompt"] for item in body["items"]] if "items" in body else [body["prompt"]]
+
+
+def _analyze(path: str):
+    def build(i, ctx):
+        if ctx.args.router == "endpoints1":
+            return {"method": "POST", "url": path, "data": {"prompt": "Give notes on pacing."},
+                    "files": [("files", (f"draft-{i}.txt", ctx.script(path, i), "text/plain"))]}
+        return {"method": "POST", "url": path, "files": {"file": (f"draft-{i}.txt", ctx.script(path, i), "text/plain")}}
+    return build
+
+
+def _kie_callback(i, ctx):
+    external_id = f"bench-{ctx.run_id}-cb-{i}"
+    result_url = f"{str(ctx.fakes.base_url).rstrip('/')}/files/{external_id}.mp4"
+    body = {"code": 200, "msg": "success", "data": {"taskId": external_id, "info": {"resultUrls": [result_url]}}}
+    params = {"internal_task_id": f"bench-{ctx.run_id}-cb-{i}"} if ctx.args.router == "endpoints1" else None
+    return {"method": "POST", "url": "/api/v1/kie-callback", "params": params, "json": body}
+
+
+def _reader(ctx) -> str:
+    return f"bench-reader-{ctx.run_id}"
+
+
+async def _create_reader_tasks(client: httpx.AsyncClient, ctx: Context):
+    """Creates tasks for one user, for the task read scenarios."""
+    if ctx.task_ids:
+        return
+    for batch in range(max(1, ctx.args.reader_tasks // 100)):
+        items = [{"prompt": ctx.prompt("reader", batch, item)} for item in range(100)]
+        while True:
+            response = await client.post("/api/v1/generate-image/batch", json={"items": items, "user_id": _reader(ctx)})
+            if response.status_code != 429:
+                break
+            # One user's submissions are rate limited; raise ADMISSION_USER_RATE with --env to speed this up
+            print(f"Setup rate limited, retrying in {response.headers['Retry-After']}s...", flush=True)
+            await asyncio.sleep(int(response.headers["Retry-After"]))
+        response.raise_for_status()
+        ctx.task_ids.extend(response.json()["task_ids"])
+
+
+async def _create_upload(client: httpx.AsyncClient, ctx: Context):
+    ctx.upload_id = f"bench-{ctx.run_id}-progress"
+    response = await client.put("/api/v1/upload-to-drive/stream", params={"file_name": "progress.bin", "upload_id": ctx.upload_id},
+                                content=os.urandom(1024))
+    response.raise_for_status()
+
+
+async def _create_media(client: httpx.AsyncClient, ctx: Context):
+    """Generates one image and waits until the media cache has a copy of it."""
+    if ctx.media_path:
+        return
+    user_id = _reader(ctx)
+    body = {"prompt": ctx.prompt("media", 0), "user_id": user_id, "internal_task_id": f"bench-{ctx.run_id}-media"}
+    response = await client.post("/api/v1/generate-image", json=body)
+    response.raise_for_status()
+    deadline = time.monotonic() + ctx.args.e2e_timeout
+    while time.monotonic() < deadline:
+        if ctx.args.router == "endpoints1":
+            urls = (await ctx.fakes.get("/_bench/stats")).json()["backend_media_urls"]
+        else:
+            task = (await client.get(f"/api/v1/tasks/{response.json()['task_id']}", params={"user_id": user_id})).json()
+            urls = [task["result_url"]] if "/media/" in (task.get("result_url") or "") else []
+        if urls:
+            ctx.media_path = "/api/v1/media/" + urls[-1].rsplit("/", 1)[1]
+            return
+        await asyncio.sleep(0.5)
+    sys.exit("The generated image never reached the media cache; is MEDIA_CACHE_ENABLED off?")
+
+
+def _media_range(i, ctx):
+    # Scrubbing: random 256 KiB windows of the cached file
+    start = random.randrange(0, ctx.args.media_bytes - 256 * 1024)
+    return {"method": "GET", "url": ctx.media_path, "headers": {"Range": f"bytes={start}-{start + 256 * 1024 - 1}"}}
+
+
+SCENARIOS = [
+    Scenario("generate-video", ("endpoints", "endpoints1"), _generation("video"), prompts=_json_prompts),
+    Scenario("generate-image", ("endpoints", "endpoints1"), _generation("image"), prompts=_json_prompts),
+    Scenario("generate-video-batch", ("endpoints", "endpoints1"), _batch("video"), prompts=_json_prompts),
+    Scenario("generate-image-batch", ("endpoints", "endpoints1"), _batch("image"), prompts=_json_prompts),
+    Scenario("admission", ("endpoints", "endpoints1"), lambda i, ctx: {"method": "GET", "url": "/api/v1/admission"}),
+    Scenario("analyze-script", ("endpoints", "endpoints1"), _analyze("/api/v1/analyze-script")),
+    Scenario("analyze-script-stream", ("endpoints", "endpoints1"), _analyze("/api/v1/analyze-script/stream"), stream=True),
+    Scenario("kie-callback", ("endpoints", "endpoints1"), _kie_callback),
+    Scenario("media-range", ("endpoints", "endpoints1"), _media_range, setup=_create_media),
+    Scenario("media-full", ("endpoints", "endpoints1"), lambda i, ctx: {"method": "GET", "url": ctx.media_path}, setup=_create_media),
+    Scenario("tasks-list", ("endpoints",),
+             lambda i, ctx: {"method": "GET", "url": "/api/v1/tasks", "params": {"user_id": _reader(ctx), "limit": 50}},
+             setup=_create_reader_tasks),
+    Scenario("task-get", ("endpoints",),
+             lambda i, ctx: {"method": "GET", "url": f"/api/v1/tasks/{random.choice(ctx.task_ids)}", "params": {"user_id": _reader(ctx)}},
+             setup=_create_reader_tasks),
+    Scenario("task-wait", ("endpoints",),
+             lambda i, ctx: {"method": "GET", "url": f"/api/v1/tasks/{random.choice(ctx.task_ids)}/wait",
+                             "params": {"user_id": _reader(ctx), "timeout": 0}},
+             setup=_create_reader_tasks),
+    # Latency is the time until the stream's first line arrives
+    Scenario("task-events-stream", ("endpoints",),
+             lambda i, ctx: {"method": "GET", "url": "/api/v1/task-events/stream", "params": {"user_id": ctx.user(i)}},
+             stream=True, first_line_only=True),
+    Scenario("task-events-ws", ("endpoints",), lambda i, ctx: {"method": "WS", "url": "/api/v1/task-events/ws", "params": {"user_id": ctx.user(i)}}),
+    Scenario("upload-to-drive", ("endpoints",),
+             lambda i, ctx: {"method": "POST", "url": "/api/v1/upload-to-drive",
+                             "files": {"file": (f"clip-{i}.bin", os.urandom(ctx.args.upload_bytes), "application/octet-stream")}}),
+    Scenario("upload-to-drive-stream", ("endpoints",),
+             lambda i, ctx: {"method": "PUT", "url": "/api/v1/upload-to-drive/stream", "params": {"file_name": f"clip-{i}.bin"},
+                             "content": os.urandom(ctx.args.upload_bytes)}),
+    Scenario("upload-progress", ("endpoints",), lambda i, ctx: {"method": "GET", "url": "/api/v1/upload-to-drive/progress"}),
+    Scenario("upload-progress-get", ("endpoints",),
+             lambda i, ctx: {"method": "GET", "url": f"/api/v1/upload-to-drive/progress/{ctx.upload_id}"},
+             setup=_create_upload),
+]
+
+
+# --- Measurement ---
+def percentiles(values: list) -> dict:
+    ordered = sorted(values)
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 4) if ordered else None
+    return {
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": round(ordered[-1], 4) if ordered else None,
+    }
+
+
+def rss_mib(pid: int) -> Optional[float]:
+    """Resident memory of a process, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler:
+    """Samples a process's RSS in a thread while a scenario runs."""
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            rss = rss_mib(self.pid)
+            if rss is not None:
+                self.peak = rss if self.peak is None else max(self.peak, rss)
+            if self._stop.wait(self.interval):
+                return
+
+
+async def _websocket_request(base_url: str, url: str, params: dict):
+    import websockets
+    query = "&".join(f"{key}={value}" for key, value in params.items())
+    async with websockets.connect(f"{base_url.replace('http', 'ws', 1)}{url}?{query}"):
+        pass
+    return 101
+
+
+async def _request(client: httpx.AsyncClient, scenario: Scenario, kwargs: dict):
+    """Sends one request; returns (status, seconds to first byte or None)."""
+    if kwargs["method"] == "WS":
+        return await _websocket_request(str(client.base_url), kwargs["url"], kwargs.get("params") or {}), None
+    if not scenario.stream:
+        response = await client.request(**kwargs)
+        return response.status_code, None
+    started = time.perf_counter()
+    first_byte = None
+    async with client.stream(**kwargs) as response:
+        async for _ in response.aiter_lines():
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+                if scenario.first_line_only:
+                    break
+    return response.status_code, first_byte
+
+
+async def run_scenario(client: httpx.AsyncClient, fakes: httpx.AsyncClient, scenario: Scenario, ctx: Context, api_pid: int) -> dict:
+    args = ctx.args
+    if scenario.setup is not None:
+        await scenario.setup(client, ctx)
+    await fakes.post("/_bench/reset")
+
+    latencies, first_bytes, statuses, submitted = [], [], {}, {}
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < args.requests:
+            index = next_index
+            next_index += 1
+            kwargs = scenario.build(index, ctx)
+            started_at = time.time()
+            started = time.perf_counter()
+            try:
+                status, first_byte = await _request(client, scenario, kwargs)
+            except Exception as e:
+                status = type(e).__name__
+                first_byte = None
+            latencies.append(time.perf_counter() - started)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if first_byte is not None:
+                first_bytes.append(first_byte)
+            if scenario.prompts is not None and status == 200:
+                for prompt in scenario.prompts(kwargs):
+                    submitted[prompt] = started_at
+
+    rss_before = rss_mib(api_pid)
+    with MemorySampler(api_pid) as memory:
+        wall_started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - wall_started
+        end_to_end = await _end_to_end(fakes, submitted, args.e2e_timeout) if submitted else None
+
+    result = {
+        "requests": len(latencies),
+        "concurrency": args.concurrency,
+        "statuses": statuses,
+        "seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "latency_seconds": percentiles(latencies),
+        "memory_mib": {"before": rss_before, "after": rss_mib(api_pid), "peak": memory.peak},
+    }
+    if first_bytes:
+        result["first_byte_seconds"] = percentiles(first_bytes)
+    if end_to_end is not None:
+        result["end_to_end"] = end_to_end
+    return result
+
+
+async def _end_to_end(fakes: httpx.AsyncClient, submitted: dict, timeout: float) -> dict:
+    """Waits for the fake Kie.ai to deliver every submitted prompt's callback."""
+    deadline = time.monotonic() + timeout
+    while True:
+        stats = (await fakes.get("/_bench/stats")).json()
+        delivered = stats["delivered"]
+        done = [delivered[prompt] - started for prompt, started in submitted.items() if prompt in delivered]
+        if len(done) == len(submitted) or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(0.5)
+    return {
+        "submitted": len(submitted),
+        "completed": len(done),
+        "latency_seconds": percentiles(done),
+        "kie_submissions": stats["kie_submissions"],
+        "callbacks_failed": stats["kie_callbacks_failed"],
+    }
+
+
+# --- Processes ---
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url: str, process: subprocess.Popen, log_path: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            with open(log_path) as log:
+                sys.exit(f"{url} exited during startup:\n{log.read()[-4000:]}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    sys.exit(f"{url} did not come up within {timeout}s; see {log_path}")
+
+
+def start_processes(args, workdir: str):
+    fakes_port, api_port = free_port(), free_port()
+    fakes_log = os.path.join(workdir, "fakes.log")
+    api_log = os.path.join(workdir, "api.log")
+    fakes = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fakes.py"), "--port", str(fakes_port),
+         "--callback-delay", str(args.callback_delay), "--kie-latency", str(args.kie_latency),
+         "--failure-rate", str(args.failure_rate), "--drive-latency", str(args.drive_latency),
+         "--media-bytes", str(args.media_bytes),
+         *[option for delay in args.model_delay for option in ("--model-delay", delay)]],
+        cwd=workdir, stdout=open(fakes_log, "w"), stderr=subprocess.STDOUT,
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+    for override in args.env:
+        name, _, value = override.partition("=")
+        env[name] = value
+    api = subprocess.Popen(
+        [sys.executable, "-W", "ignore", os.path.join(BENCH_DIR, "serve.py"), "--port", str(api_port),
+         "--fakes-url", f"http://127.0.0.1:{fakes_port}", "--router", args.router,
+         "--gemini-latency", str(args.gemini_latency), "--gemini-first-chunk", str(args.gemini_first_chunk)],
+        cwd=workdir, env=env, stdout=open(api_log, "w"), stderr=subprocess.STDOUT,
+    )
+    wait_until_up(f"http://127.0.0.1:{fakes_port}/_bench/stats", fakes, fakes_log)
+    wait_until_up(f"http://127.0.0.1:{api_port}/", api, api_log)
+    return fakes, api, f"http://127.0.0.1:{fakes_port}", f"http://127.0.0.1:{api_port}"
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Scenarios that are slower (p95) or serve less (throughput) than the baseline."""
+    regressions = []
+    for name, result in report["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        p95, old_p95 = result["latency_seconds"]["p95"], before["latency_seconds"]["p95"]
+        if p95 is not None and old_p95 and p95 > old_p95 * (1 + tolerance):
+            regressions.append(f"{name}: p95 {old_p95}s -> {p95}s")
+        rps, old_rps = result["throughput_rps"], before["throughput_rps"]
+        if rps is not None and old_rps and rps < old_rps * (1 - tolerance):
+            regressions.append(f"{name}: throughput {old_rps} -> {rps} req/s")
+    return regressions
+
+
+def print_table(report: dict):
+    print(f"{'scenario':<24}{'req':>6}{'err':>6}{'req/s':>9}{'p50':>8}{'p95':>8}{'p99':>8}{'rss MiB':>9}{'e2e p95':>9}")
+    for name, result in report["scenarios"].items():
+        errors = sum(count for status, count in result["statuses"].items() if not status.startswith(("2", "101")))
+        latency = result["latency_seconds"]
+        e2e = result.get("end_to_end", {}).get("latency_seconds", {}).get("p95")
+        print(f"{name:<24}{result['requests']:>6}{errors:>6}{result['throughput_rps'] or 0:>9}"
+              f"{latency['p50'] or 0:>8}{latency['p95'] or 0:>8}{latency['p99'] or 0:>8}"
+              f"{result['memory_mib']['peak'] or 0:>9}{e2e if e2e is not None else '-':>9}")
+
+
+async def run(args, api_url: str, fakes_url: str, api_pid: int) -> dict:
+    ctx = Context(args)
+    names = args.scenario or [s.name for s in SCENARIOS if args.router in s.routers]
+    scenarios = {s.name: s for s in SCENARIOS}
+    report = {"router": args.router, "run_id": ctx.run_id, "settings": vars(args), "scenarios": {}}
+    limits = httpx.Limits(max_connections=args.concurrency + 10, max_keepalive_connections=args.concurrency + 10)
+    async with httpx.AsyncClient(base_url=api_url, timeout=args.timeout, limits=limits) as client, \
+            httpx.AsyncClient(base_url=fakes_url, timeout=30) as fakes:
+        ctx.fakes = fakes
+        for name in names:
+            scenario = scenarios.get(name)
+            if scenario is None or args.router not in scenario.routers:
+                print(f"Skipping {name}: not an endpoint of {args.router}")
+                continue
+            print(f"Running {name} ({args.requests} requests, concurrency {args.concurrency})...", flush=True)
+            report["scenarios"][name] = await run_scenario(client, fakes, scenario, ctx, api_pid)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--router", choices=["endpoints", "endpoints1"], default="endpoints1")
+    parser.add_argument("--scenario", action="append", help="Scenario to run (repeatable); default: all for the router")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=1000, help="Distinct user IDs the requests are spread over")
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--reader-tasks", type=int, default=100, help="Tasks created for the task read scenarios")
+    parser.add_argument("--script-chars", type=int, default=20000)
+    parser.add_argument("--upload-bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--media-bytes", type=int, default=4 * 1024 * 1024, help="Size of each fake generated result")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--callback-delay", type=float, default=2.0)
+    parser.add_argument("--model-delay", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="Callback delay of one Kie.ai model in the fakes (repeatable)")
+    parser.add_argument("--kie-latency", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--drive-latency", type=float, default=0.01)
+    parser.add_argument("--gemini-latency", type=float, default=2.0)
+    parser.add_argument("--gemini-first-chunk", type=float, default=0.3)
+    parser.add_argument("--e2e-timeout", type=float, default=120.0, help="How long to wait for callbacks after a generation scenario")
+    parser.add_argument("--env", action="append", default=[], help="NAME=VALUE setting for the API process (repeatable)")
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="filmmaker-bench-") as workdir:
+        fakes, api, fakes_url, api_url = start_processes(args, workdir)
+        try:
+            report = asyncio.run(run(args, api_url, fakes_url, api.pid))
+        finally:
+            for process in (api, fakes):
+                process.terminate()
+                try:
+                    process.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    print_table(report)
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
+    if args.baseline:
+        with open(args.baseline) as previous:
+            regressions = compare(report, json.load(previous), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
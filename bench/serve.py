@@ -0,0 +1,92 @@
+"""
+Runs the API wired to the local fakes of bench/fakes.py: Kie.ai, Drive and
+the main backend point at the fakes server, and Gemini is replaced by the
+in-process FakeGemini provider. The media cache is on. Everything the app
+writes (SQLite database, outbox, callback inbox, media, script upload spool
+files, Drive token and discovery document) goes to the working directory,
+so start it from a scratch directory.
+bench/load.py does all of this; to run it by hand:
+
+    cd $(mktemp -d) && PYTHONPATH=/path/to/repo python /path/to/repo/bench/serve.py \\
+        --port 8000 --fakes-url http://127.0.0.1:8765 --router endpoints
+
+Environment variables that are already set take precedence, so any app
+setting can be overridden for a run.
+"""
+import argparse
+import json
+import os
+import sys
+
+BENCH_TOKEN = {
+    "token": "bench-access-token",
+    "refresh_token": "bench-refresh-token",
+    "client_id": "bench",
+    "client_secret": "bench",
+    "scopes": ["https://www.googleapis.com/auth/drive.file"],
+    "expiry": "2099-01-01T00:00:00Z",
+}
+
+
+def configure(args):
+    workdir = os.getcwd()
+    fakes_url = args.fakes_url.rstrip("/")
+    defaults = {
+        "GOOGLE_API_KEY": "bench",
+        "GOOGLE_DRIVE_CREDENTIALS_FILE": os.path.join(workdir, "credentials.json"),
+        "GOOGLE_CLOUD_PROJECT_ID": "bench",
+        "GOOGLE_CLOUD_LOCATION": "us-central1",
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "KIE_API_KEY": "bench",
+        "KIE_API_ROOT": fakes_url,
+        "PUBLIC_SERVER_URL": f"http://{args.host}:{args.port}",
+        "MAIN_BACKEND_SAVE_URL": f"{fakes_url}/backend/save",
+        "DRIVE_UPLOAD_URL": f"{fakes_url}/upload/drive/v3/files",
+        "DRIVE_DISCOVERY_CACHE_PATH": os.path.join(workdir, "drive_v3_discovery.json"),
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.sqlite3"),
+        "CALLBACK_INBOX_PATH": os.path.join(workdir, "callback_inbox.sqlite3"),
+        "API_ROUTER": args.router,
+        "MEDIA_CACHE_ENABLED": "true",
+        "MEDIA_CACHE_DIR": os.path.join(workdir, "media_cache"),
+        "SCRIPT_INGEST_SPOOL_DIR": workdir,
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+    # A token that never expires, so the Drive client never tries to refresh it
+    with open("token.json", "w") as token:
+        json.dump(BENCH_TOKEN, token)
+
+    # The simple-upload path uses googleapiclient, which takes its endpoints
+    # from the discovery document; point its root URL at the fakes.
+    from googleapiclient import discovery_cache
+    document = json.loads(discovery_cache.get_static_doc("drive", "v3"))
+    document["rootUrl"] = document["mtlsRootUrl"] = f"{fakes_url}/"
+    with open(os.environ["DRIVE_DISCOVERY_CACHE_PATH"], "w") as cached:
+        json.dump(document, cached)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fakes-url", default="http://127.0.0.1:8765")
+    parser.add_argument("--router", choices=["endpoints", "endpoints1"], default="endpoints1")
+    parser.add_argument("--gemini-latency", type=float, default=2.0)
+    parser.add_argument("--gemini-first-chunk", type=float, default=0.3)
+    parser.add_argument("--gemini-chunks", type=int, default=20)
+    args = parser.parse_args()
+    configure(args)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import uvicorn
+    from fakes import FakeGemini
+    from app.services.providers import providers
+    providers.register("gemini", lambda: FakeGemini(args.gemini_latency, args.gemini_first_chunk, args.gemini_chunks))
+    from app.main import app
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Measures API cold start: the time from interpreter start to the app being
+ready to serve (app.main imported and the FastAPI lifespan started).
+
+Each run happens in a fresh subprocess so nothing is cached in memory.
+Run from the repository root with the usual environment variables set:
+
+    python bench/startup.py --runs 10
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import asyncio, json, time
+started = time.perf_counter()
+from app.main import app
+imported = time.perf_counter()
+
+async def start():
+    async with app.router.lifespan_context(app):
+        ready = time.perf_counter()
+    return ready
+
+ready = asyncio.run(start())
+print(json.dumps({"import": imported - started, "ready": ready - started}))
+"""
+
+
+def run_once(python: str) -> dict:
+    output = subprocess.run(
+        [python, "-W", "ignore", "-c", PROBE],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(values: list) -> dict:
+    return {
+        "min": round(min(values), 3),
+        "median": round(statistics.median(values), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--python", default=sys.executable)
+    args = parser.parse_args()
+
+    results = [run_once(args.python) for _ in range(args.runs)]
+    report = {
+        "runs": args.runs,
+        "import_seconds": summarize([r["import"] for r in results]),
+        "import_to_ready_seconds": summarize([r["ready"] for r in results]),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+# Settings are read when app.core.config is imported, so the environment is
+# set up before any app module is.
+_workdir = tempfile.mkdtemp(prefix="filmmaker-tests-")
+os.environ.update({
+    "GOOGLE_API_KEY": "test",
+    "GOOGLE_DRIVE_CREDENTIALS_FILE": os.path.join(_workdir, "credentials.json"),
+    "GOOGLE_CLOUD_PROJECT_ID": "test",
+    "GOOGLE_CLOUD_LOCATION": "us-central1",
+    "DATABASE_URL": f"sqlite:///{os.path.join(_workdir, 'app.db')}",
+    "KIE_API_KEY": "test",
+    "PUBLIC_SERVER_URL": "http://testserver",
+    "MAIN_BACKEND_SAVE_URL": "http://backend.invalid/save",
+    "OUTBOX_PATH": os.path.join(_workdir, "outbox.sqlite3"),
+    "CALLBACK_INBOX_PATH": os.path.join(_workdir, "callback_inbox.sqlite3"),
+    "ANALYSIS_CACHE_PATH": os.path.join(_workdir, "analysis_cache.sqlite3"),
+    "SCRIPT_INGEST_WORKERS": "0",
+    "PROVIDER_WARMUP": "[]",
+})
+
+from app.database import Base, async_engine, engine  # noqa: E402
+from app.models import models  # noqa: E402,F401
+
+Base.metadata.create_all(bind=engine)
+
+
+@pytest.fixture
+def run():
+    """Runs a coroutine on a fresh event loop; pooled connections do not outlive it."""
+    def run(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await async_engine.dispose()
+        return asyncio.run(main())
+    return run
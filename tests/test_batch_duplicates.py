@@ -0,0 +1,70 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app import crud
+from app.api import endpoints, endpoints1
+from app.database import AsyncSessionLocal
+from app.services.jobs import submission_admission
+
+
+def _client(router) -> TestClient:
+    app = FastAPI()
+    app.include_router(router)
+    return TestClient(app)
+
+
+def _admitted() -> int:
+    return submission_admission.admitted["bulk"]
+
+
+@pytest.mark.parametrize("router", [endpoints.router, endpoints1.router])
+def test_repeated_id_in_a_batch_is_rejected_before_admission(router):
+    before = _admitted()
+    response = _client(router).post("/generate-video/batch", json={
+        "user_id": "dup-user",
+        "items": [
+            {"prompt": "a", "internal_task_id": "same-id"},
+            {"prompt": "b", "internal_task_id": "same-id"},
+        ],
+    })
+    assert response.status_code == 422
+    assert "unique" in response.json()["detail"]
+    assert _admitted() == before
+
+
+def test_existing_task_id_is_a_conflict_before_admission(run):
+    async def create():
+        async with AsyncSessionLocal() as db:
+            await crud.create_tasks_async(db, items=[("existing-id", "a")], owner_id="conflict-user")
+
+    run(create())
+    before = _admitted()
+    response = _client(endpoints.router).post("/generate-image/batch", json={
+        "user_id": "conflict-user",
+        "items": [{"prompt": "a", "internal_task_id": "existing-id"}, {"prompt": "b", "internal_task_id": "new-id"}],
+    })
+    assert response.status_code == 409
+    assert "existing-id" in response.json()["detail"]
+    assert _admitted() == before
+
+
+def test_conflict_after_admission_refunds_it(run, monkeypatch):
+    async def create():
+        async with AsyncSessionLocal() as db:
+            await crud.create_tasks_async(db, items=[("raced-id", "a")], owner_id="race-user")
+
+    async def no_existing_ids(db, task_ids):
+        # The row appears between the existence check and the insert
+        return set()
+
+    run(create())
+    monkeypatch.setattr(crud, "get_existing_task_ids_async", no_existing_ids)
+    before = _admitted()
+    response = _client(endpoints.router).post("/generate-image/batch", json={
+        "user_id": "race-user",
+        "items": [{"prompt": "a", "internal_task_id": "raced-id"}],
+    })
+    assert response.status_code == 409
+    assert _admitted() == before
+    assert submission_admission._bucket("race-user").tokens == pytest.approx(submission_admission.user_burst, abs=0.01)
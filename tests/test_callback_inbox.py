@@ -0,0 +1,55 @@
+from app.services.callback_inbox import CallbackInbox, CallbackProcessor
+
+
+def test_repeated_callback_is_dropped(tmp_path, run):
+    inbox = CallbackInbox(str(tmp_path / "inbox.sqlite3"))
+
+    async def scenario():
+        first = await inbox.accept("forward", "ext-1", "completed", '{"code": 200}', "task-1")
+        repeat = await inbox.accept("forward", "ext-1", "completed", '{"code": 200}', "task-1")
+        # Another state of the same job is a different callback
+        other_state = await inbox.accept("forward", "ext-1", "failed", '{"code": 500}', "task-1")
+        return first, repeat, other_state
+
+    assert run(scenario()) == (True, False, True)
+
+
+def test_processed_callback_stays_deduplicated(tmp_path, run):
+    inbox = CallbackInbox(str(tmp_path / "inbox.sqlite3"))
+    processor = CallbackProcessor(inbox)
+    handled = []
+
+    async def handler(rows):
+        handled.extend(row.external_id for row in rows)
+
+    processor.register("forward", handler)
+
+    async def scenario():
+        await inbox.accept("forward", "ext-1", "completed", '{"code": 200}', "task-1")
+        drained = await processor.drain_once()
+        repeat = await inbox.accept("forward", "ext-1", "completed", '{"code": 200}', "task-1")
+        return drained, repeat, await processor.drain_once(), await inbox.stats()
+
+    drained, repeat, drained_again, stats = run(scenario())
+    assert (drained, repeat, drained_again) == (1, False, 0)
+    assert handled == ["ext-1"]
+    assert stats["done"]["count"] == 1
+
+
+def test_failed_handler_leaves_callback_for_retry(tmp_path, run):
+    inbox = CallbackInbox(str(tmp_path / "inbox.sqlite3"))
+    processor = CallbackProcessor(inbox)
+
+    async def handler(rows):
+        raise RuntimeError("backend down")
+
+    processor.register("forward", handler)
+
+    async def scenario():
+        await inbox.accept("forward", "ext-1", "completed", "{}", "task-1")
+        await processor.drain_once()
+        return await inbox.stats()
+
+    stats = run(scenario())
+    assert stats["pending"]["count"] == 1
+    assert processor.failed_attempts == 1
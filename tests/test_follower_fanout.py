@@ -0,0 +1,103 @@
+import pytest
+
+from app.core.config import settings
+from app.services import service
+from app.services.callback_inbox import CallbackRow
+from app.services.dedup import GenerationDeduplicator
+from app.services.outbox import ResultOutbox
+
+
+def _dedup():
+    return GenerationDeduplicator(result_ttl=60, max_results=10, inflight_timeout=60)
+
+
+class _Backend:
+    name = "test-model"
+
+
+@pytest.fixture
+def forwarded(tmp_path, monkeypatch):
+    """Submissions go to a fake Kie.ai; forwarded results land in a private outbox."""
+    outbox = ResultOutbox(str(tmp_path / "outbox.sqlite3"))
+    submitted = []
+
+    async def submit_generation(service_type, prompt, callback_url, quality=None, forward_task_id=None):
+        submitted.append(forward_task_id)
+        return _Backend, f"ext-{forward_task_id}"
+
+    monkeypatch.setattr(service, "result_outbox", outbox)
+    monkeypatch.setattr(service, "submit_generation", submit_generation)
+    monkeypatch.setattr(service, "generation_dedup", _dedup())
+    return outbox, submitted
+
+
+def _callback(external_id, internal_task_id, url):
+    body = {"code": 200, "data": {"taskId": external_id, "info": {"resultUrls": [url]}}}
+    return CallbackRow(1, service.FORWARD_CALLBACK, external_id, "completed", internal_task_id, body, 1, 0.0)
+
+
+async def _forwarded(outbox):
+    return sorted((payload["task_id"], payload["status"], payload["result_url"]) for _, payload, _ in await outbox.claim(50))
+
+
+def test_identical_requests_share_one_job(forwarded, run):
+    outbox, submitted = forwarded
+
+    async def scenario():
+        external_id = await service.submit_kie_job("a red fox", "fanout-leader", "video")
+        joined = await service.submit_kie_job("a red fox", "fanout-follower", "video")
+        await service.process_callbacks([_callback(external_id, "fanout-leader", "http://r/fox.mp4")])
+        return joined, await _forwarded(outbox)
+
+    joined, results = run(scenario())
+    assert joined is None
+    assert submitted == ["fanout-leader"]
+    assert results == [
+        ("fanout-follower", "completed", "http://r/fox.mp4"),
+        ("fanout-leader", "completed", "http://r/fox.mp4"),
+    ]
+
+
+def test_callback_in_another_process_reaches_stored_followers(forwarded, run, monkeypatch):
+    outbox, submitted = forwarded
+
+    async def scenario():
+        external_id = await service.submit_kie_job("a blue whale", "remote-leader", "image")
+        await service.submit_kie_job("a blue whale", "remote-follower", "image")
+        # The process handling the callback never saw either request
+        monkeypatch.setattr(service, "generation_dedup", _dedup())
+        await service.process_callbacks([_callback(external_id, "remote-leader", "http://r/whale.png")])
+        return await _forwarded(outbox)
+
+    assert run(scenario()) == [
+        ("remote-follower", "completed", "http://r/whale.png"),
+        ("remote-leader", "completed", "http://r/whale.png"),
+    ]
+    assert submitted == ["remote-leader"]
+
+
+def test_failed_submission_fails_followers(forwarded, run):
+    outbox, _ = forwarded
+
+    async def scenario():
+        await service.submit_kie_job("a green owl", "failing-leader", "image")
+        await service.submit_kie_job("a green owl", "failing-follower", "image")
+        await service.fail_kie_job("a green owl", "failing-leader", "image", RuntimeError("rejected"))
+        return await _forwarded(outbox)
+
+    assert [(task_id, status) for task_id, status, _ in run(scenario())] == [
+        ("failing-follower", "failed"),
+        ("failing-leader", "failed"),
+    ]
+
+
+def test_default_quality_is_part_of_the_key(forwarded, run):
+    _, submitted = forwarded
+
+    async def scenario():
+        await service.submit_kie_job("a grey cat", "quality-default", "image")
+        await service.submit_kie_job("a grey cat", "quality-explicit", "image", quality=settings.MODEL_ROUTER_DEFAULT_QUALITY)
+        await service.submit_kie_job("a grey cat", "quality-other", "image", quality="standard")
+
+    run(scenario())
+    assert submitted == ["quality-default", "quality-other"]
@@ -0,0 +1,53 @@
+import time
+
+from app.core.config import settings
+from app.services.outbox import ResultOutbox
+
+
+def test_each_row_is_claimed_by_one_forwarder(tmp_path, run):
+    path = str(tmp_path / "outbox.sqlite3")
+    first, second = ResultOutbox(path), ResultOutbox(path)
+
+    async def scenario():
+        await first.append_many([{"task_id": str(i)} for i in range(10)])
+        claimed_first = await first.claim(6)
+        claimed_second = await second.claim(6)
+        return claimed_first, claimed_second, await first.claim(10)
+
+    claimed_first, claimed_second, left = run(scenario())
+    first_ids = {row_id for row_id, _, _ in claimed_first}
+    second_ids = {row_id for row_id, _, _ in claimed_second}
+    assert len(first_ids) == 6 and len(second_ids) == 4
+    assert not first_ids & second_ids
+    assert left == []
+
+
+def test_ack_deletes_and_retry_releases(tmp_path, run):
+    outbox = ResultOutbox(str(tmp_path / "outbox.sqlite3"))
+
+    async def scenario():
+        await outbox.append_many([{"task_id": "sent"}, {"task_id": "failed"}])
+        sent, failed = await outbox.claim(10)
+        await outbox.ack([sent[0]])
+        await outbox.retry_later([failed], "backend down")
+        return await outbox.stats()
+
+    stats = run(scenario())
+    assert stats == {"pending": {"count": 1, "oldest_age": stats["pending"]["oldest_age"]}}
+
+
+def test_expired_lease_is_claimed_again(tmp_path, run, monkeypatch):
+    outbox = ResultOutbox(str(tmp_path / "outbox.sqlite3"))
+    monkeypatch.setattr(settings, "OUTBOX_LEASE", 0.05)
+
+    async def scenario():
+        await outbox.append({"task_id": "orphaned"})
+        claimed = await outbox.claim(10)
+        still_leased = await outbox.claim(10)
+        time.sleep(0.1)
+        return claimed, still_leased, await outbox.claim(10)
+
+    claimed, still_leased, reclaimed = run(scenario())
+    assert still_leased == []
+    assert [row_id for row_id, _, _ in reclaimed] == [row_id for row_id, _, _ in claimed]
+    assert reclaimed[0][1] == {"task_id": "orphaned"}
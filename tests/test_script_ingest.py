@@ -0,0 +1,60 @@
+import io
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.datastructures import UploadFile
+
+from app.api import endpoints1
+from app.core.config import settings
+from app.services.script_formats import ScriptTooLargeError
+from app.services.script_ingest import ingest_scripts
+
+
+def _upload(name: str, data: bytes) -> UploadFile:
+    return UploadFile(io.BytesIO(data), filename=name)
+
+
+def test_small_scripts_are_read(run):
+    documents = run(ingest_scripts([_upload("a.txt", b"INT. HOUSE - DAY"), _upload("b.fountain", b"EXT. PARK - NIGHT")]))
+    assert [document.text for document in documents] == ["INT. HOUSE - DAY", "EXT. PARK - NIGHT"]
+
+
+def test_file_over_the_byte_limit(run, monkeypatch):
+    monkeypatch.setattr(settings, "SCRIPT_INGEST_MAX_FILE_BYTES", 100)
+    monkeypatch.setattr(settings, "SCRIPT_INGEST_CHUNK_SIZE", 16)
+    with pytest.raises(ScriptTooLargeError, match="a.txt is over the 100-byte limit"):
+        run(ingest_scripts([_upload("a.txt", b"x" * 101)]))
+
+
+def test_files_together_over_the_byte_limit(run, monkeypatch):
+    monkeypatch.setattr(settings, "SCRIPT_INGEST_MAX_FILE_BYTES", 100)
+    monkeypatch.setattr(settings, "SCRIPT_INGEST_MAX_TOTAL_BYTES", 150)
+    with pytest.raises(ScriptTooLargeError, match="together are over the 150-byte limit"):
+        run(ingest_scripts([_upload("a.txt", b"x" * 80), _upload("b.txt", b"x" * 80)]))
+
+
+def test_too_many_files(run, monkeypatch):
+    monkeypatch.setattr(settings, "SCRIPT_INGEST_MAX_FILES", 2)
+    with pytest.raises(ScriptTooLargeError, match="At most 2"):
+        run(ingest_scripts([_upload(f"{i}.txt", b"x") for i in range(3)]))
+
+
+def test_file_over_the_token_limit(run, monkeypatch):
+    monkeypatch.setattr(settings, "SCRIPT_INGEST_MAX_FILE_TOKENS", 10)
+    with pytest.raises(ScriptTooLargeError, match="a.txt is over the 10-token limit per file"):
+        run(ingest_scripts([_upload("a.txt", b"word " * 200)]))
+
+
+def test_files_together_over_the_token_limit(run, monkeypatch):
+    monkeypatch.setattr(settings, "SCRIPT_INGEST_MAX_TOTAL_TOKENS", 60)
+    with pytest.raises(ScriptTooLargeError, match="together are over the 60-token limit"):
+        run(ingest_scripts([_upload("a.txt", b"word " * 50), _upload("b.txt", b"word " * 50)]))
+
+
+def test_oversized_upload_is_a_413(monkeypatch):
+    monkeypatch.setattr(settings, "SCRIPT_INGEST_MAX_FILE_BYTES", 100)
+    app = FastAPI()
+    app.include_router(endpoints1.router)
+    response = TestClient(app).post("/analyze-script", files={"files": ("a.txt", b"x" * 101, "text/plain")})
+    assert response.status_code == 413